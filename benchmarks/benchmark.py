@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#    This file is part of billingflatfile and is MIT-licensed.
+
+# Measure the throughput of the full command-line path on synthetic extracts:
+# $ python3 benchmarks/benchmark.py --rows 10k,1M --output results.json
+# Compare the results of two commits:
+# $ python3 benchmarks/benchmark.py --compare before.json after.json
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT_DIRECTORY, "billingflatfile.py")
+CONFIG = os.path.join(ROOT_DIRECTORY, "tests", "sample_files", "configuration1.xlsx")
+
+FIRST_NAMES = ("Leendert", "Anna", "Jan", "Sophie", "Pieter", "Emma", "Willem")
+LAST_NAMES = ("MOLENDIJK", "DE VRIES", "JANSEN", "BAKKER", "VISSER", "SMIT")
+
+
+def parse_rows(value):
+    # Number of rows, optionally followed by k or M (10k, 1M, 10M)
+    m = re.match(r"^(\d+)([kKmM]?)$", value)
+    if not m:
+        raise argparse.ArgumentTypeError("invalid number of rows '%s'" % value)
+    multipliers = {"": 1, "k": 1000, "m": 1000 ** 2}
+    return int(m.group(1)) * multipliers[m.group(2).lower()]
+
+
+def generate_row(rnd):
+    # A row shaped like the ones in tests/sample_files/input1.txt
+    first_name = rnd.choice(FIRST_NAMES)
+    last_name = rnd.choice(LAST_NAMES)
+    time_separator = rnd.choice((":", ""))
+    return "^".join(
+        (
+            "%05d" % rnd.randrange(100000),
+            "%07d" % rnd.randrange(10000000),
+            "%06d" % rnd.randrange(1000000),
+            "%d.%0*d" % (rnd.randrange(10000), rnd.randint(1, 3), rnd.randrange(10)),
+            "%d/%d/%d"
+            % (rnd.randint(1, 28), rnd.randint(1, 12), rnd.randint(2015, 2025)),
+            "%02d%s%02d" % (rnd.randrange(24), time_separator, rnd.randrange(60)),
+            "%s, %s" % (last_name, first_name.upper()),
+            "%s %s [%08d]" % (first_name, last_name, rnd.randrange(100000000)),
+        )
+    )
+
+
+def generate_extract(file_name, num_rows, seed=0):
+    # A header row, the data rows and a footer row with the number of rows
+    rnd = random.Random(seed)
+    with open(file_name, "w") as f:
+        f.write("H^12301^WLX Lab Flat File\n")
+        for _ in range(num_rows):
+            f.write(generate_row(rnd))
+            f.write("\n")
+        f.write("T^%d^15072020\n" % num_rows)
+
+
+def get_extract(work_directory, num_rows):
+    # The extracts are deterministic, reuse the ones generated by a previous run
+    file_name = os.path.join(work_directory, "extract_%d.txt" % num_rows)
+    if not os.path.isfile(file_name):
+        logging.info("Generating %s with %d rows" % (file_name, num_rows))
+        generate_extract(file_name, num_rows)
+    return file_name
+
+
+def run_script(arguments):
+    # Returns the wall time in seconds and the peak RSS in bytes of the script
+    start_time = time.perf_counter()
+    process = subprocess.Popen([sys.executable, SCRIPT] + arguments)
+    peak_rss = None
+    if hasattr(os, "wait4"):
+        (_, status, rusage) = os.wait4(process.pid, 0)
+        if os.WIFEXITED(status):
+            process.returncode = os.WEXITSTATUS(status)
+        else:
+            process.returncode = -os.WTERMSIG(status)
+        # ru_maxrss is in kilobytes, except on macOS where it is in bytes
+        peak_rss = rusage.ru_maxrss
+        if sys.platform != "darwin":
+            peak_rss *= 1024
+    else:
+        process.wait()
+    wall_time = time.perf_counter() - start_time
+    if process.returncode:
+        raise RuntimeError("The script exited with code %d" % process.returncode)
+    return (wall_time, peak_rss)
+
+
+def benchmark(input_file, num_rows, work_directory, repeat, extra_arguments):
+    output_directory = os.path.join(work_directory, "output")
+    arguments = [
+        "--input",
+        input_file,
+        "--output-directory",
+        output_directory,
+        "--config",
+        CONFIG,
+        "--delimiter",
+        "^",
+        "--skip-header",
+        "1",
+        "--skip-footer",
+        "1",
+        "--application-id",
+        "BE",
+        "--run-id",
+        "1",
+        "--date-report",
+        "5",
+        "--overwrite-files",
+    ] + extra_arguments
+    # Keep the best of the repeated runs, the least disturbed by other processes
+    measures = [run_script(arguments) for _ in range(repeat)]
+    wall_time = min(measure[0] for measure in measures)
+    peak_rss = max(measure[1] or 0 for measure in measures) or None
+    input_bytes = os.path.getsize(input_file)
+    result = {
+        "rows": num_rows,
+        "input_bytes": input_bytes,
+        "wall_time": wall_time,
+        "rows_per_second": num_rows / wall_time,
+        "mb_per_second": input_bytes / wall_time / 1024 ** 2,
+        "peak_rss_bytes": peak_rss,
+    }
+    logging.info(
+        "%d rows: %.2f s, %d rows/s, %.2f MB/s"
+        % (num_rows, wall_time, result["rows_per_second"], result["mb_per_second"])
+    )
+    return result
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=ROOT_DIRECTORY,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(rows, work_directory, repeat, extra_arguments):
+    return {
+        "commit": get_commit(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "arguments": extra_arguments,
+        "results": [
+            benchmark(
+                get_extract(work_directory, num_rows),
+                num_rows,
+                work_directory,
+                repeat,
+                extra_arguments,
+            )
+            for num_rows in rows
+        ],
+    }
+
+
+def compare_results(before_file, after_file):
+    with open(before_file) as f:
+        before = {r["rows"]: r for r in json.load(f)["results"]}
+    with open(after_file) as f:
+        after = {r["rows"]: r for r in json.load(f)["results"]}
+    lines = []
+    for num_rows in sorted(set(before) & set(after)):
+        (b, a) = (before[num_rows], after[num_rows])
+        change = (a["rows_per_second"] / b["rows_per_second"] - 1) * 100
+        lines.append(
+            "%10d rows: %10d -> %10d rows/s (%+.1f%%)"
+            % (num_rows, b["rows_per_second"], a["rows_per_second"], change)
+        )
+    return "\n".join(lines)
+
+
+def parse_args(arguments):
+    parser = argparse.ArgumentParser(
+        description="Measure the throughput of billingflatfile on synthetic extracts"
+    )
+    parser.add_argument(
+        "-r",
+        "--rows",
+        help="Comma-delimited list of the number of rows of the extracts to convert, "
+        "with an optional k or M suffix (default: 10k,1M,10M)",
+        action="store",
+        default="10k,1M,10M",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="The JSON file in which to save the results",
+        action="store",
+    )
+    parser.add_argument(
+        "-wd",
+        "--work-directory",
+        help="The directory in which to keep the generated extracts, reused by "
+        "subsequent runs (default: a temporary directory)",
+        action="store",
+    )
+    parser.add_argument(
+        "-n",
+        "--repeat",
+        help="The number of times to convert each extract, the fastest run is kept "
+        "(default: 1)",
+        action="store",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "-c",
+        "--compare",
+        help="Compare two JSON results files instead of running the benchmarks",
+        action="store",
+        nargs=2,
+        metavar=("BEFORE", "AFTER"),
+    )
+    (args, extra_arguments) = parser.parse_known_args(arguments)
+    # The unknown arguments are passed to billingflatfile, e.g. `--jobs 4`
+    args.extra_arguments = extra_arguments
+    if not args.compare:
+        args.rows = [parse_rows(value) for value in args.rows.split(",")]
+    return args
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    args = parse_args(sys.argv[1:])
+    if args.compare:
+        print(compare_results(*args.compare))
+        return
+    if args.work_directory:
+        os.makedirs(args.work_directory, exist_ok=True)
+        results = run_benchmarks(
+            args.rows, args.work_directory, args.repeat, args.extra_arguments
+        )
+    else:
+        with tempfile.TemporaryDirectory() as work_directory:
+            results = run_benchmarks(
+                args.rows, work_directory, args.repeat, args.extra_arguments
+            )
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,42 +4,239 @@
 #    This file is part of billingflatfile and is MIT-licensed.
 
 import argparse
+import collections
+import contextlib
+import csv
+import functools
+import hashlib
+import io
+import itertools
+import json
 import logging
+import mmap
 import os
 import pathlib
+import queue
 import re
 import shutil
+import socket
 import sys
-
-import delimited2fixedwidth
+import threading
+import time
+from locale import LC_NUMERIC, atof, setlocale
 
 
 __version__ = "1.0.7-dev"
 
+# Only imported when a file needs to be converted, see load_delimited2fixedwidth()
+delimited2fixedwidth = None
+
+# Bump when the layout of the compiled configuration cache entries changes
+CONFIG_CACHE_VERSION = 1
+
+# The number of rows is stored on 6 digits in the metadata file
+MAX_ROWS_PER_RUN = 999999
+
+# Bump when the layout of the checkpoint files changes
+CHECKPOINT_VERSION = 1
+
+# Name of the conversion errors reported by `--validate-only`, by exit code
+VALIDATION_ERRORS = {
+    17: "invalid time",
+    18: "invalid date",
+    19: "invalid decimal",
+    20: "too long",
+    23: "too many fields",
+    24: "date without leading zeros",
+}
+
+# Number of row numbers listed per group of invalid values by `--validate-only`
+MAX_REPORTED_ROWS = 5
+
+# Maximum number of distinct values of a Date or Time field whose conversion is
+# remembered: enough for the dates of several years and the 1440 times of a day
+CONVERSION_CACHE_SIZE = 4096
+
+# Size of the blocks read when hashing the content of an input file
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# How long to wait for the lock of the Run ID file, and after how long a lock left
+# behind by a crashed process is considered stale (in seconds)
+RUN_ID_LOCK_TIMEOUT = 60
+RUN_ID_LOCK_STALE = 30
+
+# With `--pipeline`: number of lines handed over at once by the reader thread,
+# number of characters written at once by the writer thread, maximum number of
+# batches waiting between the threads, and size of the blocks read when prefetching
+# the next input file
+PIPELINE_BATCH_SIZE = 10000
+PIPELINE_BUFFER_SIZE = 1024 * 1024
+PIPELINE_QUEUE_SIZE = 8
+PREFETCH_BLOCK_SIZE = 1024 * 1024
+
+# Number of converted rows joined into a single write to the detailed output file
+WRITE_BATCH_SIZE = 1000
+
+# The compressed input files are recognized by the first bytes of their content
+COMPRESSION_MAGIC_BYTES = (
+    (b"\x1f\x8b", "gzip"),
+    (b"BZh", "bz2"),
+    (b"\xfd7zXZ\x00", "xz"),
+    (b"\x28\xb5\x2f\xfd", "zstd"),
+)
+
+# Result of the conversion of (part of) an input file to a pair of output files.
+# process_peak_rss is the peak memory usage of the process that converted it, since
+# that process started: not of this conversion alone.
+RunResult = collections.namedtuple(
+    "RunResult",
+    [
+        "input_file",
+        "input_bytes",
+        "run_id",
+        "num_input_rows",
+        "oldest_date",
+        "most_recent_date",
+        "metadata_file",
+        "detailed_file",
+        "diverted_file",
+        "rejects_file",
+        "timings",
+        "process_peak_rss",
+    ],
+)
+
+# Result of the validation of an input file: the number of rows and the invalid
+# values found, grouped by field number (None for the rows with too many fields)
+# and exit code of the conversion error
+ValidationResult = collections.namedtuple(
+    "ValidationResult", ["input_file", "num_input_rows", "errors"]
+)
+
+# Result of the conversion of a batch of input files
+BatchResult = collections.namedtuple("BatchResult", ["runs", "next_run_id", "timings"])
+
+
+class BillingFlatFileError(Exception):
+    """Base class of the errors raised while generating the billing files.
+
+    The exit code is the one the command-line interface exits with."""
+
+    def __init__(self, message, exit_code):
+        super().__init__(message, exit_code)
+        self.message = message
+        self.exit_code = exit_code
+
+    def __str__(self):
+        return self.message
+
+
+class InvalidArgumentError(BillingFlatFileError):
+    pass
+
+
+class ConfigurationError(BillingFlatFileError):
+    pass
+
+
+class ConversionError(BillingFlatFileError):
+    pass
+
+
+class MetadataError(BillingFlatFileError):
+    pass
+
+
+class OutputFileExistsError(BillingFlatFileError):
+    pass
+
+
+class RunIdError(BillingFlatFileError):
+    pass
+
+
+def exit_with_error(error):
+    # The command-line interface reports the errors and exits with their exit code
+    logging.critical("%s Exiting..." % error)
+    sys.exit(error.exit_code)
+
+
+@contextlib.contextmanager
+def raising_errors_of_delimited2fixedwidth(error_class, default_message):
+    # delimited2fixedwidth logs the reason of an error as a critical error, then
+    # exits: raise an error_class exception with that reason instead, without the
+    # log, so that it is only reported once
+    messages = []
+
+    def capture_critical(record):
+        if record.levelno < logging.CRITICAL:
+            return True
+        messages.append(record.getMessage())
+        return False
+
+    logging.getLogger().addFilter(capture_critical)
+    try:
+        yield
+    except SystemExit as e:
+        message = messages[-1] if messages else default_message
+        if message.endswith(" Exiting..."):
+            message = message[: -len(" Exiting...")]
+        raise error_class(message, e.code)
+    finally:
+        logging.getLogger().removeFilter(capture_critical)
+
+
+@contextlib.contextmanager
+def open_output_file(output_file, mode="w"):
+    # "-" is the standard output, "fd:<number>" an already open file descriptor
+    if output_file == "-":
+        yield sys.stdout
+        sys.stdout.flush()
+    elif output_file.startswith("fd:"):
+        with open(int(output_file[3:]), mode) as ofile:
+            yield ofile
+    else:
+        with open(output_file, mode) as ofile:
+            yield ofile
+
+
+def is_output_stream(output_file):
+    return output_file == "-" or output_file.startswith("fd:")
+
 
 def save_file(output_content, output_file):
-    with open(output_file, "w") as ofile:
+    with open_output_file(output_file) as ofile:
         ofile.write(output_content)
 
 
+def save_file_atomically(output_content, output_file):
+    # A crash must never leave a partially written file behind
+    temp_output_file = "%s.tmp" % output_file
+    with open(temp_output_file, "w") as f:
+        f.write(output_content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_output_file, output_file)
+
+
 def pad_output_value(val, output_format, length, field_name):
     val = str(val)
     if len(val) > length:
-        logging.critical(
-            "Field '%s' for metadata file is too long! Length: %d, max length %d. "
-            "Exiting..." % (field_name, len(val), length)
+        raise MetadataError(
+            "Field '%s' for metadata file is too long! Length: %d, max length %d."
+            % (field_name, len(val), length),
+            214,
         )
-        sys.exit(214)
     if output_format == "numeric":
         # Confirm that field is actually a number
         try:
             int(val)
         except ValueError:
-            logging.critical(
+            raise MetadataError(
                 "A non-numeric value was passed for the numeric '%s' metadata file "
-                "field. Exiting..." % field_name
+                "field." % field_name,
+                215,
             )
-            sys.exit(215)
         # Numbers get padded with 0's added in front (to the left)
         val = val.zfill(length)
     elif output_format == "alphanumeric":
@@ -47,11 +244,11 @@ def pad_output_value(val, output_format, length, field_name):
         format_template = "{:<%d}" % length
         val = format_template.format(val)
     else:
-        logging.critical(
-            "Unsupported output format '%s' for metadata file field '%s'. Exiting..."
-            % (output_format, field_name)
+        raise MetadataError(
+            "Unsupported output format '%s' for metadata file field '%s'."
+            % (output_format, field_name),
+            216,
         )
-        sys.exit(216)
     return val
 
 
@@ -68,11 +265,11 @@ def generate_metadata_file(
     output = ""
     supported_file_versions = ["V1.11"]
     if file_version not in supported_file_versions:
-        logging.critical(
-            "Unsupported output file version '%s', must be one of '%s'. Exiting..."
-            % (file_version, "', '".join(supported_file_versions))
+        raise MetadataError(
+            "Unsupported output file version '%s', must be one of '%s'."
+            % (file_version, "', '".join(supported_file_versions)),
+            213,
         )
-        sys.exit(213)
     # 1 - application_id, 3 alphanumeric character
     output = pad_output_value(
         "S%s" % application_id, "alphanumeric", 3, "application_id"
@@ -100,41 +297,461 @@ def generate_metadata_file(
 
 
 def validate_run_id_run_id_file(args):
-    if not args.run_id and not args.run_id_file:
-        logging.critical(
+    if not args.run_id and not args.run_id_file and not args.validate_only:
+        raise InvalidArgumentError(
             "Either the `--run-id` or the `--run-id-file` arguments "
-            "must be specified. Exiting..."
+            "must be specified.",
+            224,
         )
-        sys.exit(224)
+    if args.run_id_lease is not None:
+        try:
+            args.run_id_lease = int(args.run_id_lease)
+        except ValueError:
+            args.run_id_lease = 0
+        if args.run_id_lease < 1:
+            raise InvalidArgumentError(
+                "The `--run-id-lease` argument must be a positive number of Run IDs.",
+                242,
+            )
+        if args.run_id or not args.run_id_file:
+            raise InvalidArgumentError(
+                "The `--run-id-lease` argument requires the `--run-id-file` argument, "
+                "and cannot be combined with the `--run-id` argument.",
+                243,
+            )
     if not args.run_id:
-        if os.path.isfile(args.run_id_file):
-            # Read the Run ID from the provided file
-            with open(args.run_id_file) as f:
-                content = f.read()
-                try:
-                    args.run_id = int(content)
-                except ValueError:
-                    logging.critical(
-                        "The value stored in the file passed in the `--run-id-file` "
-                        "argument must be numeric. Exiting..."
-                    )
-                    sys.exit(225)
-        else:
-            # Default Run ID starts at 0
-            args.run_id = 0
+        args.run_id = read_run_id_file(args.run_id_file) if args.run_id_file else 0
     try:
         args.run_id = int(args.run_id)
     except ValueError:
-        logging.critical("The `--run-id` argument must be numeric. Exiting...")
-        sys.exit(210)
+        raise InvalidArgumentError("The `--run-id` argument must be numeric.", 210)
     if args.run_id < 0 or args.run_id > 9999:
-        logging.critical(
-            "The `--run-id` argument must be comprised between 0 and 9999. Exiting..."
+        raise InvalidArgumentError(
+            "The `--run-id` argument must be comprised between 0 and 9999.", 211
         )
-        sys.exit(211)
 
 
-def parse_args(arguments):
+def read_run_id_file(run_id_file_name):
+    if not os.path.isfile(run_id_file_name):
+        # Default Run ID starts at 0
+        return 0
+    # Read the Run ID from the provided file
+    with open(run_id_file_name) as f:
+        content = f.read()
+    try:
+        return int(content)
+    except ValueError:
+        raise InvalidArgumentError(
+            "The value stored in the file passed in the `--run-id-file` argument must "
+            "be numeric.",
+            225,
+        )
+
+
+def validate_jobs(args):
+    if str(args.jobs).lower() == "auto":
+        args.jobs = os.cpu_count() or 1
+    try:
+        args.jobs = int(args.jobs)
+    except ValueError:
+        raise InvalidArgumentError(
+            "The `--jobs` argument must be numeric or 'auto'.", 226
+        )
+    if args.jobs < 1:
+        raise InvalidArgumentError("The `--jobs` argument must be at least 1.", 227)
+
+
+def validate_chunk_size(args):
+    if args.chunk_size is None:
+        return
+    m = re.match(r"^(\d+)([KMG]?)B?$", str(args.chunk_size).upper())
+    if not m or int(m.group(1)) < 1:
+        raise InvalidArgumentError(
+            "The `--chunk-size` argument must be a positive number of bytes, "
+            "optionally followed by K, M or G.",
+            228,
+        )
+    multipliers = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    args.chunk_size = int(m.group(1)) * multipliers[m.group(2)]
+
+
+def validate_max_rows_per_run(args):
+    if args.max_rows_per_run is None:
+        return
+    if str(args.max_rows_per_run).lower() == "auto":
+        args.max_rows_per_run = str(MAX_ROWS_PER_RUN)
+    try:
+        args.max_rows_per_run = int(args.max_rows_per_run)
+    except ValueError:
+        args.max_rows_per_run = 0
+    if args.max_rows_per_run < 1 or args.max_rows_per_run > MAX_ROWS_PER_RUN:
+        raise InvalidArgumentError(
+            "The `--max-rows-per-run` argument must be 'auto' or comprised between 1 "
+            "and %d." % MAX_ROWS_PER_RUN,
+            229,
+        )
+    if args.jobs > 1 or args.chunk_size:
+        raise InvalidArgumentError(
+            "The `--max-rows-per-run` argument cannot be combined with the `--jobs` "
+            "or `--chunk-size` arguments.",
+            230,
+        )
+
+
+def validate_checkpoint(args):
+    if args.checkpoint is None:
+        return
+    try:
+        args.checkpoint = int(args.checkpoint)
+    except ValueError:
+        args.checkpoint = 0
+    if args.checkpoint < 1:
+        raise InvalidArgumentError(
+            "The `--checkpoint` argument must be a positive number of rows.", 240
+        )
+    if args.chunk_size or args.max_rows_per_run or args.output:
+        raise InvalidArgumentError(
+            "The `--checkpoint` argument cannot be combined with the `--chunk-size`, "
+            "`--max-rows-per-run` or `--output` arguments.",
+            241,
+        )
+    if args.pipeline:
+        # The rows read ahead would be recorded in the checkpoints as converted
+        raise InvalidArgumentError(
+            "The `--checkpoint` argument cannot be combined with the `--pipeline` "
+            "argument.",
+            245,
+        )
+
+
+def validate_decimal_separator(args):
+    if args.decimal_separator is None:
+        return
+    if len(args.decimal_separator) != 1 or args.decimal_separator in "0123456789+-":
+        raise InvalidArgumentError(
+            "The `--decimal-separator` argument must be a single character, other "
+            "than a digit or a sign.",
+            253,
+        )
+    if args.locale:
+        raise InvalidArgumentError(
+            "The `--decimal-separator` argument cannot be combined with the "
+            "`--locale` argument.",
+            254,
+        )
+
+
+def validate_on_error(args):
+    if args.on_error not in ("fail", "collect", "divert"):
+        raise InvalidArgumentError(
+            "The `--on-error` argument must be 'fail', 'collect' or 'divert'.", 248
+        )
+    if args.on_error != "fail" and (
+        args.chunk_size
+        or args.checkpoint
+        or (args.output and is_output_stream(args.output))
+    ):
+        # The row numbers are relative to the chunks, the rejects file isn't
+        # checkpointed and has no name next to a stream
+        raise InvalidArgumentError(
+            "The `--on-error` argument must be 'fail' when combined with the "
+            "`--chunk-size` or `--checkpoint` arguments, or when writing the detailed "
+            "output to a stream.",
+            249,
+        )
+
+
+def add_shared_args(parser):
+    # Same arguments as delimited2fixedwidth.add_shared_args: defined here to not
+    # have to import delimited2fixedwidth (and openpyxl) just to parse the command
+    # line
+    input_group = parser.add_mutually_exclusive_group(required=True)
+    input_group.add_argument(
+        "-i",
+        "--input",
+        help="Specify the input file, which can be compressed with gzip, bzip2, xz or "
+        "Zstandard (requires the `zstandard` package), or '-' to read from the "
+        "standard input",
+        action="store",
+    )
+    input_group.add_argument(
+        "-id",
+        "--input-directory",
+        help="Specify the input directory from which to process input files",
+        action="store",
+    )
+    parser.add_argument(
+        "-ie",
+        "--input-encoding",
+        help="Specify the encoding of the input files (default: 'utf-8')",
+        action="store",
+        required=False,
+        default="utf-8",
+    )
+    output_group = parser.add_mutually_exclusive_group(required=True)
+    output_group.add_argument(
+        "-o",
+        "--output",
+        help="Specify the detailed output file, '-' to write it to the standard "
+        "output, or 'fd:<number>' to write it to an open file descriptor. Must be "
+        "used in conjunction with the `--metadata-output` argument.",
+        action="store",
+    )
+    output_group.add_argument(
+        "-od",
+        "--output-directory",
+        help="The directory in which to create the output files",
+        action="store",
+    )
+    parser.add_argument(
+        "-m",
+        "--move-input-files",
+        help="Move the input files to the output directory after processing. Must be "
+        "used in conjunction with the `--output-directory` argument.",
+        action="store_true",
+        required=False,
+    )
+    parser.add_argument(
+        "-c",
+        "--config",
+        help="Specify the configuration file",
+        action="store",
+        required=True,
+    )
+    parser.add_argument(
+        "-dl",
+        "--delimiter",
+        help="The field delimiter used in the input file (default ,)",
+        action="store",
+        required=False,
+        default=",",
+    )
+    parser.add_argument(
+        "-q",
+        "--quotechar",
+        help='The character used to wrap textual fields in the input file (default ")',
+        action="store",
+        required=False,
+        default='"',
+    )
+    parser.add_argument(
+        "-sh",
+        "--skip-header",
+        help="The number of header lines to skip (default 0)",
+        action="store",
+        required=False,
+        default=0,
+    )
+    parser.add_argument(
+        "-sf",
+        "--skip-footer",
+        help="The number of footer lines to skip (default 0)",
+        action="store",
+        required=False,
+        default=0,
+    )
+    parser.add_argument(
+        "-l",
+        "--locale",
+        help="Change the locale, useful to handle decimal separators",
+        action="store",
+        required=False,
+        default="",
+    )
+    parser.add_argument(
+        "-t",
+        "--truncate",
+        help="Comma-delimited list of field numbers for which the output will be "
+        "truncated at the maximum line length, should the input value be longer than "
+        "the maximum defined field length. If not set, a field that is too long will "
+        "cause the script to stop with an error.",
+        action="store",
+        required=False,
+        default=[],
+    )
+    parser.add_argument(
+        "-dv",
+        "--divert",
+        help="Diverts to a separate file the content from rows containing a specific "
+        'value at a specific place. The format of this parameter is "<field number>'
+        ',<value to divert on>" (without quotes). This parameter can be repeated '
+        "several times to support different values or different fields. The diverted "
+        "content will be saved to a file whose name will be the output filename with "
+        '"_diverted" added before the file extension.',
+        action="append",
+        required=False,
+        default=[],
+    )
+
+
+def validate_divert(divert, divert_files=(), encoding=None):
+    # The values to divert on, in a set per field: whatever the number of values,
+    # checking a row costs one lookup per field
+    divert_values = {}
+    for d in divert:
+        v = d.split(",", 1)
+        try:
+            v[0] = int(v[0])
+        except ValueError:
+            raise InvalidArgumentError(
+                "<field number> must be a number, as passed to the `--divert` "
+                'argument in the format "<field number>,<value to divert on>" '
+                "(without quotes).",
+                28,
+            )
+        if len(v) == 2:
+            divert_values.setdefault(v[0], set()).add(v[1])
+        else:
+            raise InvalidArgumentError(
+                'The `--divert` argument must be formatted as "<field number>,'
+                '<value to divert on>" (without quotes).',
+                29,
+            )
+    for d in divert_files:
+        v = d.split(",", 1)
+        try:
+            v[0] = int(v[0])
+        except ValueError:
+            v = []
+        if len(v) != 2:
+            raise InvalidArgumentError(
+                'The `--divert-file` argument must be formatted as "<field number>,'
+                '<path of the file>" (without quotes).',
+                251,
+            )
+        if not os.path.isfile(v[1]):
+            raise InvalidArgumentError(
+                "The file '%s' passed in the `--divert-file` argument does not exist."
+                % v[1],
+                252,
+            )
+        with open(v[1], encoding=encoding) as f:
+            values = {line.rstrip("\r\n") for line in f}
+        # Ignore the empty lines, use `--divert` to divert on empty values
+        values.discard("")
+        divert_values.setdefault(v[0], set()).update(values)
+    return divert_values
+
+
+def validate_shared_args(args):
+    # The validations from delimited2fixedwidth.validate_shared_args that apply to
+    # the arguments of this script
+    if args.input:
+        # "-" reads the input from the standard input
+        if args.input != "-" and not os.path.isfile(args.input):
+            raise InvalidArgumentError("The specified input file does not exist.", 10)
+    elif args.input_directory:
+        if not os.path.isdir(args.input_directory):
+            raise InvalidArgumentError(
+                "The value passed as `--input-directory` argument is not a valid "
+                "folder path.",
+                33,
+            )
+    if not os.path.isfile(args.config):
+        raise InvalidArgumentError(
+            "The specified configuration file does not exist.", 12
+        )
+    if args.skip_header != 0:
+        try:
+            args.skip_header = int(args.skip_header)
+        except ValueError:
+            raise InvalidArgumentError(
+                "The `--skip-header` argument must be numeric.", 21
+            )
+    if args.skip_footer != 0:
+        try:
+            args.skip_footer = int(args.skip_footer)
+        except ValueError:
+            raise InvalidArgumentError(
+                "The `--skip-footer` argument must be numeric.", 22
+            )
+    if args.truncate:
+        truncate = []
+        for t in args.truncate.split(","):
+            try:
+                truncate.append(int(t))
+            except ValueError:
+                raise InvalidArgumentError(
+                    "The `--truncate` argument must be a comma-delimited list of "
+                    "numbers.",
+                    25,
+                )
+        args.truncate = truncate
+    if args.divert or args.divert_file:
+        args.divert = validate_divert(
+            args.divert, args.divert_file, args.input_encoding
+        )
+
+
+def validate_output(args):
+    if args.input_directory and not args.output_directory:
+        raise InvalidArgumentError(
+            "The `--output_directory` argument must be specified in addition to "
+            "the `--input_directory` argument.",
+            32,
+        )
+    if args.move_input_files and not args.output_directory:
+        raise InvalidArgumentError(
+            "The `--move-input-files` argument can only be used in combination with "
+            "the `--output-directory` argument.",
+            35,
+        )
+    if args.move_input_files and args.input == "-":
+        raise InvalidArgumentError(
+            "The `--move-input-files` argument can't be used when reading the input "
+            "from the standard input.",
+            238,
+        )
+    if bool(args.output) != bool(args.metadata_output):
+        raise InvalidArgumentError(
+            "The `--output` and `--metadata-output` arguments must be used together.",
+            236,
+        )
+    if args.output == "-" and (args.divert or args.divert_file):
+        raise InvalidArgumentError(
+            "The `--divert` argument can't be used when writing the detailed output "
+            "to the standard output.",
+            237,
+        )
+    if args.output and args.max_rows_per_run:
+        raise InvalidArgumentError(
+            "The `--max-rows-per-run` argument can't be combined with the `--output` "
+            "argument.",
+            239,
+        )
+    if (
+        args.output_directory
+        and not os.path.isdir(args.output_directory)
+        and not args.validate_only
+    ):
+        pathlib.Path(args.output_directory).mkdir(parents=True, exist_ok=True)
+
+
+def validate_watch(args):
+    if args.watch and not args.input_directory:
+        raise InvalidArgumentError(
+            "The `--watch` argument can only be used in combination with the "
+            "`--input-directory` argument.",
+            231,
+        )
+    if args.watch and args.validate_only:
+        raise InvalidArgumentError(
+            "The `--watch` argument can't be combined with the `--validate-only` "
+            "argument.",
+            246,
+        )
+    try:
+        args.watch_interval = float(args.watch_interval)
+    except ValueError:
+        args.watch_interval = -1
+    if args.watch_interval < 0:
+        raise InvalidArgumentError(
+            "The `--watch-interval` argument must be a positive number of seconds.",
+            232,
+        )
+
+
+def build_parser():
     parser = argparse.ArgumentParser(
         description="Generate the required fixed width format files from delimited "
         "files extracts for EMR billing purposes"
@@ -145,8 +762,17 @@ def parse_args(arguments):
         version="%s %s" % ("%(prog)s", __version__),
     )
 
-    delimited2fixedwidth.add_shared_args(parser)
+    add_shared_args(parser)
 
+    parser.add_argument(
+        "-mo",
+        "--metadata-output",
+        help="Specify the metadata output file, written once the whole input has been "
+        "converted, or 'fd:<number>' to write it to an open file descriptor. Must be "
+        "used in conjunction with the `--output` argument.",
+        action="store",
+        required=False,
+    )
     parser.add_argument(
         "-x",
         "--overwrite-files",
@@ -203,6 +829,18 @@ def parse_args(arguments):
         action="store",
         required=False,
     )
+    parser.add_argument(
+        "-rl",
+        "--run-id-lease",
+        help="Lease the Run IDs from the `--run-id-file` while processing, in blocks "
+        "of at least this number of Run IDs, instead of reading the Run ID once at "
+        "the start and saving the next one at the end. This allows several processes, "
+        "also on different machines sharing the Run ID file, to run at the same time "
+        "without ever using the same Run ID. The unused Run IDs of a block are "
+        "returned at the end, to be leased again.",
+        action="store",
+        required=False,
+    )
     parser.add_argument(
         "-fv",
         "--file-version",
@@ -221,6 +859,185 @@ def parse_args(arguments):
         required=False,
         default=None,
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="The number of worker processes used to convert the input files in "
+        "parallel, or 'auto' to use one worker per CPU core (default 1). The Run IDs "
+        "are still assigned in the same order as when processing the files one after "
+        "the other.",
+        action="store",
+        required=False,
+        default="1",
+    )
+    parser.add_argument(
+        "-cs",
+        "--chunk-size",
+        help="Split each input file at line boundaries in chunks of about this size "
+        "(in bytes, or with a K, M or G suffix), converted in parallel by the "
+        "`--jobs` workers. Row numbers in error messages are then relative to the "
+        "start of each chunk. Rows must not span several lines.",
+        action="store",
+        required=False,
+    )
+    parser.add_argument(
+        "-vo",
+        "--validate-only",
+        help="Only check every row of the input files against the configuration, "
+        "reporting all the invalid values grouped by field and error, without "
+        "writing any output file nor using any Run ID.",
+        action="store_true",
+        required=False,
+    )
+    parser.add_argument(
+        "-pl",
+        "--pipeline",
+        help="Read the input file and write the detailed output file in background "
+        "threads, overlapping the disk (or network) accesses with the conversion, and "
+        "read the next input file ahead while the current one is being converted.",
+        action="store_true",
+        required=False,
+    )
+    parser.add_argument(
+        "-mr",
+        "--max-rows-per-run",
+        help="Start a new run, with the next Run ID, each time an input file reaches "
+        "this number of rows, or 'auto' to split at the maximum of 999999 rows that "
+        "the metadata file supports. Cannot be combined with `--jobs` or "
+        "`--chunk-size`.",
+        action="store",
+        required=False,
+    )
+    parser.add_argument(
+        "-df",
+        "--divert-file",
+        help="Like the `--divert` argument, for all the values listed in a file, one "
+        'value per line. The format of this parameter is "<field number>,<path of the '
+        'file>" (without quotes). This parameter can be repeated several times to '
+        "support different fields, and combined with the `--divert` argument.",
+        action="append",
+        required=False,
+        default=[],
+    )
+    parser.add_argument(
+        "-dp",
+        "--decimal-separator",
+        help="The decimal separator of the Decimal values, e.g. ',' or '.'. The "
+        "values are then converted without using the locale, with their third "
+        "decimal rounded half up. Cannot be combined with the `--locale` argument.",
+        action="store",
+        required=False,
+    )
+    parser.add_argument(
+        "-oe",
+        "--on-error",
+        help="What to do with the rows that can't be converted: 'fail' stops on the "
+        "first one (default), 'collect' and 'divert' write them with their row "
+        "number and the reason to a separate file, with '_rejects' added before the "
+        "extension of the detailed output file, while the other rows keep being "
+        "converted. With 'collect', the input file then fails without writing its "
+        "metadata file, once all its rows have been read; with 'divert' its "
+        "conversion succeeds with the rows that could be converted.",
+        action="store",
+        choices=("fail", "collect", "divert"),
+        default="fail",
+        required=False,
+    )
+    parser.add_argument(
+        "-ck",
+        "--checkpoint",
+        help="Save a checkpoint every this number of rows, to a `.checkpoint` file "
+        "next to the detailed output file. When running again after an interruption, "
+        "the conversion resumes from the last checkpoint instead of starting over. "
+        "Cannot be combined with `--chunk-size`, `--max-rows-per-run` or `--output`.",
+        action="store",
+        required=False,
+    )
+    parser.add_argument(
+        "-cc",
+        "--config-cache-dir",
+        help="Directory in which to keep a compiled copy of the configuration file, "
+        "keyed on the content of the configuration file. Subsequent runs with an "
+        "unchanged configuration file don't need to parse the Excel file again.",
+        action="store",
+        required=False,
+    )
+    parser.add_argument(
+        "-w",
+        "--watch",
+        help="Keep running and process the new files appearing in the "
+        "`--input-directory`, once their size and modification time stop changing. "
+        "The next Run ID is saved to the `--run-id-file` after each batch of files. "
+        "The files that can't be converted are reported, and only processed again once "
+        "they change. Stop with Ctrl+C.",
+        action="store_true",
+        required=False,
+    )
+    parser.add_argument(
+        "-wi",
+        "--watch-interval",
+        help="The number of seconds between two scans of the `--input-directory` in "
+        "`--watch` mode (default 5)",
+        action="store",
+        required=False,
+        default=5,
+    )
+    parser.add_argument(
+        "-jl",
+        "--journal",
+        help="Append an entry to this journal file each time an input file has been "
+        "converted. When running again, for instance after an interruption, the input "
+        "files already in the journal are skipped, and the Run IDs continue after the "
+        "highest one in the journal. The detailed output files left without their "
+        "metadata file by an interrupted conversion are removed.",
+        action="store",
+        required=False,
+    )
+    parser.add_argument(
+        "-di",
+        "--dedup-index",
+        help="SQLite database in which to record the hash of the content of the "
+        "converted input files. Before converting, the input files with the same "
+        "content as an already converted file, or as another file of the batch, are "
+        "handled according to the `--on-duplicate` argument.",
+        action="store",
+        required=False,
+    )
+    parser.add_argument(
+        "-du",
+        "--on-duplicate",
+        help="What to do with the input files found to be duplicates with the "
+        "`--dedup-index` argument: 'skip' them (default), or 'flag' them with a "
+        "warning and still convert them.",
+        action="store",
+        choices=["skip", "flag"],
+        required=False,
+        default="skip",
+    )
+    parser.add_argument(
+        "-rp",
+        "--report",
+        help="Write a JSON report to this file once done, with for each run the input "
+        "file, Run ID, number of rows, reported dates, sizes of the input and output "
+        "files, wall and CPU time, rows per second and peak memory usage of the "
+        "process that converted it so far (not of that run alone), and the totals of "
+        "the batch. In `--watch` mode, the report of each batch of files replaces the "
+        "previous one.",
+        action="store",
+        required=False,
+    )
+    parser.add_argument(
+        "-p",
+        "--profile",
+        help="Print the wall time, CPU time and rows per second of each stage of the "
+        "processing once done. When a directory is passed, a cProfile statistics file "
+        "is also saved to that directory for each input file, named after its Run ID "
+        "and file name.",
+        action="store",
+        nargs="?",
+        const="",
+        required=False,
+    )
     parser.add_argument(
         "-txt",
         "--txt-extension",
@@ -246,46 +1063,38 @@ def parse_args(arguments):
         dest="loglevel",
         const=logging.INFO,
     )
-    for arg in parser._actions:
-        if arg.dest == "output":
-            # Remove the --output argument
-            arg.container._remove_action(arg)
-    args = parser.parse_args(arguments)
+    return parser
 
-    # Configure logging level
-    if args.loglevel:
-        logging.basicConfig(level=args.loglevel)
-        args.logging_level = logging.getLevelName(args.loglevel)
 
+def validate_args(args):
     # Validate if the arguments are used correctly
-    if not os.path.isdir(args.output_directory):
-        pathlib.Path(args.output_directory).mkdir(parents=True, exist_ok=True)
+    validate_output(args)
 
     args.application_id = args.application_id.upper()
     m = re.match(r"^[A-Z0-9]{2}$", args.application_id)
     if not m:
-        logging.critical(
+        raise InvalidArgumentError(
             "The `--application-id` argument must be two characters, from 'AA' to "
-            "'99'. Exiting..."
+            "'99'.",
+            212,
         )
-        sys.exit(212)
 
     args.billing_type = args.billing_type.upper()
     if args.billing_type not in ("H", "E", " "):
-        logging.critical(
+        raise InvalidArgumentError(
             "The `--billing-type` argument must be one character, 'H' (internal "
             "billing), 'E' (external billing) or ' ' (both external and internal "
-            "billing, or undetermined). Exiting..."
+            "billing, or undetermined).",
+            217,
         )
-        sys.exit(217)
 
     args.file_version = args.file_version.upper()
     if args.file_version not in ("V1.11",):
-        logging.critical(
+        raise InvalidArgumentError(
             "Incorrect `--file-version` argument value '%s', currently only 'v1.11' is "
-            "supported. Exiting..." % args.file_version
+            "supported." % args.file_version,
+            218,
         )
-        sys.exit(218)
 
     validate_run_id_run_id_file(args)
 
@@ -293,120 +1102,2256 @@ def parse_args(arguments):
         try:
             args.date_report = int(args.date_report)
         except ValueError:
-            logging.critical("The `--date-report` argument must be numeric. Exiting...")
-            sys.exit(221)
+            raise InvalidArgumentError(
+                "The `--date-report` argument must be numeric.", 221
+            )
         if args.date_report < 0 or args.date_report > 99999:
-            logging.critical(
-                "The `--date-report` argument must be comprised between 0 and 99999. "
-                "Exiting..."
+            raise InvalidArgumentError(
+                "The `--date-report` argument must be comprised between 0 and 99999.",
+                222,
             )
-            sys.exit(222)
 
-    delimited2fixedwidth.validate_shared_args(args)
+    validate_jobs(args)
+    validate_chunk_size(args)
+    validate_max_rows_per_run(args)
+    validate_checkpoint(args)
+    validate_decimal_separator(args)
+    validate_on_error(args)
+    validate_watch(args)
+
+    validate_shared_args(args)
+
+
+def parse_args(arguments):
+    args = build_parser().parse_args(arguments)
+
+    # Configure logging level
+    if args.loglevel:
+        logging.basicConfig(level=args.loglevel)
+        args.logging_level = logging.getLevelName(args.loglevel)
+
+    try:
+        validate_args(args)
+    except BillingFlatFileError as e:
+        exit_with_error(e)
 
     logging.debug("These are the parsed arguments:\n'%s'" % args)
     return args
 
 
-def init():
-    if __name__ == "__main__":
-        # Parse the provided command-line arguments
-        args = parse_args(sys.argv[1:])
-
-        input_files = []
-        if args.input:
-            # Just a single input/output files combination
-            input_files = [args.input]
-        elif args.input_directory:
-            # Process all files in that top-level directory (no subdirectories)
-            (_, _, filenames) = next(os.walk(args.input_directory))
-            for ifile in filenames:
-                input_files.append(os.path.join(args.input_directory, ifile))
-        run_id = args.run_id - 1
+def make_args(**options):
+    # The options of the importable API are the long command-line arguments, with
+    # underscores instead of dashes, and take the same values
+    parser = build_parser()
+    defaults = {
+        action.dest: action.default
+        for action in parser._actions
+        if action.dest not in ("help", "version")
+    }
+    unknown_options = set(options) - set(defaults)
+    if unknown_options:
+        raise InvalidArgumentError(
+            "Unknown option(s): '%s'." % "', '".join(sorted(unknown_options)), 233
+        )
+    args = argparse.Namespace(**defaults)
+    for (option, value) in options.items():
+        setattr(args, option, value)
+    required_options = ["application_id", "config"]
+    if not args.output:
+        required_options.append("output_directory")
+    for option in required_options:
+        if getattr(args, option) is None:
+            raise InvalidArgumentError("The `%s` option is required." % option, 234)
+    args.logging_level = logging.getLevelName(args.loglevel)
+    validate_args(args)
+    return args
 
-        for input_file in input_files:
-            logging.info("Processing input file %s", input_file)
-            run_id = int(run_id) + 1
-            if run_id > 9999:
-                logging.critical("The Run ID can't be higher than 9999. Exiting...")
-                sys.exit(223)
-            # Format the run-id numerically with 4 digits
-            run_id = str(run_id).zfill(4)
-            metadata_file_name = os.path.join(
-                args.output_directory, "S%s%sE" % (args.application_id, run_id)
+
+def get_input_files(args):
+    input_files = []
+    if args.input:
+        # Just a single input/output files combination
+        input_files = [args.input]
+    elif args.input_directory:
+        # Process all files in that top-level directory (no subdirectories)
+        (_, _, filenames) = next(os.walk(args.input_directory))
+        for ifile in filenames:
+            input_files.append(os.path.join(args.input_directory, ifile))
+    return input_files
+
+
+def get_output_file_names(args, run_id):
+    if args.output:
+        # The output files have been named explicitly
+        metadata_file_name = args.metadata_output
+        detailed_file_name = args.output
+    else:
+        metadata_file_name = os.path.join(
+            args.output_directory, "S%s%sE" % (args.application_id, run_id)
+        )
+        detailed_file_name = os.path.join(
+            args.output_directory, "S%s%sD" % (args.application_id, run_id)
+        )
+        if args.txt_extension:
+            metadata_file_name += ".txt"
+            detailed_file_name += ".txt"
+    logging.debug("The metadata file will be written to '%s'" % metadata_file_name)
+    logging.debug("The detailed file will be written to '%s'" % detailed_file_name)
+    if args.checkpoint and os.path.isfile(get_checkpoint_file_name(detailed_file_name)):
+        # The output files of an interrupted conversion, which will be resumed
+        return (metadata_file_name, detailed_file_name)
+    if (
+        args.journal
+        and os.path.isfile(detailed_file_name)
+        and not os.path.isfile(metadata_file_name)
+    ):
+        # Left behind by a conversion interrupted before its metadata file got
+        # written: this Run ID is not in the journal, the input file is converted
+        # again
+        remove_interrupted_output_files(detailed_file_name)
+    if os.path.isfile(metadata_file_name) and not args.overwrite_files:
+        raise OutputFileExistsError(
+            "The metadata output file '%s' does already exist, will NOT be "
+            "overwritten. Add the `--overwrite-files` argument to overwrite."
+            % metadata_file_name,
+            219,
+        )
+    if os.path.isfile(detailed_file_name) and not args.overwrite_files:
+        raise OutputFileExistsError(
+            "The detailed output file '%s' does already exist, will NOT be "
+            "overwritten. Add the `--overwrite-files` argument to overwrite."
+            % detailed_file_name,
+            220,
+        )
+    return (metadata_file_name, detailed_file_name)
+
+
+def remove_interrupted_output_files(detailed_file_name):
+    logging.warning(
+        "Removing the detailed output file '%s' of an interrupted conversion"
+        % detailed_file_name
+    )
+    for file_name in (
+        detailed_file_name,
+        get_diverted_file_name(detailed_file_name),
+        get_rejects_file_name(detailed_file_name),
+    ):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(file_name)
+
+
+def format_run_id(run_id):
+    if run_id > 9999:
+        raise RunIdError("The Run ID can't be higher than 9999.", 223)
+    # Format the run-id numerically with 4 digits
+    return str(run_id).zfill(4)
+
+
+def allocate_runs(args, input_files, first_run_id, content_hashes=None):
+    # Hand out the Run IDs and output file names up front, in processing order, so
+    # that the files can then be converted independently of each other
+    content_hashes = content_hashes or {}
+    runs = []
+    for (idx, input_file) in enumerate(input_files):
+        run_id = format_run_id(first_run_id + idx)
+        (metadata_file_name, detailed_file_name) = get_output_file_names(args, run_id)
+        runs.append(
+            (
+                input_file,
+                run_id,
+                metadata_file_name,
+                detailed_file_name,
+                content_hashes.get(input_file),
             )
-            detailed_file_name = os.path.join(
-                args.output_directory, "S%s%sD" % (args.application_id, run_id)
+        )
+    return runs
+
+
+def load_delimited2fixedwidth():
+    # delimited2fixedwidth imports openpyxl, which is slow to import: only pay that
+    # price when a file actually needs to be converted
+    global delimited2fixedwidth
+    import delimited2fixedwidth
+
+
+def load_config(config_file, cache_dir=None):
+    # The compiled configuration is keyed on the content of the workbook, so that an
+    # updated configuration file never gets served from a stale cache entry
+    with open(config_file, "rb") as f:
+        content_hash = hashlib.sha256(f.read()).hexdigest()
+    cache_file = None
+    if cache_dir:
+        cache_file = os.path.join(cache_dir, "%s.json" % content_hash)
+        try:
+            with open(cache_file) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            cached = None
+        if cached and cached.get("version") == CONFIG_CACHE_VERSION:
+            logging.info(
+                "Config '%s' loaded from cache '%s'" % (config_file, cache_file)
+            )
+            return cached["config"]
+
+    load_delimited2fixedwidth()
+    delimited2fixedwidth.define_supported_output_formats()
+    with raising_errors_of_delimited2fixedwidth(
+        ConfigurationError, "Invalid configuration file '%s'." % config_file
+    ):
+        config = delimited2fixedwidth.load_config(config_file)
+
+    if cache_file:
+        pathlib.Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        cached = {"version": CONFIG_CACHE_VERSION, "config": config}
+        # Write to a temporary file first, so that concurrent runs never read a
+        # partially written cache entry
+        temp_cache_file = "%s.%d.tmp" % (cache_file, os.getpid())
+        with open(temp_cache_file, "w") as f:
+            json.dump(cached, f)
+        os.replace(temp_cache_file, cache_file)
+        logging.debug("Config '%s' saved to cache '%s'" % (config_file, cache_file))
+    return config
+
+
+def validate_config_args(args, config):
+    if args.truncate:
+        for t in args.truncate:
+            if t > len(config):
+                raise ConfigurationError(
+                    "The value %d passed in the `--truncate` argument is invalid, it "
+                    "is higher than the %d fields defined in the configuration file. "
+                    % (t, len(config)),
+                    26,
+                )
+    if args.divert:
+        for d in args.divert.keys():
+            if d > len(config):
+                raise ConfigurationError(
+                    "The value %d passed as field ID in the `--divert` argument is "
+                    "invalid, it is higher than the %d fields defined in the "
+                    "configuration file." % (d, len(config)),
+                    30,
+                )
+
+
+def prepare_conversion(args):
+    # By default, set to the user's default locale, used to appropriately handle
+    # Decimal separators. An explicit decimal separator doesn't need the locale.
+    if args.decimal_separator is None:
+        setlocale(LC_NUMERIC, args.locale)
+    load_delimited2fixedwidth()
+    delimited2fixedwidth.define_supported_output_formats()
+
+
+def is_ascii_compatible(encoding):
+    # Byte offsets can only be used to split the input files whose encoding
+    # represents a line break like ASCII does (i.e. not UTF-16 or UTF-32)
+    try:
+        return "\n".encode(encoding) == b"\n"
+    except LookupError:
+        return False
+
+
+def find_footer_start(f, end, skip_footer):
+    # Scan the file backwards until enough line breaks have been found, on a memory
+    # mapping: only the pages of the footer get read, whatever the size of the file.
+    # A line break as very last character of the file doesn't start a new (empty)
+    # line.
+    if end == 0:
+        # Empty files can't be mapped
+        return 0
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+        position = end - 1 if mapped_file[end - 1 : end] == b"\n" else end
+        for _ in range(skip_footer):
+            position = mapped_file.rfind(b"\n", 0, position)
+            if position == -1:
+                return 0
+        return position + 1
+
+
+def find_data_range(input_file, skip_header, skip_footer):
+    # Returns the byte offsets of the rows to convert, between header and footer
+    with open(input_file, "rb") as f:
+        for _ in range(skip_header):
+            if not f.readline():
+                break
+        start = f.tell()
+        end = f.seek(0, os.SEEK_END)
+        if skip_footer:
+            end = find_footer_start(f, end, skip_footer)
+    return (start, max(start, end))
+
+
+def split_data_range(input_file, start, end, chunk_size):
+    # Split the range at line boundaries in chunks of approximately chunk_size bytes
+    chunks = []
+    with open(input_file, "rb") as f:
+        while end - start > chunk_size:
+            f.seek(start + chunk_size - 1)
+            f.readline()
+            boundary = f.tell()
+            if boundary >= end:
+                break
+            chunks.append((start, boundary))
+            start = boundary
+    chunks.append((start, end))
+    return chunks
+
+
+def read_lines(input_file, start, end, encoding, progress=None):
+    # The offset after the last line read is kept up to date in the progress dict
+    with open(input_file, "rb") as f:
+        f.seek(start)
+        position = start
+        for line in f:
+            if position >= end:
+                break
+            position += len(line)
+            if progress is not None:
+                progress["input_offset"] = position
+            yield line.decode(encoding)
+
+
+def get_compression(start):
+    for (magic_bytes, compression) in COMPRESSION_MAGIC_BYTES:
+        if start.startswith(magic_bytes):
+            return compression
+    return None
+
+
+def detect_compression(input_file):
+    if input_file == "-":
+        return None
+    with open(input_file, "rb") as f:
+        return get_compression(f.read(6))
+
+
+def open_compressed_file(input_file, compression):
+    # The input file is either a path or a binary file object. The decompression
+    # modules are only imported when needed.
+    if compression == "gzip":
+        import gzip
+
+        return gzip.open(input_file)
+    if compression == "bz2":
+        import bz2
+
+        return bz2.open(input_file)
+    if compression == "xz":
+        import lzma
+
+        return lzma.open(input_file)
+    try:
+        import zstandard
+    except ImportError:
+        raise InvalidArgumentError(
+            "The input file '%s' is compressed with Zstandard, which requires the "
+            "`zstandard` package to be installed." % input_file,
+            235,
+        )
+    if isinstance(input_file, str):
+        input_file = open(input_file, "rb")
+    reader = zstandard.ZstdDecompressor().stream_reader(input_file, closefd=True)
+    return io.BufferedReader(reader)
+
+
+def open_input_file(input_file, encoding):
+    if input_file == "-":
+        # Not closing the standard input once done
+        binary_file = open(sys.stdin.fileno(), "rb", closefd=False)
+        compression = get_compression(binary_file.peek(6)[:6])
+        if compression:
+            binary_file = open_compressed_file(binary_file, compression)
+        return io.TextIOWrapper(binary_file, encoding=encoding, newline="")
+    compression = detect_compression(input_file)
+    if not compression:
+        return open(input_file, encoding=encoding, newline="")
+    logging.debug("Decompressing %s input file %s" % (compression, input_file))
+    return io.TextIOWrapper(
+        open_compressed_file(input_file, compression), encoding=encoding, newline=""
+    )
+
+
+def read_text_lines(input_file, encoding, skip_header, skip_footer):
+    # Fallback for the standard input, the compressed files and the encodings that
+    # can't be split on byte offsets. The footer is skipped by always keeping
+    # skip_footer lines in reserve.
+    with open_input_file(input_file, encoding) as f:
+        lines = itertools.islice(f, skip_header, None)
+        lookahead = collections.deque()
+        for line in lines:
+            lookahead.append(line)
+            if len(lookahead) > skip_footer:
+                yield lookahead.popleft()
+
+
+def convert_decimal(value, decimal_separator):
+    # Integer-only counterpart of the Decimal conversion of delimited2fixedwidth,
+    # independent of the locale: returns the value in cents, rounded half up (away
+    # from zero). Raises ValueError for the invalid values.
+    value = value.strip()
+    if not value:
+        return "0"
+    sign = value[0] if value[0] in "+-" else ""
+    (units, _, decimals) = value[len(sign) :].partition(decimal_separator)
+    if (
+        not (units or decimals)
+        or not (units or "0").isdecimal()
+        or not (decimals or "0").isdecimal()
+    ):
+        raise ValueError("invalid decimal value '%s'" % value)
+    decimals = decimals.ljust(3, "0")
+    cents = int(units + decimals[:2])
+    if decimals[2] >= "5":
+        cents += 1
+    if sign == "-" and cents:
+        return "-%d" % cents
+    return str(cents)
+
+
+def convert_cell(cell, output_format, idx_col, idx_row, decimal_separator=None):
+    # delimited2fixedwidth.convert_cell, raising a ConversionError for the invalid
+    # values instead of exiting. The Decimal values are converted with the given
+    # decimal separator instead of the locale's, when there is one.
+    if output_format != "Decimal" or decimal_separator is None:
+        with raising_errors_of_delimited2fixedwidth(
+            ConversionError,
+            "Field %d on row %d (ignoring the header) could not be converted to the "
+            "'%s' output format." % (idx_col, idx_row, output_format),
+        ):
+            return delimited2fixedwidth.convert_cell(
+                cell, output_format, idx_col, idx_row
+            )
+    try:
+        return convert_decimal(cell, decimal_separator)
+    except ValueError:
+        # Same message and exit code as delimited2fixedwidth
+        raise ConversionError(
+            "Invalid decimal format '%s' in field %d on row %d (ignoring the header)."
+            % (cell, idx_col, idx_row),
+            19,
+        )
+
+
+def convert_field(cell, field, idx_col, idx_row, truncate, decimal_separator=None):
+    output_format = field["output_format"]
+    length = field["length"]
+    if field["skip_field"]:
+        cell = ""
+    else:
+        cell = convert_cell(cell, output_format, idx_col, idx_row, decimal_separator)
+
+    # Confirm that the length of the field (before padding) is less than the
+    # maximum allowed length
+    if len(cell) > length:
+        if not truncate or idx_col not in truncate:
+            raise ConversionError(
+                "Field %d on row %d (ignoring the header) is too long! Length: %d, "
+                "max length %d." % (idx_col, idx_row, len(cell), length),
+                20,
+            )
+        # Truncate to the defined maximum field length
+        logging.info(
+            "Field %d on row %d (ignoring the header) is too long! Length: %d, max "
+            "length %d. Truncating field to its max length."
+            % (idx_col, idx_row, len(cell), length)
+        )
+        cell = cell[:length]
+
+    return delimited2fixedwidth.pad_output_value(cell, output_format, length)
+
+
+def check_field(cell, field, idx_col, idx_row, truncate, decimal_separator=None):
+    # Same checks as convert_field, without padding the value. Returns the exit code
+    # of the conversion error, None when the value is valid.
+    if field["skip_field"]:
+        return None
+    output_format = field["output_format"]
+    is_date = output_format.startswith("Date (")
+    if is_date or output_format in ("Time", "Decimal", "Keep numeric"):
+        try:
+            cell = convert_cell(
+                cell, output_format, idx_col, idx_row, decimal_separator
+            )
+        except ConversionError as e:
+            return e.exit_code
+    elif output_format == "Integer" and not cell.strip():
+        # convert_cell returns the values of the other output formats unchanged,
+        # except for the empty Integer values
+        cell = "0"
+    if len(cell) > field["length"] and (not truncate or idx_col not in truncate):
+        return 20
+    return None
+
+
+def compile_value_converter(output_format, idx_col, decimal_separator=None):
+    # Returns a function converting a value like delimited2fixedwidth.convert_cell,
+    # but returning None for the invalid values instead of exiting. None for the
+    # output formats that don't need a conversion. The Date and Time values repeat
+    # a lot in an extract, their conversions are cached.
+    if output_format == "Integer":
+        return lambda cell: cell if cell.strip() else "0"
+    if output_format == "Keep numeric":
+        non_numeric = re.compile(r"\D")
+        return lambda cell: non_numeric.sub("", cell) or "0"
+    if output_format == "Time":
+        time_pattern = re.compile(r"(\d{2})(:)?(\d{2})")
+
+        @functools.lru_cache(maxsize=CONVERSION_CACHE_SIZE)
+        def convert_time(cell):
+            m = time_pattern.match(cell)
+            return "%s%s" % (m.group(1), m.group(3)) if m else None
+
+        return convert_time
+    if output_format == "Decimal":
+
+        def convert_decimal_value(cell):
+            try:
+                if decimal_separator is not None:
+                    return convert_decimal(cell, decimal_separator)
+                return str(int(round(float(atof(cell if cell.strip() else "0")) * 100)))
+            except ValueError:
+                return None
+
+        return convert_decimal_value
+    if output_format.startswith("Date ("):
+
+        @functools.lru_cache(maxsize=CONVERSION_CACHE_SIZE)
+        def convert_date(cell):
+            try:
+                # The invalid values are converted again by convert_field, which
+                # reports them with their row number
+                with raising_errors_of_delimited2fixedwidth(ConversionError, ""):
+                    return delimited2fixedwidth.convert_date(
+                        cell, output_format, idx_col, 0
+                    )
+            except ConversionError:
+                return None
+
+        return convert_date
+    return None
+
+
+def compile_field_converter(
+    field, idx_col, truncate, caches=None, decimal_separator=None
+):
+    # Returns a function converting and padding a value of this field, like
+    # convert_field but with the output format and length resolved once. The values
+    # it doesn't handle itself (invalid or too long) go through convert_field, which
+    # raises or truncates them exactly as before.
+    output_format = field["output_format"]
+    length = field["length"]
+    if field["skip_field"]:
+        padding = delimited2fixedwidth.pad_output_value("", output_format, length)
+        return lambda cell, idx_row: padding
+
+    def fallback(cell, idx_row):
+        return convert_field(cell, field, idx_col, idx_row, truncate, decimal_separator)
+
+    if output_format == "Text":
+        # Strings get padded with spaces added to the right
+        def convert_text(cell, idx_row):
+            if len(cell) > length:
+                return fallback(cell, idx_row)
+            return cell.ljust(length)
+
+        return convert_text
+    convert = compile_value_converter(output_format, idx_col, decimal_separator)
+    if not convert:
+        return fallback
+    if caches is not None and hasattr(convert, "cache_info"):
+        caches[idx_col] = convert
+
+    # Numbers get padded with 0's added in front (to the left)
+    def convert_numeric(cell, idx_row):
+        value = convert(cell)
+        if value is None or len(value) > length:
+            return fallback(cell, idx_row)
+        return value.zfill(length)
+
+    return convert_numeric
+
+
+def compile_field_checker(field, idx_col, truncate, decimal_separator=None):
+    # Returns a function doing the checks of check_field on a value of this field,
+    # with the compiled (and cached) conversions of compile_value_converter. The
+    # values these conversions reject go through check_field, for their exact exit
+    # code.
+    if field["skip_field"]:
+        return lambda cell, idx_row: None
+    output_format = field["output_format"]
+    # The values of the truncated fields are never too long
+    length = field["length"] if not truncate or idx_col not in truncate else None
+
+    def is_too_long(value):
+        return length is not None and len(value) > length
+
+    def fallback(cell, idx_row):
+        return check_field(cell, field, idx_col, idx_row, truncate, decimal_separator)
+
+    if output_format == "Text":
+        return lambda cell, idx_row: 20 if is_too_long(cell) else None
+    convert = compile_value_converter(output_format, idx_col, decimal_separator)
+    if not convert:
+        return fallback
+
+    def check_value(cell, idx_row):
+        value = convert(cell)
+        if value is None:
+            return fallback(cell, idx_row)
+        return 20 if is_too_long(value) else None
+
+    return check_value
+
+
+def compile_row_converter(
+    config,
+    date_field_to_report_on,
+    truncate,
+    divert,
+    caches=None,
+    decimal_separator=None,
+):
+    # Returns a function converting a row, with everything that only depends on the
+    # configuration and the arguments resolved once: the per-row work is one call
+    # per field. The function takes the row and its 1-based number, and returns the
+    # converted row, whether it must be diverted and the date to report on
+    # (date_field_to_report_on is 0-based). The cached conversions of the fields are
+    # added to caches, by field number.
+    converters = [
+        compile_field_converter(field, idx_col, truncate, caches, decimal_separator)
+        for (idx_col, field) in enumerate(config, 1)
+    ]
+    num_fields = len(config)
+    # Fields not in the input content but defined in the configuration file: empty
+    # padding, based on the defined output format
+    paddings = [
+        delimited2fixedwidth.pad_output_value(
+            "", field["output_format"], field["length"]
+        )
+        for field in config
+    ]
+    missing_fields = [
+        "".join(paddings[num_row_fields:]) for num_row_fields in range(num_fields + 1)
+    ]
+    divert_fields = [
+        (idx_col - 1, values) for (idx_col, values) in (divert or {}).items()
+    ]
+    report_field = date_field_to_report_on or None
+
+    def convert_row(row, idx_row):
+        num_row_fields = len(row)
+        # Confirm that the row doesn't have more fields than are defined in the
+        # configuration file
+        if num_row_fields > num_fields:
+            raise ConversionError(
+                "Row %d (ignoring the header) has more fields than are defined in the "
+                "configuration file! The row has %d fields while the configuration "
+                "defines only %d possible fields."
+                % (idx_row, num_row_fields, num_fields),
+                23,
             )
-            if args.txt_extension:
-                metadata_file_name += ".txt"
-                detailed_file_name += ".txt"
-            logging.debug(
-                "The metadata file will be written to '%s'" % metadata_file_name
+        converted_row_content = [
+            converter(cell, idx_row) for (converter, cell) in zip(converters, row)
+        ]
+        report_date = None
+        if report_field is not None and report_field < num_row_fields:
+            report_date = converted_row_content[report_field]
+        # The content for the entire row will be diverted to a separate file if one
+        # of its fields contains a value marked for content diversion
+        divert_row = any(
+            idx_col < num_row_fields and row[idx_col] in values
+            for (idx_col, values) in divert_fields
+        )
+        converted_row_content.append(missing_fields[num_row_fields])
+        return ("".join(converted_row_content), divert_row, report_date)
+
+    return convert_row
+
+
+def convert_rows(
+    rows,
+    config,
+    date_field_to_report_on=None,
+    truncate=None,
+    divert=None,
+    first_row=0,
+    reject_row=None,
+    decimal_separator=None,
+):
+    # Streaming counterpart of delimited2fixedwidth.convert_content: yields every
+    # converted row, whether it must be diverted and the date to report on. With
+    # reject_row, the rows that can't be converted are passed to it (with their
+    # 1-based row number and the ConversionError) instead of stopping the conversion.
+    if date_field_to_report_on:
+        # Argument is 1-based
+        date_field_to_report_on -= 1
+    caches = {}
+    convert_row = compile_row_converter(
+        config, date_field_to_report_on, truncate, divert, caches, decimal_separator
+    )
+    for idx_row, row in enumerate(rows, first_row + 1):
+        try:
+            converted_row = convert_row(row, idx_row)
+        except ConversionError as e:
+            if reject_row is None:
+                raise
+            reject_row(idx_row, e, row)
+            continue
+        yield converted_row
+    for (idx_col, cache) in sorted(caches.items()):
+        cache_info = cache.cache_info()
+        logging.info(
+            "Field %d conversion cache: %d hits, %d misses"
+            % (idx_col, cache_info.hits, cache_info.misses)
+        )
+
+
+def iterate_in_background(iterable, batch_size=PIPELINE_BATCH_SIZE):
+    # A background thread consumes the iterable (e.g. reads the input file) while
+    # the items already handed over are processed, in batches passed through a
+    # bounded queue. The exceptions are raised again in the consuming thread.
+    iterator = iter(iterable)
+    batches = queue.Queue(PIPELINE_QUEUE_SIZE)
+    stopped = threading.Event()
+
+    def put(item):
+        # Give up when the consumer stopped iterating
+        while not stopped.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def produce():
+        batch = []
+        try:
+            for item in iterator:
+                batch.append(item)
+                if len(batch) == batch_size:
+                    put((batch, None))
+                    batch = []
+                    if stopped.is_set():
+                        return
+            if batch:
+                put((batch, None))
+            put(([], None))
+        except BaseException as e:
+            # The items before the exception are processed first, as in a serial run
+            put((batch, e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            (batch, error) = batches.get()
+            yield from batch
+            if error:
+                raise error
+            if not batch:
+                break
+    finally:
+        stopped.set()
+        thread.join()
+        if hasattr(iterator, "close"):
+            iterator.close()
+
+
+@contextlib.contextmanager
+def write_in_background(f, buffer_size=PIPELINE_BUFFER_SIZE):
+    # Yields a write function collecting the written strings in large buffers, which
+    # a background thread writes to f through a bounded queue. The exceptions are
+    # raised again in the writing thread.
+    buffers = queue.Queue(PIPELINE_QUEUE_SIZE)
+    errors = []
+
+    def consume():
+        for buffer in iter(buffers.get, None):
+            if not errors:
+                try:
+                    f.write(buffer)
+                except BaseException as e:
+                    errors.append(e)
+
+    pending = []
+    pending_size = 0
+
+    def write(content):
+        nonlocal pending_size
+        pending.append(content)
+        pending_size += len(content)
+        if pending_size >= buffer_size:
+            if errors:
+                raise errors[0]
+            buffers.put("".join(pending))
+            pending.clear()
+            pending_size = 0
+
+    thread = threading.Thread(target=consume, daemon=True)
+    thread.start()
+    try:
+        yield write
+        buffers.put("".join(pending))
+    finally:
+        buffers.put(None)
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def prefetch_file(input_file):
+    # Read the next input file in a background thread, so that it is already in the
+    # page cache once the current input file has been converted
+    def read():
+        try:
+            with open(input_file, "rb") as f:
+                while f.read(PREFETCH_BLOCK_SIZE):
+                    pass
+        except OSError:
+            # Not prefetched, it will just be read when converted
+            pass
+
+    if input_file != "-":
+        threading.Thread(target=read, daemon=True).start()
+
+
+def sync_file(f):
+    # Make sure that the content written so far survives a crash
+    f.flush()
+    os.fsync(f.fileno())
+    return f.buffer.tell()
+
+
+def write_rows(
+    converted_rows,
+    output_file,
+    diverted_output_file,
+    checkpoint=None,
+    save_checkpoint=None,
+    pipeline=False,
+):
+    # Like delimited2fixedwidth.write_output_file, the rows are separated by line
+    # breaks, without a line break after the last row.
+    # When resuming from a checkpoint, the output files are truncated to their size
+    # at that checkpoint, and save_checkpoint is called every checkpoint["interval"]
+    # rows with the updated checkpoint.
+    # With pipeline, the detailed output file is written by a background thread.
+    # The rows are written to the detailed output file in batches of
+    # WRITE_BATCH_SIZE rows, always complete before a checkpoint is saved.
+    checkpoint = checkpoint or {
+        "rows": 0,
+        "oldest_date": "99999999",
+        "most_recent_date": "00000000",
+        "output_offset": 0,
+        "diverted_offset": 0,
+    }
+    num_rows = checkpoint["rows"]
+    oldest_date = checkpoint["oldest_date"]
+    most_recent_date = checkpoint["most_recent_date"]
+    mode = "w"
+    if checkpoint["output_offset"]:
+        os.truncate(output_file, checkpoint["output_offset"])
+        mode = "a"
+    diverted_mode = "w"
+    if checkpoint["diverted_offset"]:
+        os.truncate(diverted_output_file, checkpoint["diverted_offset"])
+        diverted_mode = "a"
+    diverted_file = None
+    try:
+        with contextlib.ExitStack() as stack:
+            ofile = stack.enter_context(open_output_file(output_file, mode))
+            write = ofile.write
+            if pipeline:
+                write = stack.enter_context(write_in_background(ofile))
+            separator = "\n" if checkpoint["output_offset"] else ""
+            diverted_separator = "\n" if checkpoint["diverted_offset"] else ""
+            batch = []
+            while True:
+                rows = converted_rows
+                if save_checkpoint:
+                    rows = itertools.islice(converted_rows, checkpoint["interval"])
+                previous_num_rows = num_rows
+                for (converted_row, divert_row, report_date) in rows:
+                    num_rows += 1
+                    if report_date is not None:
+                        oldest_date = min(oldest_date, report_date)
+                        most_recent_date = max(most_recent_date, report_date)
+                    if divert_row:
+                        if not diverted_file:
+                            diverted_file = open(diverted_output_file, diverted_mode)
+                        diverted_file.write(diverted_separator + converted_row)
+                        diverted_separator = "\n"
+                    else:
+                        batch.append(converted_row)
+                        if len(batch) == WRITE_BATCH_SIZE:
+                            write(separator + "\n".join(batch))
+                            separator = "\n"
+                            batch = []
+                if batch:
+                    write(separator + "\n".join(batch))
+                    separator = "\n"
+                    batch = []
+                if not save_checkpoint or num_rows == previous_num_rows:
+                    break
+                checkpoint["rows"] = num_rows
+                checkpoint["oldest_date"] = oldest_date
+                checkpoint["most_recent_date"] = most_recent_date
+                checkpoint["output_offset"] = sync_file(ofile)
+                if diverted_file:
+                    checkpoint["diverted_offset"] = sync_file(diverted_file)
+                save_checkpoint(checkpoint)
+    finally:
+        if diverted_file:
+            diverted_file.close()
+    return (num_rows, oldest_date, most_recent_date)
+
+
+def convert_lines(args, config, lines, output_file, diverted_output_file, rejects=None):
+    if args.pipeline:
+        lines = iterate_in_background(lines)
+    rows = csv.reader(lines, delimiter=args.delimiter, quotechar=args.quotechar)
+    with rejecting_rows(args, rejects) as reject:
+        converted_rows = convert_rows(
+            rows,
+            config,
+            args.date_report,
+            args.truncate,
+            args.divert,
+            reject_row=reject,
+            decimal_separator=args.decimal_separator,
+        )
+        return write_rows(
+            converted_rows, output_file, diverted_output_file, pipeline=args.pipeline
+        )
+
+
+def convert_chunk(
+    args, config, input_file, start, end, output_file, diverted_output_file
+):
+    prepare_conversion(args)
+    logging.debug("Converting bytes %d to %d of '%s'" % (start, end, input_file))
+    lines = read_lines(input_file, start, end, args.input_encoding)
+    return convert_lines(args, config, lines, output_file, diverted_output_file)
+
+
+def join_part_files(part_files, output_file):
+    # Each part has been written like a complete output file, without a line break
+    # after its last row
+    with open(output_file, "wb") as ofile:
+        separator = b""
+        for part_file in part_files:
+            if os.path.getsize(part_file):
+                ofile.write(separator)
+                with open(part_file, "rb") as pfile:
+                    shutil.copyfileobj(pfile, ofile)
+                separator = b"\n"
+            os.remove(part_file)
+
+
+def convert_chunks_in_parallel(
+    args, config, input_file, chunks, detailed_file_name, diverted_file_name, executor
+):
+    import concurrent.futures
+
+    logging.info("Converting input file %s in %d chunks" % (input_file, len(chunks)))
+    part_files = [
+        (
+            "%s.part%d" % (detailed_file_name, idx),
+            "%s.part%d" % (diverted_file_name, idx),
+        )
+        for idx in range(len(chunks))
+    ]
+    futures = [
+        executor.submit(
+            run_in_worker,
+            args.loglevel,
+            convert_chunk,
+            args,
+            config,
+            input_file,
+            start,
+            end,
+            *parts
+        )
+        for ((start, end), parts) in zip(chunks, part_files)
+    ]
+    try:
+        results = [future.result() for future in futures]
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        concurrent.futures.wait(futures)
+        for part_file in itertools.chain.from_iterable(part_files):
+            if os.path.isfile(part_file):
+                os.remove(part_file)
+        raise
+
+    join_part_files([parts[0] for parts in part_files], detailed_file_name)
+    diverted_part_files = [parts[1] for parts in part_files if os.path.isfile(parts[1])]
+    if diverted_part_files:
+        join_part_files(diverted_part_files, diverted_file_name)
+
+    num_input_rows = sum(result[0] for result in results)
+    oldest_date = min(result[1] for result in results)
+    most_recent_date = max(result[2] for result in results)
+    return (num_input_rows, oldest_date, most_recent_date)
+
+
+def can_seek_input_file(args, input_file):
+    # Byte offsets can only be used on uncompressed files, in an encoding that
+    # represents a line break like ASCII does
+    return (
+        input_file != "-"
+        and is_ascii_compatible(args.input_encoding)
+        and not detect_compression(input_file)
+    )
+
+
+def read_input_lines(args, input_file):
+    if not can_seek_input_file(args, input_file):
+        return read_text_lines(
+            input_file, args.input_encoding, args.skip_header, args.skip_footer
+        )
+    (start, end) = find_data_range(input_file, args.skip_header, args.skip_footer)
+    return read_lines(input_file, start, end, args.input_encoding)
+
+
+def get_diverted_file_name(detailed_file_name):
+    # The diverted content is saved to its separate file with "_diverted" added
+    # before the extension
+    return "%s_diverted%s" % (os.path.splitext(detailed_file_name))
+
+
+@contextlib.contextmanager
+def removing_output_files_on_error(detailed_file_name):
+    # A failed conversion must not leave a partial detailed output file behind, the
+    # next run would stop on it. Only the output files of a conversion that resumes
+    # from its checkpoint are kept.
+    try:
+        yield
+    except BaseException:
+        if not is_output_stream(detailed_file_name) and not os.path.isfile(
+            get_checkpoint_file_name(detailed_file_name)
+        ):
+            for file_name in (
+                detailed_file_name,
+                get_diverted_file_name(detailed_file_name),
+            ):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(file_name)
+        raise
+
+
+def get_rejects_file_name(detailed_file_name):
+    # The rows that could not be converted are saved to their separate file with
+    # "_rejects" added before the extension
+    return "%s_rejects%s" % (os.path.splitext(detailed_file_name))
+
+
+def make_rejects(args):
+    # Where to write the rejected rows of an input file, None when the conversion
+    # must stop on the first row that can't be converted
+    if args.on_error == "fail":
+        return None
+    return {"file_name": None, "file": None, "writer": None, "rows": 0, "files": []}
+
+
+def start_rejects_file(rejects, detailed_file_name):
+    # The next rejected rows go to the rejects file of this detailed output file
+    if not rejects:
+        return
+    close_rejects_file(rejects)
+    rejects["file_name"] = get_rejects_file_name(detailed_file_name)
+    # Not left over from a previous conversion
+    if os.path.isfile(rejects["file_name"]):
+        os.remove(rejects["file_name"])
+
+
+def close_rejects_file(rejects):
+    if rejects["file"]:
+        rejects["file"].close()
+        rejects["file"] = None
+
+
+def reject_row(args, rejects, idx_row, error, row):
+    # The row number and reason, followed by the fields of the rejected row
+    if rejects["file"] is None:
+        rejects["file"] = open(
+            rejects["file_name"], "w", encoding=args.input_encoding, newline=""
+        )
+        rejects["writer"] = csv.writer(
+            rejects["file"],
+            delimiter=args.delimiter,
+            quotechar=args.quotechar,
+            lineterminator="\n",
+        )
+        rejects["files"].append(rejects["file_name"])
+    rejects["writer"].writerow([idx_row, error.message] + row)
+    rejects["rows"] += 1
+
+
+def check_rejected_rows(args, rejects, input_file):
+    if not rejects or not rejects["rows"]:
+        return
+    message = "%d rows of input file %s could not be converted, see %s" % (
+        rejects["rows"],
+        input_file,
+        ", ".join(rejects["files"]),
+    )
+    if args.on_error == "collect":
+        raise ConversionError("%s." % message, 250)
+    logging.warning(message)
+
+
+@contextlib.contextmanager
+def rejecting_rows(args, rejects):
+    # Yields the reject_row function for convert_rows, None to stop on the first row
+    # that can't be converted
+    if not rejects:
+        yield None
+        return
+    try:
+        yield lambda idx_row, error, row: reject_row(args, rejects, idx_row, error, row)
+    finally:
+        close_rejects_file(rejects)
+
+
+def get_checkpoint_file_name(detailed_file_name):
+    return "%s.checkpoint" % detailed_file_name
+
+
+def get_input_file_state(input_file):
+    # Identifies the input file a checkpoint has been saved for
+    stat = os.stat(input_file)
+    return [os.path.abspath(input_file), stat.st_size, stat.st_mtime_ns]
+
+
+def load_checkpoint(checkpoint_file_name, input_file):
+    try:
+        with open(checkpoint_file_name) as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if checkpoint.get("version") != CHECKPOINT_VERSION or checkpoint.get(
+        "input_file"
+    ) != get_input_file_state(input_file):
+        logging.warning(
+            "Ignoring checkpoint '%s', saved for another input file"
+            % checkpoint_file_name
+        )
+        return None
+    return checkpoint
+
+
+def save_checkpoint_file(checkpoint_file_name, checkpoint):
+    # Replace the previous checkpoint atomically, a crash must never leave a
+    # partially written checkpoint behind
+    save_file_atomically(json.dumps(checkpoint), checkpoint_file_name)
+
+
+def remove_checkpoint_file(detailed_file_name):
+    # The conversion is complete, the metadata file has been written
+    checkpoint_file_name = get_checkpoint_file_name(detailed_file_name)
+    if os.path.isfile(checkpoint_file_name):
+        os.remove(checkpoint_file_name)
+
+
+def convert_file_with_checkpoints(
+    args, config, input_file, detailed_file_name, diverted_file_name
+):
+    checkpoint_file_name = get_checkpoint_file_name(detailed_file_name)
+    (start, end) = find_data_range(input_file, args.skip_header, args.skip_footer)
+    checkpoint = load_checkpoint(checkpoint_file_name, input_file)
+    if checkpoint:
+        logging.info(
+            "Resuming the conversion of %s after %d rows"
+            % (input_file, checkpoint["rows"])
+        )
+        start = checkpoint["input_offset"]
+    else:
+        checkpoint = {
+            "version": CHECKPOINT_VERSION,
+            "input_file": get_input_file_state(input_file),
+            "input_offset": start,
+            "rows": 0,
+            "oldest_date": "99999999",
+            "most_recent_date": "00000000",
+            "output_offset": 0,
+            "diverted_offset": 0,
+        }
+    checkpoint["interval"] = args.checkpoint
+    progress = {"input_offset": start}
+
+    def save_checkpoint(checkpoint):
+        checkpoint["input_offset"] = progress["input_offset"]
+        save_checkpoint_file(checkpoint_file_name, checkpoint)
+        logging.debug("Checkpoint saved after %d rows" % checkpoint["rows"])
+
+    prepare_conversion(args)
+    lines = read_lines(input_file, start, end, args.input_encoding, progress)
+    rows = csv.reader(lines, delimiter=args.delimiter, quotechar=args.quotechar)
+    converted_rows = convert_rows(
+        rows,
+        config,
+        args.date_report,
+        args.truncate,
+        args.divert,
+        checkpoint["rows"],
+        decimal_separator=args.decimal_separator,
+    )
+    return write_rows(
+        converted_rows,
+        detailed_file_name,
+        diverted_file_name,
+        checkpoint,
+        save_checkpoint,
+    )
+
+
+def convert_file(
+    args, config, input_file, detailed_file_name, executor=None, rejects=None
+):
+    diverted_file_name = get_diverted_file_name(detailed_file_name)
+    chunks = []
+    if (
+        args.chunk_size
+        and executor
+        and can_seek_input_file(args, input_file)
+        and not is_output_stream(detailed_file_name)
+    ):
+        (start, end) = find_data_range(input_file, args.skip_header, args.skip_footer)
+        chunks = split_data_range(input_file, start, end, args.chunk_size)
+    if len(chunks) > 1:
+        return convert_chunks_in_parallel(
+            args,
+            config,
+            input_file,
+            chunks,
+            detailed_file_name,
+            diverted_file_name,
+            executor,
+        )
+    if args.checkpoint:
+        if can_seek_input_file(args, input_file):
+            return convert_file_with_checkpoints(
+                args, config, input_file, detailed_file_name, diverted_file_name
             )
-            logging.debug(
-                "The detailed file will be written to '%s'" % detailed_file_name
+        logging.warning(
+            "No checkpoints can be saved for input file %s, it can't be read from "
+            "a byte offset" % input_file
+        )
+    prepare_conversion(args)
+    lines = read_input_lines(args, input_file)
+    return convert_lines(
+        args, config, lines, detailed_file_name, diverted_file_name, rejects
+    )
+
+
+def write_metadata_file(
+    args, metadata_file_name, run_id, num_input_rows, oldest_date, most_recent_date
+):
+    logging.info(
+        "Processed %d rows, oldest date %s, most recent date %s"
+        % (num_input_rows, oldest_date, most_recent_date)
+    )
+    # Generate the second file containing the metadata
+    output = generate_metadata_file(
+        args.application_id,
+        args.run_description,
+        oldest_date,
+        most_recent_date,
+        args.billing_type,
+        num_input_rows,
+        run_id,
+        args.file_version,
+    )
+    save_file(output, metadata_file_name)
+
+
+def get_input_file_size(input_file):
+    # The size of the standard input is not known
+    if input_file == "-":
+        return None
+    return os.path.getsize(input_file)
+
+
+def get_peak_rss():
+    # Peak resident set size of the current process in bytes, None when it can't be
+    # measured on this platform
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # In kilobytes, except on macOS where it is in bytes
+    if sys.platform != "darwin":
+        peak_rss *= 1024
+    return peak_rss
+
+
+def make_run_result(
+    input_file,
+    input_bytes,
+    run_id,
+    metadata_file_name,
+    detailed_file_name,
+    conversion_result,
+    timings,
+):
+    (num_input_rows, oldest_date, most_recent_date) = conversion_result
+    diverted_file_name = get_diverted_file_name(detailed_file_name)
+    if not os.path.isfile(diverted_file_name):
+        diverted_file_name = None
+    rejects_file_name = get_rejects_file_name(detailed_file_name)
+    if not os.path.isfile(rejects_file_name):
+        rejects_file_name = None
+    return RunResult(
+        input_file,
+        input_bytes,
+        run_id,
+        num_input_rows,
+        oldest_date,
+        most_recent_date,
+        metadata_file_name,
+        detailed_file_name,
+        diverted_file_name,
+        rejects_file_name,
+        timings,
+        get_peak_rss(),
+    )
+
+
+@contextlib.contextmanager
+def stage_timer(timings, stage):
+    # Record the wall and CPU time spent in a stage of the processing
+    wall_time = time.perf_counter()
+    cpu_time = time.process_time()
+    yield
+    timings[stage] = {
+        "wall": time.perf_counter() - wall_time,
+        "cpu": time.process_time() - cpu_time,
+    }
+
+
+def start_profiler(args):
+    if not args.profile:
+        return None
+    import cProfile
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def save_profile(args, profiler, input_file, run_id):
+    # One statistics file per input file, to be analyzed with the pstats module
+    if not profiler:
+        return
+    profiler.disable()
+    pathlib.Path(args.profile).mkdir(parents=True, exist_ok=True)
+    stats_file = os.path.join(
+        args.profile, "%s_%s.pstats" % (run_id, os.path.basename(input_file))
+    )
+    profiler.dump_stats(stats_file)
+    logging.info("Profile of input file %s saved to %s" % (input_file, stats_file))
+
+
+def get_journal_key(args, input_file):
+    # The input files are identified by their path, size and modification time
+    if not args.journal or input_file == "-":
+        return None
+    return tuple(get_input_file_state(input_file))
+
+
+def append_journal_entry(args, journal_key, runs):
+    # One line per completed input file, written with a single append so that
+    # concurrent workers never interleave their entries
+    if not journal_key:
+        return
+    (input_file, size, mtime_ns) = journal_key
+    entry = {
+        "input_file": input_file,
+        "size": size,
+        "mtime_ns": mtime_ns,
+        "runs": [
+            {
+                "run_id": run_id,
+                "metadata_file": metadata_file_name,
+                "detailed_file": detailed_file_name,
+            }
+            for (run_id, metadata_file_name, detailed_file_name) in runs
+        ],
+    }
+    fd = os.open(args.journal, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+    try:
+        os.write(fd, (json.dumps(entry) + "\n").encode("utf-8"))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def load_journal(journal_file_name):
+    # Returns the keys of the completed input files, and the Run ID following the
+    # highest one in the journal
+    completed = set()
+    next_run_id = 0
+    if not os.path.isfile(journal_file_name):
+        return (completed, next_run_id)
+    with open(journal_file_name, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Partially written entry of an interrupted run
+                continue
+            completed.add((entry["input_file"], entry["size"], entry["mtime_ns"]))
+            for run in entry["runs"]:
+                next_run_id = max(next_run_id, int(run["run_id"]) + 1)
+    return (completed, next_run_id)
+
+
+def skip_journaled_files(args, input_files, run_id):
+    (completed, next_run_id) = load_journal(args.journal)
+    remaining_files = []
+    for input_file in input_files:
+        if get_journal_key(args, input_file) in completed:
+            logging.info("Skipping input file %s, already converted" % input_file)
+        else:
+            remaining_files.append(input_file)
+    # Don't reuse the Run IDs of the completed files, even if the next Run ID
+    # couldn't be saved before the previous run got interrupted
+    return (remaining_files, max(run_id, next_run_id))
+
+
+def hash_file(input_file):
+    # Streamed in blocks, to not load the whole input file in memory
+    content_hash = hashlib.sha256()
+    with open(input_file, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            content_hash.update(block)
+    return content_hash.hexdigest()
+
+
+def open_dedup_index(dedup_index_file_name):
+    import sqlite3
+
+    # Wait for the other processes writing to the index instead of failing
+    connection = sqlite3.connect(dedup_index_file_name, timeout=60)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS processed_inputs ("
+        "content_hash TEXT PRIMARY KEY, input_file TEXT, size INTEGER, "
+        "run_ids TEXT, processed_at TEXT)"
+    )
+    return connection
+
+
+def record_content_hash(args, content_hash, input_file, run_ids):
+    if not content_hash:
+        return
+    connection = open_dedup_index(args.dedup_index)
+    try:
+        with connection:
+            connection.execute(
+                "INSERT OR IGNORE INTO processed_inputs VALUES "
+                "(?, ?, ?, ?, datetime('now'))",
+                (
+                    content_hash,
+                    os.path.abspath(input_file),
+                    os.path.getsize(input_file),
+                    ",".join(run_ids),
+                ),
             )
-            if os.path.isfile(metadata_file_name) and not args.overwrite_files:
-                logging.critical(
-                    "The metadata output file '%s' does already exist, will NOT be "
-                    "overwritten. Add the `--overwrite-files` argument to overwrite. "
-                    "Exiting..." % metadata_file_name
+    finally:
+        connection.close()
+
+
+def skip_duplicate_files(args, input_files):
+    # Hash the input files before converting them, to skip (or flag) the ones with
+    # the same content as an already processed file, or as a previous file of this
+    # batch. Returns the files to convert, and the hash of their content.
+    remaining_files = []
+    content_hashes = {}
+    batch_files = {}
+    connection = open_dedup_index(args.dedup_index)
+    try:
+        for input_file in input_files:
+            if input_file == "-":
+                remaining_files.append(input_file)
+                continue
+            content_hash = hash_file(input_file)
+            row = connection.execute(
+                "SELECT input_file, run_ids FROM processed_inputs "
+                "WHERE content_hash = ?",
+                (content_hash,),
+            ).fetchone()
+            duplicate_of = None
+            if row:
+                duplicate_of = "%s (Run ID %s)" % row
+            elif content_hash in batch_files:
+                duplicate_of = batch_files[content_hash]
+            if duplicate_of and args.on_duplicate == "skip":
+                logging.warning(
+                    "Skipping input file %s, it has the same content as %s"
+                    % (input_file, duplicate_of)
                 )
-                sys.exit(219)
-            if os.path.isfile(detailed_file_name) and not args.overwrite_files:
-                logging.critical(
-                    "The detailed output file '%s' does already exist, will NOT be "
-                    "overwritten. Add the `--overwrite-files` argument to overwrite. "
-                    "Exiting..." % detailed_file_name
+                continue
+            if duplicate_of:
+                logging.warning(
+                    "Input file %s has the same content as %s"
+                    % (input_file, duplicate_of)
                 )
-                sys.exit(220)
+            batch_files.setdefault(content_hash, input_file)
+            content_hashes[input_file] = content_hash
+            remaining_files.append(input_file)
+    finally:
+        connection.close()
+    return (remaining_files, content_hashes)
 
-            # Run the delimited2fixedwidth main process
-            # Generates the main file with the detailed transactions
-            (
-                num_input_rows,
-                oldest_date,
-                most_recent_date,
-            ) = delimited2fixedwidth.process(
-                input_file,
-                detailed_file_name,
-                args.config,
-                args.delimiter,
-                args.quotechar,
-                args.skip_header,
-                args.skip_footer,
-                args.date_report,
-                args.locale,
-                args.truncate,
-                args.divert,
-                args.input_encoding,
+
+def process_run(
+    args,
+    config,
+    input_file,
+    run_id,
+    metadata_file_name,
+    detailed_file_name,
+    content_hash=None,
+    executor=None,
+):
+    logging.info("Processing input file %s", input_file)
+    profiler = start_profiler(args)
+    input_bytes = get_input_file_size(input_file)
+    journal_key = get_journal_key(args, input_file)
+    rejects = make_rejects(args)
+    start_rejects_file(rejects, detailed_file_name)
+    timings = {}
+    with stage_timer(timings, "total"):
+        # Generates the main file with the detailed transactions
+        with removing_output_files_on_error(detailed_file_name):
+            with stage_timer(timings, "conversion"):
+                conversion_result = convert_file(
+                    args, config, input_file, detailed_file_name, executor, rejects
+                )
+            check_rejected_rows(args, rejects, input_file)
+        with stage_timer(timings, "metadata"):
+            write_metadata_file(args, metadata_file_name, run_id, *conversion_result)
+        append_journal_entry(
+            args, journal_key, [(run_id, metadata_file_name, detailed_file_name)]
+        )
+        record_content_hash(args, content_hash, input_file, [run_id])
+        if args.checkpoint:
+            remove_checkpoint_file(detailed_file_name)
+        if args.move_input_files:
+            with stage_timer(timings, "move"):
+                shutil.move(input_file, args.output_directory)
+    logging.info("Metadata file written, end processing file %s" % input_file)
+    save_profile(args, profiler, input_file, run_id)
+    return make_run_result(
+        input_file,
+        input_bytes,
+        run_id,
+        metadata_file_name,
+        detailed_file_name,
+        conversion_result,
+        timings,
+    )
+
+
+def process_file_in_runs(args, config, input_file, lease, content_hash=None):
+    # Stream the input file once, starting a new run (with the next Run ID) each
+    # time the maximum number of rows per run is reached. Returns the results of
+    # these runs.
+    logging.info("Processing input file %s", input_file)
+    profiler = start_profiler(args)
+    first_run_id = None
+    input_bytes = get_input_file_size(input_file)
+    journal_key = get_journal_key(args, input_file)
+    prepare_conversion(args)
+    lines = read_input_lines(args, input_file)
+    if args.pipeline:
+        lines = iterate_in_background(lines)
+    rows = csv.reader(lines, delimiter=args.delimiter, quotechar=args.quotechar)
+    rejects = make_rejects(args)
+    with rejecting_rows(args, rejects) as reject:
+        converted_rows = convert_rows(
+            rows,
+            config,
+            args.date_report,
+            args.truncate,
+            args.divert,
+            reject_row=reject,
+            decimal_separator=args.decimal_separator,
+        )
+        run_rows = itertools.islice(converted_rows, args.max_rows_per_run)
+        results = []
+        while True:
+            timings = {}
+            with stage_timer(timings, "total"):
+                formatted_run_id = format_run_id(take_run_ids(args, lease, 1))
+                first_run_id = first_run_id or formatted_run_id
+                (metadata_file_name, detailed_file_name) = get_output_file_names(
+                    args, formatted_run_id
+                )
+                start_rejects_file(rejects, detailed_file_name)
+                with removing_output_files_on_error(detailed_file_name):
+                    with stage_timer(timings, "conversion"):
+                        conversion_result = write_rows(
+                            run_rows,
+                            detailed_file_name,
+                            get_diverted_file_name(detailed_file_name),
+                            pipeline=args.pipeline,
+                        )
+                    if args.on_error == "collect" and rejects["rows"]:
+                        # Go on to the end of the input file, only to collect all the
+                        # rows that can't be converted
+                        collections.deque(converted_rows, maxlen=0)
+                        check_rejected_rows(args, rejects, input_file)
+                with stage_timer(timings, "metadata"):
+                    write_metadata_file(
+                        args, metadata_file_name, formatted_run_id, *conversion_result
+                    )
+            results.append(
+                make_run_result(
+                    input_file,
+                    input_bytes,
+                    formatted_run_id,
+                    metadata_file_name,
+                    detailed_file_name,
+                    conversion_result,
+                    timings,
+                )
             )
+            next_row = next(converted_rows, None)
+            if next_row is None:
+                break
             logging.info(
-                "Processed %d rows, oldest date %s, most recent date %s"
-                % (num_input_rows, oldest_date, most_recent_date)
+                "Reached %d rows, continuing input file %s in a new run"
+                % (args.max_rows_per_run, input_file)
             )
+            run_rows = itertools.chain(
+                [next_row], itertools.islice(converted_rows, args.max_rows_per_run - 1)
+            )
+    check_rejected_rows(args, rejects, input_file)
+    append_journal_entry(
+        args,
+        journal_key,
+        [(run.run_id, run.metadata_file, run.detailed_file) for run in results],
+    )
+    record_content_hash(args, content_hash, input_file, [run.run_id for run in results])
+    if args.move_input_files:
+        # Accounted for in the last run of the input file
+        with stage_timer(timings, "move"):
+            shutil.move(input_file, args.output_directory)
+        timings["total"]["wall"] += timings["move"]["wall"]
+        timings["total"]["cpu"] += timings["move"]["cpu"]
+    logging.info("Metadata file written, end processing file %s" % input_file)
+    save_profile(args, profiler, input_file, first_run_id)
+    return results
 
-            # Generate the second file containing the metadata
-            output = generate_metadata_file(
-                args.application_id,
-                args.run_description,
-                oldest_date,
-                most_recent_date,
-                args.billing_type,
-                num_input_rows,
-                run_id,
-                args.file_version,
+
+def run_in_worker(loglevel, function, *args):
+    # Worker processes started with "spawn" don't inherit the logging configuration.
+    # Not set up by an initializer of the pool, only available from Python 3.7.
+    logging.basicConfig(level=loglevel)
+    return function(*args)
+
+
+def process_runs_in_parallel(args, config, runs):
+    import concurrent.futures
+
+    jobs = args.jobs
+    if not args.chunk_size:
+        jobs = min(jobs, len(runs))
+    logging.info("Processing %d input files with %d workers" % (len(runs), jobs))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        if args.chunk_size:
+            # The input files are processed one after the other, the workers
+            # converting the chunks of the current file
+            return [process_run(args, config, *run, executor=executor) for run in runs]
+        futures = [
+            executor.submit(
+                run_in_worker, args.loglevel, process_run, args, config, *run
             )
-            save_file(output, metadata_file_name)
-            if args.move_input_files:
-                shutil.move(input_file, args.output_directory)
-            logging.info("Metadata file written, end processing file %s" % input_file)
+            for run in runs
+        ]
+        try:
+            # Wait in submission order, so that the first failing file is the one a
+            # serial run would have stopped on
+            return [future.result() for future in futures]
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            concurrent.futures.wait(futures)
+            # The files after the failing one may have been converted (and moved)
+            # already: the next batch must not reuse their Run IDs
+            completed_run_ids = [
+                int(run[1])
+                for (run, future) in zip(runs, futures)
+                if not future.cancelled() and not future.exception()
+            ]
+            if completed_run_ids:
+                save_run_id(args, max(completed_run_ids) + 1)
+            raise
+
+
+def process_input_files(args, config, input_files, run_id):
+    # Convert the input files, starting at the given Run ID. Returns the results of
+    # the runs and the next Run ID. On error, the Run ID following the ones already
+    # taken is the next_run_id of the BillingFlatFileError.
+    if args.journal:
+        (input_files, run_id) = skip_journaled_files(args, input_files, run_id)
+    content_hashes = {}
+    if args.dedup_index:
+        (input_files, content_hashes) = skip_duplicate_files(args, input_files)
+    if args.run_id_lease:
+        # The Run IDs are leased from the Run ID file as they are needed
+        lease = {"next": 0, "end": 0}
+    else:
+        lease = {"next": run_id, "end": float("inf")}
+    try:
+        if args.max_rows_per_run:
+            # The number of runs per input file is only known after conversion
+            results = []
+            for (idx, input_file) in enumerate(input_files):
+                if args.pipeline and idx + 1 < len(input_files):
+                    prefetch_file(input_files[idx + 1])
+                results.extend(
+                    process_file_in_runs(
+                        args, config, input_file, lease, content_hashes.get(input_file)
+                    )
+                )
+        else:
+            runs = allocate_runs(
+                args,
+                input_files,
+                take_run_ids(args, lease, len(input_files)),
+                content_hashes,
+            )
+            if args.jobs > 1 and (args.chunk_size or len(runs) > 1):
+                results = process_runs_in_parallel(args, config, runs)
+            else:
+                results = []
+                for (idx, run) in enumerate(runs):
+                    if args.pipeline and idx + 1 < len(runs):
+                        prefetch_file(runs[idx + 1][0])
+                    results.append(process_run(args, config, *run))
+    except BillingFlatFileError as e:
+        e.next_run_id = lease["next"]
+        raise
+    finally:
+        if args.run_id_lease:
+            release_run_ids(args.run_id_file, lease["next"], lease["end"])
+    return (results, lease["next"])
+
+
+def get_lock_identity(lock_file_name):
+    stat = os.stat(lock_file_name)
+    return (stat.st_ino, stat.st_mtime_ns)
+
+
+def remove_lock_file(lock_file_name, identity):
+    # Rename the lock file to a name of its own before removing it, so that a lock
+    # file created by another process in the meantime is never removed. Returns
+    # whether the lock file with that identity has been removed.
+    renamed_file_name = "%s.%s.%d.%d" % (
+        lock_file_name,
+        socket.gethostname(),
+        os.getpid(),
+        threading.get_ident(),
+    )
+    try:
+        os.rename(lock_file_name, renamed_file_name)
+    except FileNotFoundError:
+        return False
+    removed = get_lock_identity(renamed_file_name) == identity
+    if not removed:
+        # Another process holds the lock now, put its lock file back
+        with contextlib.suppress(FileExistsError):
+            os.link(renamed_file_name, lock_file_name)
+    os.remove(renamed_file_name)
+    return removed
+
+
+@contextlib.contextmanager
+def lock_run_id_file(run_id_file_name):
+    # Creating the lock file with O_EXCL is atomic, also on a filesystem shared
+    # between several nodes (NFS v3 and later)
+    lock_file_name = "%s.lock" % run_id_file_name
+    deadline = time.monotonic() + RUN_ID_LOCK_TIMEOUT
+    while True:
+        try:
+            fd = os.open(lock_file_name, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            pass
+        try:
+            identity = get_lock_identity(lock_file_name)
+        except FileNotFoundError:
+            # Released in the meantime
+            continue
+        if time.time() - identity[1] / 1e9 > RUN_ID_LOCK_STALE:
+            # The lock is only held for a few milliseconds, its owner crashed
+            if remove_lock_file(lock_file_name, identity):
+                logging.warning("Removed stale lock file %s" % lock_file_name)
+            continue
+        if time.monotonic() > deadline:
+            raise RunIdError(
+                "Timed out waiting for the lock file '%s'." % lock_file_name, 244
+            )
+        time.sleep(0.05)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write("%s %d\n" % (socket.gethostname(), os.getpid()))
+        identity = get_lock_identity(lock_file_name)
+    except BaseException:
+        os.remove(lock_file_name)
+        raise
+    try:
+        yield
+    finally:
+        if not remove_lock_file(lock_file_name, identity):
+            logging.warning(
+                "Lock file %s was removed as stale while held" % lock_file_name
+            )
+
+
+def load_free_run_ids(free_file_name):
+    # The blocks of Run IDs returned unused, as [first, end) pairs
+    if not os.path.isfile(free_file_name):
+        return []
+    with open(free_file_name) as f:
+        return json.load(f)
+
+
+def merge_run_id_blocks(blocks):
+    # Sort the [first, end) blocks of Run IDs, joining the adjacent ones
+    merged = []
+    for (first, end) in sorted(blocks):
+        if merged and first <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([first, end])
+    return merged
+
+
+def lease_run_ids(run_id_file_name, count, size=None):
+    # Take a block of up to `size` (by default `count`) consecutive Run IDs, from
+    # the first block returned by another process that has at least the `count`
+    # Run IDs actually needed, otherwise from the counter stored in the Run ID file.
+    # The block is cut short at Run ID 9999. Returns the [first, end) pair.
+    size = max(count, size or count)
+    free_file_name = "%s.free" % run_id_file_name
+    with lock_run_id_file(run_id_file_name):
+        free_blocks = load_free_run_ids(free_file_name)
+        for (idx, (first, end)) in enumerate(free_blocks):
+            if end - first >= count:
+                lease_end = min(end, first + size)
+                if lease_end == end:
+                    del free_blocks[idx]
+                else:
+                    free_blocks[idx] = [lease_end, end]
+                save_file_atomically(json.dumps(free_blocks), free_file_name)
+                return (first, lease_end)
+        first = read_run_id_file(run_id_file_name)
+        if first + count - 1 > 9999:
+            raise RunIdError("The Run ID can't be higher than 9999.", 223)
+        end = min(first + size, 10000)
+        save_file_atomically(str(end), run_id_file_name)
+    return (first, end)
+
+
+def release_run_ids(run_id_file_name, first, end):
+    # Return the unused Run IDs [first, end) of a lease
+    if first >= end:
+        return
+    free_file_name = "%s.free" % run_id_file_name
+    with lock_run_id_file(run_id_file_name):
+        free_blocks = load_free_run_ids(free_file_name)
+        free_blocks = merge_run_id_blocks(free_blocks + [[first, end]])
+        if free_blocks[-1][1] == read_run_id_file(run_id_file_name):
+            # Nobody leased any Run ID after the last free block
+            save_file_atomically(str(free_blocks.pop()[0]), run_id_file_name)
+        if free_blocks or os.path.isfile(free_file_name):
+            save_file_atomically(json.dumps(free_blocks), free_file_name)
+
+
+def take_run_ids(args, lease, count):
+    # The next `count` consecutive Run IDs of the current lease, leasing a new block
+    # of at least `--run-id-lease` Run IDs when it doesn't have enough left
+    if lease["next"] + count > lease["end"]:
+        release_run_ids(args.run_id_file, lease["next"], lease["end"])
+        (lease["next"], lease["end"]) = lease_run_ids(
+            args.run_id_file, count, args.run_id_lease
+        )
+    first_run_id = lease["next"]
+    lease["next"] += count
+    return first_run_id
+
+
+def save_run_id(args, run_id):
+    if args.run_id_file and not args.run_id_lease:
+        # Save the next Run ID to the file
+        with lock_run_id_file(args.run_id_file):
+            save_file_atomically(str(run_id), args.run_id_file)
+
+
+def get_file_signature(path):
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def list_directory_files(directory):
+    # The signature of each file in that top-level directory (no subdirectories)
+    files = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file():
+                files[entry.path] = get_file_signature(entry.path)
+    return files
+
+
+def watch_input_directory(args, config, max_polls=None):
+    # Keep polling the input directory, processing the new input files with the
+    # configuration and Run ID kept in memory. Returns the next Run ID.
+    logging.info(
+        "Watching input directory %s every %s seconds"
+        % (args.input_directory, args.watch_interval)
+    )
+    run_id = args.run_id
+    config_signature = get_file_signature(args.config)
+    previous_files = {}
+    processed_files = set()
+    polls = 0
+    try:
+        while max_polls is None or polls < max_polls:
+            polls += 1
+            files = list_directory_files(args.input_directory)
+            # Only pick up the files whose size and modification time didn't change
+            # since the previous poll, i.e. that are not being written anymore
+            ready_files = [
+                path
+                for (path, signature) in files.items()
+                if previous_files.get(path) == signature
+                and (path, signature) not in processed_files
+            ]
+            previous_files = files
+            # Forget the processed files that have been (re)moved since
+            processed_files = {
+                (path, signature)
+                for (path, signature) in processed_files
+                if files.get(path) == signature
+            }
+            if ready_files:
+                if get_file_signature(args.config) != config_signature:
+                    config_signature = get_file_signature(args.config)
+                    config = load_config(args.config, args.config_cache_dir)
+                    validate_config_args(args, config)
+                results = []
+                timings = {}
+                try:
+                    with stage_timer(timings, "total"):
+                        for path in ready_files:
+                            try:
+                                (file_results, run_id) = process_input_files(
+                                    args, config, [path], run_id
+                                )
+                                results.extend(file_results)
+                            except BillingFlatFileError as e:
+                                # Only processed again once it changed
+                                logging.error(
+                                    "Input file %s could not be processed: %s"
+                                    % (path, e)
+                                )
+                                run_id = getattr(e, "next_run_id", run_id)
+                            processed_files.add((path, files[path]))
+                finally:
+                    save_run_id(args, run_id)
+                write_report(args, BatchResult(results, run_id, timings))
+            if max_polls is None or polls < max_polls:
+                time.sleep(args.watch_interval)
+    except KeyboardInterrupt:
+        logging.info("Stopped watching input directory %s" % args.input_directory)
+    return run_id
 
-        if args.run_id_file:
-            # Save the next Run ID to the file
-            run_id = str(int(run_id) + 1)
-            save_file(run_id, args.run_id_file)
+
+def record_validation_error(errors, idx_col, error_code, idx_row, value):
+    error = errors.setdefault(
+        (idx_col, error_code), {"count": 0, "rows": [], "value": value}
+    )
+    error["count"] += 1
+    if len(error["rows"]) < MAX_REPORTED_ROWS:
+        error["rows"].append(idx_row)
+
+
+def validate_file(args, config, input_file):
+    # Same checks as the conversion, going on after the invalid values, but without
+    # formatting nor writing the rows
+    logging.info("Validating input file %s", input_file)
+    prepare_conversion(args)
+    rows = csv.reader(
+        read_input_lines(args, input_file),
+        delimiter=args.delimiter,
+        quotechar=args.quotechar,
+    )
+    checkers = [
+        compile_field_checker(field, idx_col, args.truncate, args.decimal_separator)
+        for (idx_col, field) in enumerate(config, 1)
+    ]
+    errors = {}
+    num_input_rows = 0
+    for (idx_row, row) in enumerate(rows, 1):
+        num_input_rows = idx_row
+        if len(row) > len(config):
+            record_validation_error(errors, None, 23, idx_row, len(row))
+        for (idx_col, (checker, cell)) in enumerate(zip(checkers, row), 1):
+            error_code = checker(cell, idx_row)
+            if error_code:
+                record_validation_error(errors, idx_col, error_code, idx_row, cell)
+    return ValidationResult(input_file, num_input_rows, errors)
+
+
+def log_validation_result(result, config):
+    if not result.errors:
+        logging.info(
+            "Input file %s: %d rows, no invalid values found"
+            % (result.input_file, result.num_input_rows)
+        )
+        return
+    logging.error(
+        "Input file %s: %d rows, %d invalid values found"
+        % (
+            result.input_file,
+            result.num_input_rows,
+            sum(error["count"] for error in result.errors.values()),
+        )
+    )
+    for ((idx_col, error_code), error) in sorted(
+        result.errors.items(), key=lambda item: (item[0][0] or 0, item[0][1])
+    ):
+        if idx_col is None:
+            field = "Rows"
+            example = "%d fields instead of %d" % (error["value"], len(config))
+        else:
+            field = "Field %d (%s)" % (idx_col, config[idx_col - 1]["output_format"])
+            example = "'%s'" % error["value"]
+        rows = ", ".join(str(idx_row) for idx_row in error["rows"])
+        if error["count"] > len(error["rows"]):
+            rows += ", ..."
+        logging.error(
+            "%s, %s on rows %s (%d in total, ignoring the header), e.g. %s"
+            % (
+                field,
+                VALIDATION_ERRORS.get(error_code, "exit code %d" % error_code),
+                rows,
+                error["count"],
+                example,
+            )
+        )
+
+
+def run_validation(args, input_files):
+    config = load_config(args.config, args.config_cache_dir)
+    validate_config_args(args, config)
+    results = [validate_file(args, config, input_file) for input_file in input_files]
+    for result in results:
+        log_validation_result(result, config)
+    return results
+
+
+def run_batch(args, input_files):
+    timings = {}
+    with stage_timer(timings, "total"):
+        with stage_timer(timings, "configuration"):
+            # Parse the configuration file only once for the whole batch
+            config = load_config(args.config, args.config_cache_dir)
+            validate_config_args(args, config)
+        (results, run_id) = process_input_files(args, config, input_files, args.run_id)
+        save_run_id(args, run_id)
+    batch = BatchResult(results, run_id, timings)
+    write_report(args, batch)
+    return batch
+
+
+def get_file_size(file_name):
+    if file_name and os.path.isfile(file_name):
+        return os.path.getsize(file_name)
+    return None
+
+
+def make_report(batch):
+    files = []
+    for run in batch.runs:
+        output_files = (
+            run.metadata_file,
+            run.detailed_file,
+            run.diverted_file,
+            run.rejects_file,
+        )
+        timing = run.timings["total"]
+        files.append(
+            {
+                "input_file": run.input_file,
+                "run_id": run.run_id,
+                "input_bytes": run.input_bytes,
+                "rows": run.num_input_rows,
+                "oldest_date": run.oldest_date,
+                "most_recent_date": run.most_recent_date,
+                "output_files": {
+                    output_file: get_file_size(output_file)
+                    for output_file in output_files
+                    if output_file
+                },
+                "wall_time": timing["wall"],
+                "cpu_time": timing["cpu"],
+                "rows_per_second": run.num_input_rows / timing["wall"],
+                "process_peak_rss_bytes": run.process_peak_rss,
+            }
+        )
+    # The input files split over several runs are only counted once
+    input_files = {run.input_file: run.input_bytes for run in batch.runs}
+    num_rows = sum(run.num_input_rows for run in batch.runs)
+    wall_time = batch.timings["total"]["wall"]
+    # The CPU time of the runs, which may have been spent in worker processes
+    cpu_time = sum(run.timings["total"]["cpu"] for run in batch.runs)
+    if "configuration" in batch.timings:
+        cpu_time += batch.timings["configuration"]["cpu"]
+    peak_rss = [run.process_peak_rss for run in batch.runs] + [get_peak_rss()]
+    totals = {
+        "input_files": len(input_files),
+        "runs": len(batch.runs),
+        "input_bytes": sum(size for size in input_files.values() if size),
+        "rows": num_rows,
+        "output_bytes": sum(
+            size for entry in files for size in entry["output_files"].values() if size
+        ),
+        "wall_time": wall_time,
+        "cpu_time": cpu_time,
+        "rows_per_second": num_rows / wall_time,
+        "peak_rss_bytes": max((rss for rss in peak_rss if rss), default=None),
+        "next_run_id": batch.next_run_id,
+    }
+    return {"version": __version__, "files": files, "totals": totals}
+
+
+def write_report(args, batch):
+    if not args.report:
+        return
+    with open(args.report, "w") as f:
+        json.dump(make_report(batch), f, indent=2)
+    logging.info("Run report written to %s" % args.report)
+
+
+def format_profile_summary(batch, arguments_timing):
+    # Per-stage summary of the batch, the stages of the runs being summed up
+    num_rows = sum(run.num_input_rows for run in batch.runs)
+    stages = [("arguments", arguments_timing)]
+    stages.append(("configuration", batch.timings["configuration"]))
+    for stage in ("conversion", "metadata", "move"):
+        run_timings = [run.timings[stage] for run in batch.runs if stage in run.timings]
+        if run_timings:
+            wall_time = sum(timing["wall"] for timing in run_timings)
+            cpu_time = sum(timing["cpu"] for timing in run_timings)
+            stages.append((stage, {"wall": wall_time, "cpu": cpu_time}))
+    total = batch.timings["total"]
+    stages.append(
+        (
+            "total",
+            {
+                "wall": total["wall"] + arguments_timing["wall"],
+                "cpu": total["cpu"] + arguments_timing["cpu"],
+            },
+        )
+    )
+    lines = ["%-15s %10s %10s %12s" % ("Stage", "Wall (s)", "CPU (s)", "Rows/s")]
+    for (stage, timing) in stages:
+        rows_per_second = ""
+        if stage in ("conversion", "total") and timing["wall"]:
+            rows_per_second = "%d" % (num_rows / timing["wall"])
+        lines.append(
+            (
+                "%-15s %10.3f %10.3f %12s"
+                % (stage, timing["wall"], timing["cpu"], rows_per_second)
+            ).rstrip()
+        )
+    lines.append(
+        "%d rows in %d runs. The CPU time only includes the main process."
+        % (num_rows, len(batch.runs))
+    )
+    return "\n".join(lines)
+
+
+def process_batch(input_files=None, **options):
+    """Convert a batch of input files, without exiting the Python interpreter.
+
+    The options are the long command-line arguments, with underscores instead of
+    dashes (e.g. `application_id="AB", run_id_file="run_id.txt"`). When no list of
+    input files is passed, the files from the `input_directory` option are
+    converted. Returns a BatchResult, raises a BillingFlatFileError subclass when
+    the files can't be converted."""
+    args = make_args(**options)
+    if input_files is None:
+        input_files = get_input_files(args)
+    for input_file in input_files:
+        if not os.path.isfile(input_file):
+            raise InvalidArgumentError(
+                "The input file '%s' does not exist." % input_file, 10
+            )
+    return run_batch(args, input_files)
+
+
+def validate_batch(input_files=None, **options):
+    """Check every row of a batch of input files against the configuration, without
+    writing any output file nor using any Run ID.
+
+    Takes the same options as process_batch. Returns the list of ValidationResults,
+    the invalid values don't raise an exception."""
+    args = make_args(validate_only=True, **options)
+    if input_files is None:
+        input_files = get_input_files(args)
+    return run_validation(args, input_files)
+
+
+def process_file(input_file, **options):
+    """Convert a single input file, without exiting the Python interpreter.
+
+    Takes the same options as process_batch. Returns the list of RunResults, more
+    than one when the `max_rows_per_run` option splits the file over several runs.
+    """
+    return run_batch(make_args(input=input_file, **options), [input_file]).runs
+
+
+def init():
+    if __name__ == "__main__":
+        timings = {}
+        with stage_timer(timings, "arguments"):
+            # Parse the provided command-line arguments
+            args = parse_args(sys.argv[1:])
+
+        try:
+            if args.watch:
+                # Parse the configuration file only once for the whole session
+                config = load_config(args.config, args.config_cache_dir)
+                validate_config_args(args, config)
+                watch_input_directory(args, config)
+            elif args.validate_only:
+                results = run_validation(args, get_input_files(args))
+                invalid_files = [result for result in results if result.errors]
+                if invalid_files:
+                    raise ConversionError(
+                        "Invalid values found in %d of the %d input files."
+                        % (len(invalid_files), len(results)),
+                        247,
+                    )
+            else:
+                batch = run_batch(args, get_input_files(args))
+                if args.profile is not None:
+                    print(
+                        format_profile_summary(batch, timings["arguments"]),
+                        file=sys.stderr,
+                    )
+        except BillingFlatFileError as e:
+            exit_with_error(e)
 
 
 init()
@@ -25,6 +25,7 @@ setuptools.setup(
     url="https://github.com/e2jk/billingflatfile",
     py_modules=["billingflatfile"],
     install_requires=[req for req in requirements if req[:2] != "# "],
+    extras_require={"zstd": ["zstandard"]},
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
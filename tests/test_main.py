@@ -8,20 +8,33 @@
 #   rm -rf html_dev/coverage && coverage html --directory=html_dev/coverage \
 #   --title="Code test coverage for billingflatfile"
 
+import ast
+import bz2
 import contextlib
+import gzip
 import io
+import json
 import logging
+import lzma
 import os
 import pathlib
+import pstats
 import shutil
+import subprocess
 import sys
 import unittest
 from locale import Error as localeError
+from unittest import mock
 
 CURRENT_VERSION = "1.0.7-dev"
 
+# Maximum time it may take to import the script, relative to the time it takes to
+# import the modules of the standard library it depends on
+IMPORT_TIME_MARGIN = 3
+
 sys.path.append(".")
 target = __import__("billingflatfile")
+benchmark = __import__("benchmarks.benchmark", fromlist=["benchmark"])
 
 
 def num_files_in_directory(dir):
@@ -39,6 +52,58 @@ class TestVersion(unittest.TestCase):
         self.assertEqual(CURRENT_VERSION, target.__version__)
 
 
+def get_import_times(code):
+    # The cumulative import time of the top-level modules imported by that code, in
+    # microseconds
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    # Lines are formatted as "import time: self [us] | cumulative | module", with
+    # the modules imported by another one indented
+    import_times = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            (_, cumulative, module) = line.split("|")
+            if cumulative.strip().isdigit() and not module.startswith("  "):
+                import_times[module.strip()] = int(cumulative)
+    return import_times
+
+
+def get_script_imports():
+    # The modules imported at the top level of the script
+    with open("billingflatfile.py") as f:
+        tree = ast.parse(f.read())
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            modules.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            modules.append(node.module)
+    return modules
+
+
+@unittest.skipIf(sys.version_info < (3, 7), "-X importtime requires Python 3.7")
+class TestImportTime(unittest.TestCase):
+    def test_import_time(self):
+        """
+        Validate that importing the script doesn't import the heavy dependencies
+        only needed for converting files, and stays within its time budget
+        """
+        import_times = get_import_times("import billingflatfile")
+        self.assertIn("billingflatfile", import_times)
+        for module in ("delimited2fixedwidth", "openpyxl", "concurrent.futures"):
+            self.assertNotIn(module, import_times)
+        # Measured on the same runner, to not depend on its speed
+        baseline = sum(
+            get_import_times("import %s" % ", ".join(get_script_imports())).values()
+        )
+        self.assertLess(import_times["billingflatfile"], baseline * IMPORT_TIME_MARGIN)
+
+
 class TestPadOutputValue(unittest.TestCase):
     def test_pad_output_value_numeric(self):
         """
@@ -58,17 +123,13 @@ class TestPadOutputValue(unittest.TestCase):
         """
         Test padding output value, too long input value
         """
-        with self.assertRaises(SystemExit) as cm1, self.assertLogs(
-            level="CRITICAL"
-        ) as cm2:
+        with self.assertRaises(target.MetadataError) as cm:
             target.pad_output_value("TOO LONG", None, 2, "Field Name")
-        self.assertEqual(cm1.exception.code, 214)
+        self.assertEqual(cm.exception.exit_code, 214)
         self.assertEqual(
-            cm2.output,
-            [
-                "CRITICAL:root:Field 'Field Name' for metadata file is too long! "
-                "Length: 8, max length 2. Exiting..."
-            ],
+            str(cm.exception),
+            "Field 'Field Name' for metadata file is too long! "
+            "Length: 8, max length 2.",
         )
 
     def test_pad_output_value_nonnumeric_number(self):
@@ -76,34 +137,26 @@ class TestPadOutputValue(unittest.TestCase):
         Test padding output value, passing a non-numeric value for a
         numeric field
         """
-        with self.assertRaises(SystemExit) as cm1, self.assertLogs(
-            level="CRITICAL"
-        ) as cm2:
+        with self.assertRaises(target.MetadataError) as cm:
             target.pad_output_value("NOT A NUMBER", "numeric", 15, "Field Name")
-        self.assertEqual(cm1.exception.code, 215)
+        self.assertEqual(cm.exception.exit_code, 215)
         self.assertEqual(
-            cm2.output,
-            [
-                "CRITICAL:root:A non-numeric value was passed for the numeric "
-                "'Field Name' metadata file field. Exiting..."
-            ],
+            str(cm.exception),
+            "A non-numeric value was passed for the numeric "
+            "'Field Name' metadata file field.",
         )
 
     def test_pad_output_value_invalid_output_format(self):
         """
         Test padding output value, passing an invalid output_format
         """
-        with self.assertRaises(SystemExit) as cm1, self.assertLogs(
-            level="CRITICAL"
-        ) as cm2:
+        with self.assertRaises(target.MetadataError) as cm:
             target.pad_output_value("", "INVALID", 15, "Field Name")
-        self.assertEqual(cm1.exception.code, 216)
+        self.assertEqual(cm.exception.exit_code, 216)
         self.assertEqual(
-            cm2.output,
-            [
-                "CRITICAL:root:Unsupported output format 'INVALID' for metadata "
-                "file field 'Field Name'. Exiting..."
-            ],
+            str(cm.exception),
+            "Unsupported output format 'INVALID' for metadata "
+            "file field 'Field Name'.",
         )
 
 
@@ -113,9 +166,7 @@ class TestGenerateMetadataFile(unittest.TestCase):
         Test generating the metadata file with an invalid output file version
         """
         file_version = "INVALID"
-        with self.assertRaises(SystemExit) as cm1, self.assertLogs(
-            level="CRITICAL"
-        ) as cm2:
+        with self.assertRaises(target.MetadataError) as cm:
             target.generate_metadata_file(
                 "application_id",
                 "run_description",
@@ -126,13 +177,10 @@ class TestGenerateMetadataFile(unittest.TestCase):
                 "run_id",
                 file_version,
             )
-        self.assertEqual(cm1.exception.code, 213)
+        self.assertEqual(cm.exception.exit_code, 213)
         self.assertEqual(
-            cm2.output,
-            [
-                "CRITICAL:root:Unsupported output file version 'INVALID', must be "
-                "one of 'V1.11'. Exiting..."
-            ],
+            str(cm.exception),
+            "Unsupported output file version 'INVALID', must be " "one of 'V1.11'.",
         )
 
     def test_generate_metadata_file(self):
@@ -166,6 +214,90 @@ class TestGenerateMetadataFile(unittest.TestCase):
         )
 
 
+class TestLoadConfig(unittest.TestCase):
+    def test_load_config_no_cache(self):
+        """
+        Test loading a configuration file without a cache directory
+        """
+        config = target.load_config("tests/sample_files/configuration1.xlsx")
+        self.assertEqual(len(config), 9)
+        self.assertEqual(
+            config[0], {"length": 7, "output_format": "Integer", "skip_field": False}
+        )
+
+    def test_load_config_cache(self):
+        """
+        Test that a cached configuration is used instead of parsing the Excel file
+        """
+        cache_dir = "nonexistent_dir"
+        self.assertFalse(os.path.isdir(cache_dir))
+        config = target.load_config("tests/sample_files/configuration1.xlsx", cache_dir)
+        self.assertEqual(num_files_in_directory(cache_dir), 1)
+        # The cached configuration doesn't even need delimited2fixedwidth / openpyxl
+        with mock.patch.object(
+            target, "load_delimited2fixedwidth", side_effect=AssertionError
+        ):
+            cached_config = target.load_config(
+                "tests/sample_files/configuration1.xlsx", cache_dir
+            )
+        self.assertEqual(config, cached_config)
+        shutil.rmtree(cache_dir)
+        self.assertFalse(os.path.isdir(cache_dir))
+
+
+class TestFindDataRange(unittest.TestCase):
+    def test_find_data_range(self):
+        """
+        Test finding the rows between the header and the footer
+        """
+        input_file = "tests/sample_files/input1.txt"
+        with open(input_file, "rb") as f:
+            content = f.read()
+        (start, end) = target.find_data_range(input_file, 1, 1)
+        self.assertTrue(content[start:end].startswith(b"04000^1330342^"))
+        self.assertTrue(content[start:end].endswith(b"[90038979]\n"))
+        self.assertEqual(content[end:], b"T^3^15072020\n")
+        (start, end) = target.find_data_range(input_file, 0, 0)
+        self.assertEqual((start, end), (0, len(content)))
+        # Skipping more lines than the file contains
+        (start, end) = target.find_data_range(input_file, 3, 3)
+        self.assertEqual(start, end)
+        # Long footer lines, and a last line without line break
+        output_directory = "nonexistent_dir"
+        input_file = "%s/input.txt" % output_directory
+        self.assertFalse(os.path.isdir(output_directory))
+        pathlib.Path(output_directory).mkdir()
+        footer = b"%s\n%s" % (b"F" * 100000, b"G" * 100000)
+        with open(input_file, "wb") as f:
+            f.write(content + footer)
+        (start, end) = target.find_data_range(input_file, 1, 3)
+        self.assertEqual((content + footer)[end:], b"T^3^15072020\n" + footer)
+        (start, end) = target.find_data_range(input_file, 0, 10)
+        self.assertEqual((start, end), (0, 0))
+        open(input_file, "wb").close()
+        self.assertEqual(target.find_data_range(input_file, 1, 1), (0, 0))
+        shutil.rmtree(output_directory)
+        self.assertFalse(os.path.isdir(output_directory))
+
+    def test_split_data_range(self):
+        """
+        Test splitting the rows to convert in chunks at line boundaries
+        """
+        input_file = "tests/sample_files/input1.txt"
+        with open(input_file, "rb") as f:
+            content = f.read()
+        (start, end) = target.find_data_range(input_file, 1, 1)
+        chunks = target.split_data_range(input_file, start, end, 1)
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(chunks[0][0], start)
+        self.assertEqual(chunks[-1][1], end)
+        for (chunk_start, chunk_end) in chunks:
+            self.assertTrue(content[chunk_start:chunk_end].startswith(b"04000^"))
+            self.assertEqual(content[chunk_end - 1 : chunk_end], b"\n")
+        chunks = target.split_data_range(input_file, start, end, 1024)
+        self.assertEqual(chunks, [(start, end)])
+
+
 class TestParseArgs(unittest.TestCase):
     def test_parse_args_no_arguments(self):
         """
@@ -246,28 +378,48 @@ class TestParseArgs(unittest.TestCase):
                 "DEBUG:root:These are the parsed arguments:\n'Namespace("
                 "application_id='SE', "
                 "billing_type=' ', "
+                "checkpoint=None, "
+                "chunk_size=None, "
                 "config='tests/sample_files/configuration1.xlsx', "
+                "config_cache_dir=None, "
                 "date_report=None, "
+                "decimal_separator=None, "
+                "dedup_index=None, "
                 "delimiter=',', "
                 "divert=[], "
+                "divert_file=[], "
                 "file_version='V1.11', "
                 "input='tests/sample_files/input1.txt', "
                 "input_directory=None, "
                 "input_encoding='utf-8', "
+                "jobs=1, "
+                "journal=None, "
                 "locale='', "
                 "logging_level='DEBUG', "
                 "loglevel=10, "
+                "max_rows_per_run=None, "
+                "metadata_output=None, "
                 "move_input_files=False, "
+                "on_duplicate='skip', "
+                "on_error='fail', "
+                "output=None, "
                 "output_directory='data', "
                 "overwrite_files=False, "
+                "pipeline=False, "
+                "profile=None, "
                 "quotechar='\"', "
+                "report=None, "
                 "run_description='', "
                 "run_id=123, "
                 "run_id_file=None, "
+                "run_id_lease=None, "
                 "skip_footer=0, "
                 "skip_header=0, "
                 "truncate=[], "
-                "txt_extension=False)'"
+                "txt_extension=False, "
+                "validate_only=False, "
+                "watch=False, "
+                "watch_interval=5.0)'"
             ],
         )
 
@@ -641,6 +793,184 @@ class TestParseArgs(unittest.TestCase):
             ],
         )
 
+    def test_parse_args_jobs_str(self):
+        """
+        Test running the script with a non-numeric --jobs argument
+        """
+        with self.assertRaises(SystemExit) as cm1, self.assertLogs(
+            level="CRITICAL"
+        ) as cm2:
+            target.parse_args(
+                [
+                    "--input",
+                    "tests/sample_files/input1.txt",
+                    "--output-directory",
+                    "data",
+                    "--config",
+                    "tests/sample_files/configuration1.xlsx",
+                    "--application-id",
+                    "SE",
+                    "--run-id",
+                    "123",
+                    "--jobs",
+                    "many",
+                ]
+            )
+        self.assertEqual(cm1.exception.code, 226)
+        self.assertEqual(
+            cm2.output,
+            [
+                "CRITICAL:root:The `--jobs` argument must be numeric or 'auto'. "
+                "Exiting..."
+            ],
+        )
+
+    def test_parse_args_jobs_auto(self):
+        """
+        Test running the script with --jobs auto, one worker per CPU core
+        """
+        parser = target.parse_args(
+            [
+                "--input",
+                "tests/sample_files/input1.txt",
+                "--output-directory",
+                "data",
+                "--config",
+                "tests/sample_files/configuration1.xlsx",
+                "--application-id",
+                "SE",
+                "--run-id",
+                "123",
+                "--jobs",
+                "auto",
+            ]
+        )
+        self.assertEqual(parser.jobs, os.cpu_count() or 1)
+
+    def test_parse_args_chunk_size(self):
+        """
+        Test the --chunk-size argument, with and without unit suffix
+        """
+        for (chunk_size, expected) in (("65536", 65536), ("64M", 64 * 1024 ** 2)):
+            parser = target.parse_args(
+                [
+                    "--input",
+                    "tests/sample_files/input1.txt",
+                    "--output-directory",
+                    "data",
+                    "--config",
+                    "tests/sample_files/configuration1.xlsx",
+                    "--application-id",
+                    "SE",
+                    "--run-id",
+                    "123",
+                    "--chunk-size",
+                    chunk_size,
+                ]
+            )
+            self.assertEqual(parser.chunk_size, expected)
+        with self.assertRaises(SystemExit) as cm1, self.assertLogs(
+            level="CRITICAL"
+        ) as cm2:
+            target.parse_args(
+                [
+                    "--input",
+                    "tests/sample_files/input1.txt",
+                    "--output-directory",
+                    "data",
+                    "--config",
+                    "tests/sample_files/configuration1.xlsx",
+                    "--application-id",
+                    "SE",
+                    "--run-id",
+                    "123",
+                    "--chunk-size",
+                    "0",
+                ]
+            )
+        self.assertEqual(cm1.exception.code, 228)
+        self.assertEqual(
+            cm2.output,
+            [
+                "CRITICAL:root:The `--chunk-size` argument must be a positive number "
+                "of bytes, optionally followed by K, M or G. Exiting..."
+            ],
+        )
+
+    def test_parse_args_max_rows_per_run(self):
+        """
+        Test the --max-rows-per-run argument
+        """
+        arguments = [
+            "--input",
+            "tests/sample_files/input1.txt",
+            "--output-directory",
+            "data",
+            "--config",
+            "tests/sample_files/configuration1.xlsx",
+            "--application-id",
+            "SE",
+            "--run-id",
+            "123",
+            "--max-rows-per-run",
+        ]
+        parser = target.parse_args(arguments + ["auto"])
+        self.assertEqual(parser.max_rows_per_run, 999999)
+        with self.assertRaises(SystemExit) as cm1, self.assertLogs(
+            level="CRITICAL"
+        ) as cm2:
+            target.parse_args(arguments + ["1000000"])
+        self.assertEqual(cm1.exception.code, 229)
+        self.assertEqual(
+            cm2.output,
+            [
+                "CRITICAL:root:The `--max-rows-per-run` argument must be 'auto' or "
+                "comprised between 1 and 999999. Exiting..."
+            ],
+        )
+        with self.assertRaises(SystemExit) as cm1, self.assertLogs(
+            level="CRITICAL"
+        ) as cm2:
+            target.parse_args(arguments + ["10", "--jobs", "2"])
+        self.assertEqual(cm1.exception.code, 230)
+        self.assertEqual(
+            cm2.output,
+            [
+                "CRITICAL:root:The `--max-rows-per-run` argument cannot be combined "
+                "with the `--jobs` or `--chunk-size` arguments. Exiting..."
+            ],
+        )
+
+    def test_parse_args_output_without_metadata_output(self):
+        """
+        Test the --output argument without the --metadata-output argument
+        """
+        with self.assertRaises(SystemExit) as cm1, self.assertLogs(
+            level="CRITICAL"
+        ) as cm2:
+            target.parse_args(
+                [
+                    "--input",
+                    "-",
+                    "--output",
+                    "-",
+                    "--config",
+                    "tests/sample_files/configuration1.xlsx",
+                    "--application-id",
+                    "SE",
+                    "--run-id",
+                    "123",
+                ]
+            )
+        self.assertEqual(cm1.exception.code, 236)
+        self.assertEqual(
+            cm2.output,
+            [
+                "CRITICAL:root:The `--output` and `--metadata-output` arguments must "
+                "be used together. Exiting..."
+            ],
+        )
+
     def test_parse_args_version(self):
         """
         Test the --version argument
@@ -947,13 +1277,14 @@ class TestInit(unittest.TestCase):
         shutil.rmtree(output_directory)
         self.assertFalse(os.path.isdir(output_directory))
 
-    def test_init_input_directory_run_id_too_high(self):
+    def test_init_valid_input_directory_parallel(self):
         """
-        Test the init code with valid parameters, multiple input files but
-        the Run ID becomes too high
+        Test the init code with multiple input files converted by a pool of workers,
+        the output must be identical to a serial run
         """
         input_directory = "tests/sample_files/multiple"
         output_directory = "nonexistent_dir"
+        run_id_file = "%s/run-id.txt" % output_directory
         self.assertEqual(num_files_in_directory(input_directory), 3)
         self.assertFalse(os.path.isdir(output_directory))
         target.__name__ = "__main__"
@@ -963,7 +1294,6 @@ class TestInit(unittest.TestCase):
             input_directory,
             "--output-directory",
             output_directory,
-            "--overwrite-files",
             "--config",
             "tests/sample_files/configuration1.xlsx",
             "--delimiter",
@@ -979,45 +1309,63 @@ class TestInit(unittest.TestCase):
             "--billing-type",
             "H",
             "--run-id",
-            "9998",
-            "--txt-extension",
-            "--locale",
-            "fr_FR.utf8",
+            "123",
+            "--run-id-file",
+            run_id_file,
+            "--jobs",
+            "2",
         ]
-        with self.assertRaises(SystemExit) as cm1, self.assertLogs(
-            level="CRITICAL"
-        ) as cm2:
-            try:
-                target.init()
-            except localeError:
-                # On Windows, the French locale is just called "fr"
-                target.sys.argv[-1] = "fr"
-                target.init()
-        self.assertEqual(cm1.exception.code, 223)
-        self.assertEqual(
-            cm2.output,
-            ["CRITICAL:root:The Run ID can't be higher than 9999. Exiting..."],
-        )
+        target.init()
+
+        # The Run ID file and the 6 generated output files
+        self.assertEqual(num_files_in_directory(output_directory), 1 + 6)
+        with open(run_id_file) as f:
+            self.assertEqual("126", f.read())
+        # Run IDs are assigned in the same order as a serial run would
+        (_, _, filenames) = next(os.walk(input_directory))
+        for (run_id, ifile) in zip((123, 124, 125), filenames):
+            metadata_file_name = "%s/SSE0%dE" % (output_directory, run_id)
+            with open(metadata_file_name) as f:
+                s = f.read()
+                expected_output = (
+                    "SSEAAA                           "
+                    "9999999900000000H00000300%dV1.11                          "
+                    "                                                           "
+                    "                                                 " % run_id
+                )
+                self.assertEqual(expected_output, s)
+            detailed_file_name = "%s/SSE0%dD" % (output_directory, run_id)
+            with open(detailed_file_name) as f:
+                s = f.read()
+                expected_output = (
+                    "0004000133034205413540000100202007312006"
+                    "                                        "
+                    "Leendert MOLENDIJK [90038979]           \n"
+                    "0004000133034005407940000157202003051022"
+                    "                                        "
+                    "Leendert MOLENDIJK [90038979]           \n"
+                    "0004000133034105409340022139202012252006"
+                    "                                        "
+                    "Leendert MOLENDIJK [90038979]           "
+                )
+                self.assertEqual(expected_output, s)
         shutil.rmtree(output_directory)
         self.assertFalse(os.path.isdir(output_directory))
 
-    def test_init_move_input_files(self):
+    def test_init_valid_input_file_chunks(self):
         """
-        Test the init code with valid parameters, multiple input files
+        Test the init code with a single input file split in chunks converted by a
+        pool of workers, the output must be identical to a serial run
         """
-        input_directory = "tests/sample_files/multiple"
         output_directory = "nonexistent_dir"
-        self.assertEqual(num_files_in_directory(input_directory), 3)
         self.assertFalse(os.path.isdir(output_directory))
         target.__name__ = "__main__"
         target.sys.argv = [
             "scriptname.py",
-            "--input-directory",
-            input_directory,
+            "--input",
+            "tests/sample_files/input1.txt",
             "--output-directory",
             output_directory,
-            "--move-input-files",
-            "--overwrite-files",
             "--config",
             "tests/sample_files/configuration1.xlsx",
             "--delimiter",
@@ -1034,68 +1382,341 @@ class TestInit(unittest.TestCase):
             "H",
             "--run-id",
             "123",
-            "--txt-extension",
-            "--locale",
-            "fr_FR.utf8",
+            "--date-report",
+            "5",
+            "--divert",
+            "4,1.567",
+            "--jobs",
+            "2",
+            "--chunk-size",
+            "1",
         ]
-        try:
-            target.init()
-        except localeError:
-            # On Windows, the French locale is just called "fr"
-            target.sys.argv[-1] = "fr"
-            target.init()
-
-        self.assertTrue(os.path.isdir(output_directory))
-        # The 3 input files and the 6 generated output files
-        self.assertEqual(num_files_in_directory(output_directory), 3 + 6)
-
-        for i in ("", "_copy1", "_copy2"):
-            # Move the input files back to the input directory
-            input_file = os.path.join(output_directory, "input1%s.txt" % i)
-            shutil.move(input_file, input_directory)
+        target.init()
 
-        for run_id in (123, 124, 125):
-            # Confirm the output files have been written and their content
-            metadata_file_name = "%s/SSE0%dE.txt" % (output_directory, run_id)
-            self.assertTrue(os.path.isfile(metadata_file_name))
-            with open(metadata_file_name) as f:
-                s = f.read()
-                expected_output = (
-                    "SSEAAA                           "
-                    "9999999900000000H00000300%dV1.11                          "
-                    "                                                           "
-                    "                                                 " % run_id
-                )
-                self.assertEqual(expected_output, s)
-            # Remove the metadata output file
-            os.remove(metadata_file_name)
-            self.assertFalse(os.path.isfile(metadata_file_name))
+        # The metadata, detailed and diverted output files
+        self.assertEqual(num_files_in_directory(output_directory), 3)
+        with open("%s/SSE0123E" % output_directory) as f:
+            s = f.read()
+            expected_output = (
+                "SSEAAA                           "
+                "2020030520201225H00000300123V1.11                          "
+                "                                                           "
+                "                                                 "
+            )
+            self.assertEqual(expected_output, s)
+        with open("%s/SSE0123D" % output_directory) as f:
+            s = f.read()
+            expected_output = (
+                "0004000133034205413540000100202007312006"
+                "                                        "
+                "Leendert MOLENDIJK [90038979]           \n"
+                "0004000133034105409340022139202012252006"
+                "                                        "
+                "Leendert MOLENDIJK [90038979]           "
+            )
+            self.assertEqual(expected_output, s)
+        with open("%s/SSE0123D_diverted" % output_directory) as f:
+            s = f.read()
+            expected_output = (
+                "0004000133034005407940000157202003051022"
+                "                                        "
+                "Leendert MOLENDIJK [90038979]           "
+            )
+            self.assertEqual(expected_output, s)
+        shutil.rmtree(output_directory)
+        self.assertFalse(os.path.isdir(output_directory))
 
-            detailed_file_name = "%s/SSE0%dD.txt" % (output_directory, run_id)
-            self.assertTrue(os.path.isfile(detailed_file_name))
-            with open(detailed_file_name) as f:
-                s = f.read()
-                expected_output = (
-                    "0004000133034205413540000100202007312006"
-                    "                                        "
-                    "Leendert MOLENDIJK [90038979]           \n"
-                    "0004000133034005407940000157202003051022"
-                    "                                        "
-                    "Leendert MOLENDIJK [90038979]           \n"
-                    "0004000133034105409340022139202012252006"
-                    "                                        "
-                    "Leendert MOLENDIJK [90038979]           "
-                )
-                self.assertEqual(expected_output, s)
-            # Remove the detailed output file
-            os.remove(detailed_file_name)
-            self.assertFalse(os.path.isfile(detailed_file_name))
+    def test_init_max_rows_per_run(self):
+        """
+        Test the init code with an input file split in several runs
+        """
+        output_directory = "nonexistent_dir"
+        run_id_file = "%s/run-id.txt" % output_directory
+        self.assertFalse(os.path.isdir(output_directory))
+        target.__name__ = "__main__"
+        target.sys.argv = [
+            "scriptname.py",
+            "--input",
+            "tests/sample_files/input1.txt",
+            "--output-directory",
+            output_directory,
+            "--config",
+            "tests/sample_files/configuration1.xlsx",
+            "--delimiter",
+            "^",
+            "--skip-header",
+            "1",
+            "--skip-footer",
+            "1",
+            "--application-id",
+            "SE",
+            "--run-description",
+            "AAA",
+            "--billing-type",
+            "H",
+            "--run-id",
+            "123",
+            "--run-id-file",
+            run_id_file,
+            "--date-report",
+            "5",
+            "--max-rows-per-run",
+            "2",
+        ]
+        target.init()
+
+        # The Run ID file and 2 runs of metadata and detailed output files
+        self.assertEqual(num_files_in_directory(output_directory), 1 + 4)
+        with open(run_id_file) as f:
+            self.assertEqual("125", f.read())
+        with open("%s/SSE0123E" % output_directory) as f:
+            s = f.read()
+            self.assertEqual(
+                "SSEAAA                           2020030520200731H00000200123V1.11",
+                s[:66],
+            )
+        with open("%s/SSE0123D" % output_directory) as f:
+            s = f.read()
+            expected_output = (
+                "0004000133034205413540000100202007312006"
+                "                                        "
+                "Leendert MOLENDIJK [90038979]           \n"
+                "0004000133034005407940000157202003051022"
+                "                                        "
+                "Leendert MOLENDIJK [90038979]           "
+            )
+            self.assertEqual(expected_output, s)
+        with open("%s/SSE0124E" % output_directory) as f:
+            s = f.read()
+            self.assertEqual(
+                "SSEAAA                           2020122520201225H00000100124V1.11",
+                s[:66],
+            )
+        with open("%s/SSE0124D" % output_directory) as f:
+            s = f.read()
+            expected_output = (
+                "0004000133034105409340022139202012252006"
+                "                                        "
+                "Leendert MOLENDIJK [90038979]           "
+            )
+            self.assertEqual(expected_output, s)
         shutil.rmtree(output_directory)
         self.assertFalse(os.path.isdir(output_directory))
 
-    def test_init_no_run_id_nor_run_id_file(self):
+    def test_init_profile(self):
         """
-        Test the init code without --run-id nor --run-id-file
+        Test the init code printing the per-stage profile, and saving the cProfile
+        statistics of each input file
+        """
+        output_directory = "nonexistent_dir"
+        profile_directory = "%s/profile" % output_directory
+        self.assertFalse(os.path.isdir(output_directory))
+        target.__name__ = "__main__"
+        target.sys.argv = [
+            "scriptname.py",
+            "--input",
+            "tests/sample_files/input1.txt",
+            "--output-directory",
+            output_directory,
+            "--config",
+            "tests/sample_files/configuration1.xlsx",
+            "--delimiter",
+            "^",
+            "--skip-header",
+            "1",
+            "--skip-footer",
+            "1",
+            "--application-id",
+            "SE",
+            "--run-id",
+            "123",
+            "--profile",
+            profile_directory,
+        ]
+        f = io.StringIO()
+        with contextlib.redirect_stderr(f):
+            target.init()
+        summary = f.getvalue().splitlines()
+        self.assertEqual(
+            [line.split()[0] for line in summary[:-1]],
+            ["Stage", "arguments", "configuration", "conversion", "metadata", "total"],
+        )
+        self.assertEqual(
+            summary[-1],
+            "3 rows in 1 runs. The CPU time only includes the main process.",
+        )
+        stats_file = "%s/0123_input1.txt.pstats" % profile_directory
+        self.assertTrue(os.path.isfile(stats_file))
+        # The statistics file can be loaded with the pstats module
+        self.assertTrue(pstats.Stats(stats_file).total_calls > 0)
+        shutil.rmtree(output_directory)
+        self.assertFalse(os.path.isdir(output_directory))
+
+    def test_init_stdin_stdout(self):
+        """
+        Test streaming a compressed input from the standard input to the standard
+        output, the metadata file being written once the input has been converted
+        """
+        output_directory = "nonexistent_dir"
+        metadata_file_name = "%s/metadata.txt" % output_directory
+        self.assertFalse(os.path.isdir(output_directory))
+        pathlib.Path(output_directory).mkdir()
+        with open("tests/sample_files/input1.txt", "rb") as f:
+            compressed_input = gzip.compress(f.read())
+        result = subprocess.run(
+            [
+                sys.executable,
+                "billingflatfile.py",
+                "--input",
+                "-",
+                "--output",
+                "-",
+                "--metadata-output",
+                metadata_file_name,
+                "--config",
+                "tests/sample_files/configuration1.xlsx",
+                "--delimiter",
+                "^",
+                "--skip-header",
+                "1",
+                "--skip-footer",
+                "1",
+                "--application-id",
+                "SE",
+                "--run-id",
+                "123",
+                "--date-report",
+                "5",
+            ],
+            input=compressed_input,
+            stdout=subprocess.PIPE,
+            check=True,
+        )
+        with open("tests/sample_files/output.txt", "rb") as f:
+            self.assertEqual(f.read(), result.stdout)
+        with open(metadata_file_name) as f:
+            self.assertEqual(
+                "SSE                              2020030520201225 00000300123V1.11",
+                f.read()[:66],
+            )
+        shutil.rmtree(output_directory)
+        self.assertFalse(os.path.isdir(output_directory))
+
+    def test_init_invalid_value(self):
+        """
+        Test that a value that can't be converted is reported once, with the reason
+        """
+        input_directory = "nonexistent_input_dir"
+        input_file = "%s/input.txt" % input_directory
+        output_directory = "nonexistent_dir"
+        self.assertFalse(os.path.isdir(input_directory))
+        self.assertFalse(os.path.isdir(output_directory))
+        pathlib.Path(input_directory).mkdir()
+        with open("tests/sample_files/input1.txt") as f:
+            content = f.read()
+        with open(input_file, "w") as f:
+            f.write(content.replace("1.567", "1,567.0"))
+        target.__name__ = "__main__"
+        target.sys.argv = [
+            "scriptname.py",
+            "--input",
+            input_file,
+            "--output-directory",
+            output_directory,
+            "--config",
+            "tests/sample_files/configuration1.xlsx",
+            "--delimiter",
+            "^",
+            "--skip-header",
+            "1",
+            "--skip-footer",
+            "1",
+            "--application-id",
+            "SE",
+            "--run-id",
+            "1",
+        ]
+        with self.assertRaises(SystemExit) as cm1, self.assertLogs(
+            level="CRITICAL"
+        ) as cm2:
+            target.init()
+        self.assertEqual(cm1.exception.code, 19)
+        self.assertEqual(
+            cm2.output,
+            [
+                "CRITICAL:root:Invalid decimal format '1,567.0' in field 4 on row 2 "
+                "(ignoring the header). Exiting..."
+            ],
+        )
+        self.assertEqual(num_files_in_directory(output_directory), 0)
+        shutil.rmtree(input_directory)
+        shutil.rmtree(output_directory)
+        self.assertFalse(os.path.isdir(input_directory))
+        self.assertFalse(os.path.isdir(output_directory))
+
+    def test_init_validate_only(self):
+        """
+        Test checking an input file with invalid values, without writing any output
+        file nor using any Run ID
+        """
+        input_directory = "nonexistent_input_dir"
+        input_file = "%s/input.txt" % input_directory
+        output_directory = "nonexistent_dir"
+        self.assertFalse(os.path.isdir(input_directory))
+        self.assertFalse(os.path.isdir(output_directory))
+        pathlib.Path(input_directory).mkdir()
+        with open("tests/sample_files/input1.txt") as f:
+            lines = f.read().split("\n")
+        lines[2] = lines[2].replace("1.567", "1,567.0").replace("5/3/2020", "31/2/2020")
+        lines[3] = lines[3].replace("25/12/2020", "30/2/2020") + "^extra1^extra2"
+        with open(input_file, "w") as f:
+            f.write("\n".join(lines))
+        target.__name__ = "__main__"
+        target.sys.argv = [
+            "scriptname.py",
+            "--input",
+            input_file,
+            "--output-directory",
+            output_directory,
+            "--config",
+            "tests/sample_files/configuration1.xlsx",
+            "--delimiter",
+            "^",
+            "--skip-header",
+            "1",
+            "--skip-footer",
+            "1",
+            "--application-id",
+            "SE",
+            "--validate-only",
+        ]
+        with self.assertRaises(SystemExit) as cm1, self.assertLogs(
+            level="ERROR"
+        ) as cm2:
+            target.init()
+        self.assertEqual(cm1.exception.code, 247)
+        self.assertEqual(
+            cm2.output,
+            [
+                "ERROR:root:Input file %s: 3 rows, 4 invalid values found" % input_file,
+                "ERROR:root:Rows, too many fields on rows 3 (1 in total, ignoring the "
+                "header), e.g. 10 fields instead of 9",
+                "ERROR:root:Field 4 (Decimal), invalid decimal on rows 2 (1 in total, "
+                "ignoring the header), e.g. '1,567.0'",
+                "ERROR:root:Field 5 (Date (DD/MM/YYYY to YYYYMMDD)), invalid date on "
+                "rows 2, 3 (2 in total, ignoring the header), e.g. '31/2/2020'",
+                "CRITICAL:root:Invalid values found in 1 of the 1 input files. "
+                "Exiting...",
+            ],
+        )
+        self.assertFalse(os.path.isdir(output_directory))
+        shutil.rmtree(input_directory)
+        self.assertFalse(os.path.isdir(input_directory))
+
+    def test_init_input_directory_run_id_too_high(self):
+        """
+        Test the init code with valid parameters, multiple input files but
+        the Run ID becomes too high
         """
         input_directory = "tests/sample_files/multiple"
         output_directory = "nonexistent_dir"
@@ -1123,6 +1744,8 @@ class TestInit(unittest.TestCase):
             "AAA",
             "--billing-type",
             "H",
+            "--run-id",
+            "9998",
             "--txt-extension",
             "--locale",
             "fr_FR.utf8",
@@ -1136,25 +1759,20 @@ class TestInit(unittest.TestCase):
                 # On Windows, the French locale is just called "fr"
                 target.sys.argv[-1] = "fr"
                 target.init()
-        self.assertEqual(cm1.exception.code, 224)
+        self.assertEqual(cm1.exception.code, 223)
         self.assertEqual(
             cm2.output,
-            [
-                "CRITICAL:root:Either the `--run-id` or the `--run-id-file` arguments "
-                "must be specified. Exiting..."
-            ],
+            ["CRITICAL:root:The Run ID can't be higher than 9999. Exiting..."],
         )
         shutil.rmtree(output_directory)
         self.assertFalse(os.path.isdir(output_directory))
 
-    def test_init_new_run_id_file_no_run_id(self):
+    def test_init_move_input_files(self):
         """
-        Test the init code with multiple files, nonexisting --run-id-file and without
-        --run-id. Run ID will start at 0
+        Test the init code with valid parameters, multiple input files
         """
         input_directory = "tests/sample_files/multiple"
         output_directory = "nonexistent_dir"
-        run_id_file = "%s/run-id.txt" % output_directory
         self.assertEqual(num_files_in_directory(input_directory), 3)
         self.assertFalse(os.path.isdir(output_directory))
         target.__name__ = "__main__"
@@ -1164,6 +1782,7 @@ class TestInit(unittest.TestCase):
             input_directory,
             "--output-directory",
             output_directory,
+            "--move-input-files",
             "--overwrite-files",
             "--config",
             "tests/sample_files/configuration1.xlsx",
@@ -1179,8 +1798,8 @@ class TestInit(unittest.TestCase):
             "AAA",
             "--billing-type",
             "H",
-            "--run-id-file",
-            run_id_file,
+            "--run-id",
+            "123",
             "--txt-extension",
             "--locale",
             "fr_FR.utf8",
@@ -1193,7 +1812,154 @@ class TestInit(unittest.TestCase):
             target.init()
 
         self.assertTrue(os.path.isdir(output_directory))
-        self.assertTrue(os.path.isfile(run_id_file))
+        # The 3 input files and the 6 generated output files
+        self.assertEqual(num_files_in_directory(output_directory), 3 + 6)
+
+        for i in ("", "_copy1", "_copy2"):
+            # Move the input files back to the input directory
+            input_file = os.path.join(output_directory, "input1%s.txt" % i)
+            shutil.move(input_file, input_directory)
+
+        for run_id in (123, 124, 125):
+            # Confirm the output files have been written and their content
+            metadata_file_name = "%s/SSE0%dE.txt" % (output_directory, run_id)
+            self.assertTrue(os.path.isfile(metadata_file_name))
+            with open(metadata_file_name) as f:
+                s = f.read()
+                expected_output = (
+                    "SSEAAA                           "
+                    "9999999900000000H00000300%dV1.11                          "
+                    "                                                           "
+                    "                                                 " % run_id
+                )
+                self.assertEqual(expected_output, s)
+            # Remove the metadata output file
+            os.remove(metadata_file_name)
+            self.assertFalse(os.path.isfile(metadata_file_name))
+
+            detailed_file_name = "%s/SSE0%dD.txt" % (output_directory, run_id)
+            self.assertTrue(os.path.isfile(detailed_file_name))
+            with open(detailed_file_name) as f:
+                s = f.read()
+                expected_output = (
+                    "0004000133034205413540000100202007312006"
+                    "                                        "
+                    "Leendert MOLENDIJK [90038979]           \n"
+                    "0004000133034005407940000157202003051022"
+                    "                                        "
+                    "Leendert MOLENDIJK [90038979]           \n"
+                    "0004000133034105409340022139202012252006"
+                    "                                        "
+                    "Leendert MOLENDIJK [90038979]           "
+                )
+                self.assertEqual(expected_output, s)
+            # Remove the detailed output file
+            os.remove(detailed_file_name)
+            self.assertFalse(os.path.isfile(detailed_file_name))
+        shutil.rmtree(output_directory)
+        self.assertFalse(os.path.isdir(output_directory))
+
+    def test_init_no_run_id_nor_run_id_file(self):
+        """
+        Test the init code without --run-id nor --run-id-file
+        """
+        input_directory = "tests/sample_files/multiple"
+        output_directory = "nonexistent_dir"
+        self.assertEqual(num_files_in_directory(input_directory), 3)
+        self.assertFalse(os.path.isdir(output_directory))
+        target.__name__ = "__main__"
+        target.sys.argv = [
+            "scriptname.py",
+            "--input-directory",
+            input_directory,
+            "--output-directory",
+            output_directory,
+            "--overwrite-files",
+            "--config",
+            "tests/sample_files/configuration1.xlsx",
+            "--delimiter",
+            "^",
+            "--skip-header",
+            "1",
+            "--skip-footer",
+            "1",
+            "--application-id",
+            "SE",
+            "--run-description",
+            "AAA",
+            "--billing-type",
+            "H",
+            "--txt-extension",
+            "--locale",
+            "fr_FR.utf8",
+        ]
+        with self.assertRaises(SystemExit) as cm1, self.assertLogs(
+            level="CRITICAL"
+        ) as cm2:
+            try:
+                target.init()
+            except localeError:
+                # On Windows, the French locale is just called "fr"
+                target.sys.argv[-1] = "fr"
+                target.init()
+        self.assertEqual(cm1.exception.code, 224)
+        self.assertEqual(
+            cm2.output,
+            [
+                "CRITICAL:root:Either the `--run-id` or the `--run-id-file` arguments "
+                "must be specified. Exiting..."
+            ],
+        )
+        shutil.rmtree(output_directory)
+        self.assertFalse(os.path.isdir(output_directory))
+
+    def test_init_new_run_id_file_no_run_id(self):
+        """
+        Test the init code with multiple files, nonexisting --run-id-file and without
+        --run-id. Run ID will start at 0
+        """
+        input_directory = "tests/sample_files/multiple"
+        output_directory = "nonexistent_dir"
+        run_id_file = "%s/run-id.txt" % output_directory
+        self.assertEqual(num_files_in_directory(input_directory), 3)
+        self.assertFalse(os.path.isdir(output_directory))
+        target.__name__ = "__main__"
+        target.sys.argv = [
+            "scriptname.py",
+            "--input-directory",
+            input_directory,
+            "--output-directory",
+            output_directory,
+            "--overwrite-files",
+            "--config",
+            "tests/sample_files/configuration1.xlsx",
+            "--delimiter",
+            "^",
+            "--skip-header",
+            "1",
+            "--skip-footer",
+            "1",
+            "--application-id",
+            "SE",
+            "--run-description",
+            "AAA",
+            "--billing-type",
+            "H",
+            "--run-id-file",
+            run_id_file,
+            "--txt-extension",
+            "--locale",
+            "fr_FR.utf8",
+        ]
+        try:
+            target.init()
+        except localeError:
+            # On Windows, the French locale is just called "fr"
+            target.sys.argv[-1] = "fr"
+            target.init()
+
+        self.assertTrue(os.path.isdir(output_directory))
+        self.assertTrue(os.path.isfile(run_id_file))
         # The Run ID file and the 6 generated output files
         self.assertEqual(num_files_in_directory(output_directory), 1 + 6)
         with open(run_id_file) as f:
@@ -1584,6 +2350,1125 @@ class TestInit(unittest.TestCase):
         self.assertFalse(os.path.isdir(output_directory))
 
 
+class TestWatch(unittest.TestCase):
+    def test_parse_args_watch_without_input_directory(self):
+        """
+        Test the --watch argument with a single input file
+        """
+        with self.assertRaises(SystemExit) as cm1, self.assertLogs(
+            level="CRITICAL"
+        ) as cm2:
+            target.parse_args(
+                [
+                    "--input",
+                    "tests/sample_files/input1.txt",
+                    "--output-directory",
+                    "data",
+                    "--config",
+                    "tests/sample_files/configuration1.xlsx",
+                    "--application-id",
+                    "SE",
+                    "--run-id",
+                    "123",
+                    "--watch",
+                ]
+            )
+        self.assertEqual(cm1.exception.code, 231)
+        self.assertEqual(
+            cm2.output,
+            [
+                "CRITICAL:root:The `--watch` argument can only be used in combination "
+                "with the `--input-directory` argument. Exiting..."
+            ],
+        )
+
+    def test_watch_input_directory(self):
+        """
+        Test that the new files are only processed once they stopped changing,
+        keeping the Run ID in memory between batches
+        """
+        input_directory = "nonexistent_input_dir"
+        output_directory = "nonexistent_dir"
+        run_id_file = "%s/run-id.txt" % output_directory
+        self.assertFalse(os.path.isdir(input_directory))
+        self.assertFalse(os.path.isdir(output_directory))
+        pathlib.Path(input_directory).mkdir()
+        shutil.copy("tests/sample_files/input1.txt", input_directory)
+        args = target.parse_args(
+            [
+                "--input-directory",
+                input_directory,
+                "--output-directory",
+                output_directory,
+                "--config",
+                "tests/sample_files/configuration1.xlsx",
+                "--delimiter",
+                "^",
+                "--skip-header",
+                "1",
+                "--skip-footer",
+                "1",
+                "--application-id",
+                "SE",
+                "--run-id",
+                "123",
+                "--run-id-file",
+                run_id_file,
+                "--move-input-files",
+                "--watch",
+                "--watch-interval",
+                "0",
+            ]
+        )
+        config = target.load_config(args.config)
+
+        # The file has only been seen once, it could still be being written
+        run_id = target.watch_input_directory(args, config, max_polls=1)
+        self.assertEqual(run_id, 123)
+        self.assertEqual(num_files_in_directory(output_directory), 0)
+
+        run_id = target.watch_input_directory(args, config, max_polls=2)
+        self.assertEqual(run_id, 124)
+        self.assertEqual(num_files_in_directory(input_directory), 0)
+        # The moved input file, the Run ID file and the 2 generated output files
+        self.assertEqual(num_files_in_directory(output_directory), 1 + 1 + 2)
+        with open(run_id_file) as f:
+            self.assertEqual("124", f.read())
+        self.assertTrue(os.path.isfile("%s/SSE0123D" % output_directory))
+        self.assertTrue(os.path.isfile("%s/SSE0123E" % output_directory))
+
+        shutil.rmtree(input_directory)
+        shutil.rmtree(output_directory)
+        self.assertFalse(os.path.isdir(input_directory))
+        self.assertFalse(os.path.isdir(output_directory))
+
+    def test_watch_input_directory_failure(self):
+        """
+        Test that a file that can't be converted doesn't stop watching, nor the
+        conversion of the other files
+        """
+        input_directory = "nonexistent_input_dir"
+        output_directory = "nonexistent_dir"
+        run_id_file = "%s/run-id.txt" % output_directory
+        self.assertFalse(os.path.isdir(input_directory))
+        self.assertFalse(os.path.isdir(output_directory))
+        pathlib.Path(input_directory).mkdir()
+        shutil.copy("tests/sample_files/input1.txt", input_directory)
+        invalid_input_file = "%s/invalid.txt" % input_directory
+        with open("tests/sample_files/input1.txt") as f:
+            content = f.read().replace("31/7/2020", "31/13/2020")
+        with open(invalid_input_file, "w") as ofile:
+            ofile.write(content)
+        args = target.make_args(
+            input_directory=input_directory,
+            output_directory=output_directory,
+            config="tests/sample_files/configuration1.xlsx",
+            delimiter="^",
+            skip_header=1,
+            skip_footer=1,
+            application_id="SE",
+            run_id=123,
+            run_id_file=run_id_file,
+            watch=True,
+            watch_interval=0,
+        )
+        config = target.load_config(args.config)
+
+        with self.assertLogs(level="ERROR") as cm:
+            run_id = target.watch_input_directory(args, config, max_polls=3)
+        self.assertEqual(
+            [line for line in cm.output if line.startswith("ERROR:")],
+            [
+                "ERROR:root:Input file %s could not be processed: Invalid date value "
+                "'31/13/2020' for format 'Date (DD/MM/YYYY to YYYYMMDD)' in field 5 on "
+                "row 1 (ignoring the header)." % invalid_input_file
+            ],
+        )
+        # The Run ID taken by the invalid file isn't used again
+        self.assertEqual(run_id, 125)
+        with open(run_id_file) as f:
+            self.assertEqual("125", f.read())
+        metadata_files = [
+            name for name in os.listdir(output_directory) if name.endswith("E")
+        ]
+        self.assertEqual(len(metadata_files), 1)
+
+        shutil.rmtree(input_directory)
+        shutil.rmtree(output_directory)
+        self.assertFalse(os.path.isdir(input_directory))
+        self.assertFalse(os.path.isdir(output_directory))
+
+
+class TestPipeline(unittest.TestCase):
+    def test_iterate_in_background(self):
+        """
+        Test that the items are handed over in order, and the exceptions raised again
+        """
+        self.assertEqual(
+            list(target.iterate_in_background(range(25), batch_size=10)),
+            list(range(25)),
+        )
+
+        def failing_lines():
+            yield "first line"
+            raise ValueError("Unreadable line")
+
+        lines = target.iterate_in_background(failing_lines())
+        self.assertEqual(next(lines), "first line")
+        with self.assertRaises(ValueError):
+            next(lines)
+
+    def test_write_in_background(self):
+        """
+        Test that the buffered content is completely written, and the exceptions
+        raised again
+        """
+        f = io.StringIO()
+        with target.write_in_background(f, buffer_size=10) as write:
+            for idx in range(25):
+                write("%d\n" % idx)
+        self.assertEqual(f.getvalue(), "".join("%d\n" % idx for idx in range(25)))
+
+        f.close()
+        with self.assertRaises(ValueError):
+            with target.write_in_background(f) as write:
+                write("closed file")
+
+    def test_process_batch_pipeline(self):
+        """
+        Test that the pipelined conversion gives the same output as a serial one
+        """
+        output_directory = "nonexistent_dir"
+        self.assertFalse(os.path.isdir(output_directory))
+        options = {
+            "input_directory": "tests/sample_files/multiple",
+            "output_directory": output_directory,
+            "config": "tests/sample_files/configuration1.xlsx",
+            "delimiter": "^",
+            "skip_header": 1,
+            "skip_footer": 1,
+            "application_id": "SE",
+            "run_id": 1,
+            "pipeline": True,
+        }
+        with open("tests/sample_files/output.txt") as f:
+            expected_output = f.read()
+        batch = target.process_batch(**options)
+        self.assertEqual([run.num_input_rows for run in batch.runs], [3, 3, 3])
+        for run in batch.runs:
+            with open(run.detailed_file) as f:
+                self.assertEqual(expected_output, f.read())
+        batch = target.process_batch(
+            max_rows_per_run=2, overwrite_files=True, **options
+        )
+        self.assertEqual([run.num_input_rows for run in batch.runs], [2, 1] * 3)
+        with open(batch.runs[0].detailed_file) as f:
+            self.assertEqual(expected_output.split("\n")[:2], f.read().split("\n"))
+        shutil.rmtree(output_directory)
+        self.assertFalse(os.path.isdir(output_directory))
+
+
+class TestApi(unittest.TestCase):
+    def test_process_file(self):
+        """
+        Test converting a single file with the importable API
+        """
+        output_directory = "nonexistent_dir"
+        self.assertFalse(os.path.isdir(output_directory))
+        results = target.process_file(
+            "tests/sample_files/input1.txt",
+            output_directory=output_directory,
+            config="tests/sample_files/configuration1.xlsx",
+            delimiter="^",
+            skip_header=1,
+            skip_footer=1,
+            application_id="SE",
+            run_id=123,
+            date_report=5,
+            divert=["4,1.567"],
+        )
+        self.assertEqual(len(results), 1)
+        result = results[0]
+        self.assertEqual(result.input_file, "tests/sample_files/input1.txt")
+        self.assertEqual(result.run_id, "0123")
+        self.assertEqual(result.num_input_rows, 3)
+        self.assertEqual(result.oldest_date, "20200305")
+        self.assertEqual(result.most_recent_date, "20201225")
+        self.assertEqual(result.metadata_file, "%s/SSE0123E" % output_directory)
+        self.assertEqual(result.detailed_file, "%s/SSE0123D" % output_directory)
+        self.assertEqual(
+            result.diverted_file, "%s/SSE0123D_diverted" % output_directory
+        )
+        self.assertEqual(sorted(result.timings), ["conversion", "metadata", "total"])
+        self.assertEqual(sorted(result.timings["total"]), ["cpu", "wall"])
+        # The metadata, detailed and diverted output files
+        self.assertEqual(num_files_in_directory(output_directory), 3)
+        shutil.rmtree(output_directory)
+        self.assertFalse(os.path.isdir(output_directory))
+
+    def test_process_batch(self):
+        """
+        Test converting a batch of files with the importable API, and the typed
+        exceptions raised instead of exiting
+        """
+        output_directory = "nonexistent_dir"
+        run_id_file = "%s/run-id.txt" % output_directory
+        self.assertFalse(os.path.isdir(output_directory))
+        options = {
+            "output_directory": output_directory,
+            "config": "tests/sample_files/configuration1.xlsx",
+            "delimiter": "^",
+            "skip_header": 1,
+            "skip_footer": 1,
+            "application_id": "SE",
+            "run_id_file": run_id_file,
+        }
+        batch = target.process_batch(["tests/sample_files/input1.txt"] * 2, **options)
+        self.assertEqual([run.run_id for run in batch.runs], ["0000", "0001"])
+        self.assertEqual([run.num_input_rows for run in batch.runs], [3, 3])
+        self.assertEqual([run.diverted_file for run in batch.runs], [None, None])
+        self.assertEqual(batch.next_run_id, 2)
+        self.assertEqual(sorted(batch.timings), ["configuration", "total"])
+        with open(run_id_file) as f:
+            self.assertEqual("2", f.read())
+
+        with self.assertRaises(target.OutputFileExistsError) as cm:
+            target.process_batch(["tests/sample_files/input1.txt"], run_id=1, **options)
+        self.assertEqual(cm.exception.exit_code, 219)
+        with self.assertRaises(target.InvalidArgumentError) as cm:
+            target.process_batch(["tests/sample_files/input1.txt"], jobs=0, **options)
+        self.assertEqual(cm.exception.exit_code, 227)
+        with self.assertRaises(target.InvalidArgumentError) as cm:
+            target.process_batch(
+                ["tests/sample_files/input1.txt"], invalid=1, **options
+            )
+        self.assertEqual(str(cm.exception), "Unknown option(s): 'invalid'.")
+        shutil.rmtree(output_directory)
+        self.assertFalse(os.path.isdir(output_directory))
+
+    def test_process_batch_parallel_failure(self):
+        """
+        Test that the Run IDs of the files converted by the workers are saved when
+        another file of the batch fails
+        """
+        output_directory = "nonexistent_dir"
+        run_id_file = "%s/run-id.txt" % output_directory
+        self.assertFalse(os.path.isdir(output_directory))
+        pathlib.Path(output_directory, "input").mkdir(parents=True)
+        invalid_input_file = "%s/input/invalid.txt" % output_directory
+        with open("tests/sample_files/input1.txt") as f:
+            content = f.read().replace("31/7/2020", "31/13/2020")
+        with open(invalid_input_file, "w") as ofile:
+            ofile.write(content)
+        with self.assertRaises(target.ConversionError):
+            target.process_batch(
+                [
+                    "tests/sample_files/input1.txt",
+                    invalid_input_file,
+                    "tests/sample_files/input1.txt",
+                ],
+                output_directory=output_directory,
+                config="tests/sample_files/configuration1.xlsx",
+                delimiter="^",
+                skip_header=1,
+                skip_footer=1,
+                application_id="SE",
+                run_id=123,
+                run_id_file=run_id_file,
+                jobs=3,
+            )
+        # The third file has been converted, its Run ID won't be used again
+        self.assertTrue(os.path.isfile("%s/SSE0125D" % output_directory))
+        with open(run_id_file) as f:
+            self.assertEqual("126", f.read())
+        shutil.rmtree(output_directory)
+        self.assertFalse(os.path.isdir(output_directory))
+
+    def test_process_file_compressed(self):
+        """
+        Test converting compressed input files, moved once converted
+        """
+        output_directory = "nonexistent_dir"
+        self.assertFalse(os.path.isdir(output_directory))
+        pathlib.Path(output_directory).mkdir()
+        with open("tests/sample_files/input1.txt", "rb") as f:
+            content = f.read()
+        compressed_files = []
+        for (compression, module) in (("gz", gzip), ("bz2", bz2), ("xz", lzma)):
+            # Named without extension, the compression is detected on the content
+            compressed_file = "%s/input1_%s" % (output_directory, compression)
+            with module.open(compressed_file, "wb") as f:
+                f.write(content)
+            compressed_files.append(compressed_file)
+            self.assertEqual(
+                target.detect_compression(compressed_file),
+                {"gz": "gzip"}.get(compression, compression),
+            )
+        self.assertIsNone(target.detect_compression("tests/sample_files/input1.txt"))
+        batch = target.process_batch(
+            compressed_files,
+            output_directory="%s/output" % output_directory,
+            config="tests/sample_files/configuration1.xlsx",
+            delimiter="^",
+            skip_header=1,
+            skip_footer=1,
+            application_id="SE",
+            run_id=1,
+            move_input_files=True,
+        )
+        self.assertEqual([run.num_input_rows for run in batch.runs], [3, 3, 3])
+        with open("tests/sample_files/output.txt") as f:
+            expected_output = f.read()
+        for run in batch.runs:
+            with open(run.detailed_file) as f:
+                self.assertEqual(expected_output, f.read())
+        # The 3 moved input files and the 3 pairs of output files
+        self.assertEqual(num_files_in_directory("%s/output" % output_directory), 9)
+        shutil.rmtree(output_directory)
+        self.assertFalse(os.path.isdir(output_directory))
+
+    def test_process_file_failure(self):
+        """
+        Test that a failed conversion doesn't leave a partial detailed output file
+        behind, so that it can be run again once the input file is fixed
+        """
+        output_directory = "nonexistent_dir"
+        self.assertFalse(os.path.isdir(output_directory))
+        pathlib.Path(output_directory).mkdir()
+        input_file = "%s/input.txt" % output_directory
+        with open("tests/sample_files/input1.txt") as f:
+            content = f.read()
+        with open(input_file, "w") as ofile:
+            ofile.write(content.replace("25/12/2020", "25/13/2020"))
+        options = {
+            "output_directory": "%s/output" % output_directory,
+            "config": "tests/sample_files/configuration1.xlsx",
+            "delimiter": "^",
+            "skip_header": 1,
+            "skip_footer": 1,
+            "application_id": "SE",
+            "run_id": 1,
+            "divert": ["5,5/3/2020"],
+        }
+        for extra_options in ({}, {"pipeline": True}, {"max_rows_per_run": 5}):
+            with self.assertRaises(target.ConversionError), self.assertLogs():
+                target.process_file(input_file, **options, **extra_options)
+            self.assertEqual(os.listdir("%s/output" % output_directory), [])
+        with open(input_file, "w") as ofile:
+            ofile.write(content)
+        results = target.process_file(input_file, **options)
+        self.assertEqual(results[0].num_input_rows, 3)
+        shutil.rmtree(output_directory)
+        self.assertFalse(os.path.isdir(output_directory))
+
+    def test_process_file_checkpoint(self):
+        """
+        Test resuming an interrupted conversion from its last checkpoint
+        """
+        output_directory = "nonexistent_dir"
+        self.assertFalse(os.path.isdir(output_directory))
+        pathlib.Path(output_directory).mkdir()
+        input_file = "%s/extract.txt" % output_directory
+        benchmark.generate_extract(input_file, 10)
+        options = {
+            "output_directory": "%s/output" % output_directory,
+            "config": benchmark.CONFIG,
+            "delimiter": "^",
+            "skip_header": 1,
+            "skip_footer": 1,
+            "application_id": "BE",
+            "date_report": 5,
+        }
+        target.process_file(input_file, run_id=2, **options)
+        with open("%s/output/SBE0002D" % output_directory) as f:
+            expected_output = f.read()
+
+        compile_row_converter = target.compile_row_converter
+
+        def crashing_compile_row_converter(*args):
+            convert_row = compile_row_converter(*args)
+
+            def crashing_convert_row(row, idx_row):
+                if idx_row == 8:
+                    raise RuntimeError("Crash on row 8")
+                return convert_row(row, idx_row)
+
+            return crashing_convert_row
+
+        with mock.patch.object(
+            target, "compile_row_converter", crashing_compile_row_converter
+        ):
+            with self.assertRaises(RuntimeError):
+                target.process_file(input_file, run_id=1, checkpoint=3, **options)
+        checkpoint_file = "%s/output/SBE0001D.checkpoint" % output_directory
+        with open(checkpoint_file) as f:
+            self.assertEqual(json.load(f)["rows"], 6)
+
+        with self.assertLogs(level="INFO") as cm:
+            results = target.process_file(input_file, run_id=1, checkpoint=3, **options)
+        self.assertIn(
+            "INFO:root:Resuming the conversion of %s after 6 rows" % input_file,
+            cm.output,
+        )
+        self.assertEqual(results[0].num_input_rows, 10)
+        with open("%s/output/SBE0002E" % output_directory) as f:
+            expected_metadata = f.read()[33:]
+        with open("%s/output/SBE0001E" % output_directory) as f:
+            self.assertEqual(expected_metadata.replace("0002", "0001"), f.read()[33:])
+        with open("%s/output/SBE0001D" % output_directory) as f:
+            self.assertEqual(expected_output, f.read())
+        self.assertFalse(os.path.isfile(checkpoint_file))
+        shutil.rmtree(output_directory)
+        self.assertFalse(os.path.isdir(output_directory))
+
+    def test_process_batch_journal(self):
+        """
+        Test that a rerun skips the input files recorded in the journal, and
+        continues the numbering after their Run IDs
+        """
+        output_directory = "nonexistent_dir"
+        journal_file = "%s/journal.jsonl" % output_directory
+        self.assertFalse(os.path.isdir(output_directory))
+        pathlib.Path(output_directory).mkdir()
+        input_files = []
+        for idx in range(3):
+            input_file = "%s/input%d.txt" % (output_directory, idx)
+            shutil.copy("tests/sample_files/input1.txt", input_file)
+            input_files.append(input_file)
+        options = {
+            "output_directory": "%s/output" % output_directory,
+            "config": "tests/sample_files/configuration1.xlsx",
+            "delimiter": "^",
+            "skip_header": 1,
+            "skip_footer": 1,
+            "application_id": "SE",
+            "run_id": 7,
+            "journal": journal_file,
+        }
+        batch = target.process_batch(input_files[:2], **options)
+        self.assertEqual([run.run_id for run in batch.runs], ["0007", "0008"])
+        with open(journal_file) as f:
+            entries = [json.loads(line) for line in f]
+        self.assertEqual(
+            [entry["input_file"] for entry in entries],
+            [os.path.abspath(input_file) for input_file in input_files[:2]],
+        )
+        self.assertEqual(
+            entries[1]["runs"],
+            [
+                {
+                    "run_id": "0008",
+                    "metadata_file": "%s/output/SSE0008E" % output_directory,
+                    "detailed_file": "%s/output/SSE0008D" % output_directory,
+                }
+            ],
+        )
+
+        # Rerun with the same initial Run ID, as if it had not been saved, after a
+        # crash in the middle of the third input file
+        detailed_file = "%s/output/SSE0009D" % output_directory
+        for file_name in (detailed_file, "%s_diverted" % detailed_file):
+            with open(file_name, "w") as ofile:
+                ofile.write("0004000133034205413540000100")
+        with self.assertLogs(level="WARNING") as cm:
+            batch = target.process_batch(input_files, **options)
+        self.assertEqual(
+            cm.output,
+            [
+                "WARNING:root:Removing the detailed output file '%s' of an "
+                "interrupted conversion" % detailed_file
+            ],
+        )
+        self.assertEqual([run.input_file for run in batch.runs], input_files[2:])
+        self.assertEqual([run.run_id for run in batch.runs], ["0009"])
+        self.assertEqual(batch.next_run_id, 10)
+        self.assertEqual(os.path.getsize(detailed_file), 362)
+        self.assertFalse(os.path.isfile("%s_diverted" % detailed_file))
+        shutil.rmtree(output_directory)
+        self.assertFalse(os.path.isdir(output_directory))
+
+    def test_process_batch_dedup_index(self):
+        """
+        Test skipping, then flagging, the input files with the same content as an
+        already converted file
+        """
+        output_directory = "nonexistent_dir"
+        dedup_index = "%s/dedup.sqlite" % output_directory
+        self.assertFalse(os.path.isdir(output_directory))
+        options = {
+            "output_directory": output_directory,
+            "config": "tests/sample_files/configuration1.xlsx",
+            "delimiter": "^",
+            "skip_header": 1,
+            "skip_footer": 1,
+            "application_id": "SE",
+            "dedup_index": dedup_index,
+        }
+        input_files = sorted(
+            os.path.join("tests/sample_files/multiple", input_file)
+            for input_file in os.listdir("tests/sample_files/multiple")
+        )
+        with self.assertLogs(level="WARNING") as cm:
+            batch = target.process_batch(input_files, run_id=1, **options)
+        self.assertEqual([run.input_file for run in batch.runs], input_files[:1])
+        self.assertEqual(
+            cm.output,
+            [
+                "WARNING:root:Skipping input file %s, it has the same content as %s"
+                % (input_file, input_files[0])
+                for input_file in input_files[1:]
+            ],
+        )
+
+        # Already converted in a previous batch
+        with self.assertLogs(level="WARNING") as cm:
+            batch = target.process_batch(
+                ["tests/sample_files/input1.txt"],
+                run_id=2,
+                on_duplicate="flag",
+                **options,
+            )
+        self.assertEqual([run.run_id for run in batch.runs], ["0002"])
+        self.assertEqual(
+            cm.output,
+            [
+                "WARNING:root:Input file tests/sample_files/input1.txt has the same "
+                "content as %s (Run ID 0001)" % os.path.abspath(input_files[0])
+            ],
+        )
+        shutil.rmtree(output_directory)
+        self.assertFalse(os.path.isdir(output_directory))
+
+    def test_process_batch_run_id_lease(self):
+        """
+        Test leasing the Run IDs from a Run ID file shared with other processes
+        """
+        output_directory = "nonexistent_dir"
+        run_id_file = "%s/run-id.txt" % output_directory
+        self.assertFalse(os.path.isdir(output_directory))
+        os.makedirs(output_directory)
+        with open(run_id_file, "w") as ofile:
+            ofile.write("7")
+        options = {
+            "output_directory": output_directory,
+            "config": "tests/sample_files/configuration1.xlsx",
+            "delimiter": "^",
+            "skip_header": 1,
+            "skip_footer": 1,
+            "application_id": "SE",
+            "run_id_file": run_id_file,
+        }
+        batch = target.process_batch(
+            ["tests/sample_files/input1.txt"], run_id_lease=5, **options
+        )
+        self.assertEqual([run.run_id for run in batch.runs], ["0007"])
+        # The unused Run IDs of the block have been returned
+        with open(run_id_file) as f:
+            self.assertEqual(f.read(), "8")
+
+        # Another process leases Run IDs 8 to 10 and returns 8 and 9 after a third
+        # process leased Run ID 11: this block of 2 Run IDs is leased again
+        self.assertEqual(target.lease_run_ids(run_id_file, 3), (8, 11))
+        self.assertEqual(target.lease_run_ids(run_id_file, 1), (11, 12))
+        target.release_run_ids(run_id_file, 8, 10)
+        batch = target.process_batch(
+            ["tests/sample_files/input1.txt"],
+            run_id_lease=2,
+            max_rows_per_run=2,
+            overwrite_files=True,
+            **options,
+        )
+        self.assertEqual([run.run_id for run in batch.runs], ["0008", "0009"])
+        with open(run_id_file) as f:
+            self.assertEqual(f.read(), "12")
+        with open("%s.free" % run_id_file) as f:
+            self.assertEqual(json.load(f), [])
+
+        # The lock is held by another process, or left behind by a crashed one
+        lock_file = "%s.lock" % run_id_file
+        with open(lock_file, "w") as ofile:
+            ofile.write("otherhost 1234\n")
+        with mock.patch.object(target, "RUN_ID_LOCK_TIMEOUT", 0):
+            with self.assertRaises(target.RunIdError) as cm:
+                target.lease_run_ids(run_id_file, 1)
+        self.assertEqual(cm.exception.exit_code, 244)
+        os.utime(lock_file, (0, 0))
+        with self.assertLogs(level="WARNING") as cm:
+            self.assertEqual(target.lease_run_ids(run_id_file, 1), (12, 13))
+        self.assertEqual(
+            cm.output, ["WARNING:root:Removed stale lock file %s" % lock_file]
+        )
+        self.assertFalse(os.path.isfile(lock_file))
+        # A lock file created by another process after the stale one was found is
+        # left in place
+        with open(lock_file, "w") as ofile:
+            ofile.write("otherhost 1234\n")
+        os.utime(lock_file, (0, 0))
+        stale_identity = target.get_lock_identity(lock_file)
+        os.remove(lock_file)
+        with open(lock_file, "w") as ofile:
+            ofile.write("otherhost 5678\n")
+        self.assertFalse(target.remove_lock_file(lock_file, stale_identity))
+        with open(lock_file) as f:
+            self.assertEqual(f.read(), "otherhost 5678\n")
+        os.remove(lock_file)
+        self.assertEqual(
+            sorted(os.listdir(output_directory)),
+            ["SSE0007D", "SSE0007E", "SSE0008D", "SSE0008E", "SSE0009D"]
+            + ["SSE0009E", "run-id.txt", "run-id.txt.free"],
+        )
+
+        # The Run IDs returned in small blocks are merged, and leased again even
+        # when the block is smaller than the requested lease
+        self.assertEqual(target.lease_run_ids(run_id_file, 4), (13, 17))
+        self.assertEqual(target.lease_run_ids(run_id_file, 1), (17, 18))
+        target.release_run_ids(run_id_file, 14, 15)
+        target.release_run_ids(run_id_file, 13, 14)
+        target.release_run_ids(run_id_file, 16, 17)
+        with open("%s.free" % run_id_file) as f:
+            self.assertEqual(json.load(f), [[13, 15], [16, 17]])
+        self.assertEqual(target.lease_run_ids(run_id_file, 1, 5), (13, 15))
+        # Returning the last leased Run ID also takes back the free block before it
+        target.release_run_ids(run_id_file, 17, 18)
+        with open(run_id_file) as f:
+            self.assertEqual(f.read(), "16")
+        with open("%s.free" % run_id_file) as f:
+            self.assertEqual(json.load(f), [])
+
+        # The leased block is cut short at Run ID 9999
+        with open(run_id_file, "w") as ofile:
+            ofile.write("9950")
+        batch = target.process_batch(
+            ["tests/sample_files/input1.txt"], run_id_lease=100, **options
+        )
+        self.assertEqual([run.run_id for run in batch.runs], ["9950"])
+        with open(run_id_file) as f:
+            self.assertEqual(f.read(), "9951")
+        self.assertEqual(target.lease_run_ids(run_id_file, 2, 100), (9951, 10000))
+        with self.assertRaises(target.RunIdError) as cm:
+            target.lease_run_ids(run_id_file, 1, 100)
+        self.assertEqual(cm.exception.exit_code, 223)
+        shutil.rmtree(output_directory)
+        self.assertFalse(os.path.isdir(output_directory))
+
+    def test_process_file_divert_file(self):
+        """
+        Test diverting the rows on values listed in a file, combined with the
+        `divert` option
+        """
+        output_directory = "nonexistent_dir"
+        divert_file = "%s/divert.txt" % output_directory
+        self.assertFalse(os.path.isdir(output_directory))
+        pathlib.Path(output_directory).mkdir()
+        with open(divert_file, "w") as f:
+            f.write("1.567\n\n999\n")
+        self.assertEqual(
+            target.validate_divert(["4,221.392", "2,1330342"], ["4,%s" % divert_file]),
+            {2: {"1330342"}, 4: {"221.392", "1.567", "999"}},
+        )
+        results = target.process_file(
+            "tests/sample_files/input1.txt",
+            output_directory=output_directory,
+            config="tests/sample_files/configuration1.xlsx",
+            delimiter="^",
+            skip_header=1,
+            skip_footer=1,
+            application_id="SE",
+            run_id=1,
+            divert=["4,221.392"],
+            divert_file=["4,%s" % divert_file],
+        )
+        with open("tests/sample_files/output.txt") as f:
+            expected_output = f.read().split("\n")
+        with open(results[0].detailed_file) as f:
+            self.assertEqual(expected_output[0], f.read())
+        with open(results[0].diverted_file) as f:
+            self.assertEqual("\n".join(expected_output[1:]), f.read())
+
+        with self.assertRaises(target.InvalidArgumentError) as cm:
+            target.validate_divert([], ["4,%s/missing.txt" % output_directory])
+        self.assertEqual(cm.exception.exit_code, 252)
+        shutil.rmtree(output_directory)
+        self.assertFalse(os.path.isdir(output_directory))
+
+    def test_process_file_on_error(self):
+        """
+        Test writing the rows that can't be converted to a rejects file, while the
+        other rows keep being converted
+        """
+        output_directory = "nonexistent_dir"
+        input_file = "%s/input.txt" % output_directory
+        self.assertFalse(os.path.isdir(output_directory))
+        pathlib.Path(output_directory).mkdir()
+        with open("tests/sample_files/input1.txt") as f:
+            lines = f.read().split("\n")
+        invalid_row = lines[2].replace("1.567", "1,567.0")
+        lines[2] = invalid_row
+        with open(input_file, "w") as f:
+            f.write("\n".join(lines))
+        options = {
+            "output_directory": output_directory,
+            "config": "tests/sample_files/configuration1.xlsx",
+            "delimiter": "^",
+            "skip_header": 1,
+            "skip_footer": 1,
+            "application_id": "SE",
+            "run_id": 1,
+        }
+        with self.assertLogs(level="WARNING") as cm:
+            results = target.process_file(input_file, on_error="divert", **options)
+        rejects_file = "%s/SSE0001D_rejects" % output_directory
+        self.assertEqual(
+            cm.output,
+            [
+                "WARNING:root:1 rows of input file %s could not be converted, see %s"
+                % (input_file, rejects_file)
+            ],
+        )
+        self.assertEqual(results[0].num_input_rows, 2)
+        self.assertEqual(results[0].rejects_file, rejects_file)
+        with open(rejects_file) as f:
+            self.assertEqual(
+                "2^Invalid decimal format '1,567.0' in field 4 on row 2 (ignoring the "
+                "header).^%s\n" % invalid_row,
+                f.read(),
+            )
+        with open("tests/sample_files/output.txt") as f:
+            expected_output = f.read().split("\n")
+        with open(results[0].detailed_file) as f:
+            self.assertEqual(
+                "\n".join([expected_output[0], expected_output[2]]), f.read()
+            )
+
+        # The input file fails once all its rows have been read
+        shutil.rmtree(output_directory)
+        pathlib.Path(output_directory).mkdir()
+        with open(input_file, "w") as f:
+            f.write("\n".join(lines))
+        with self.assertRaises(target.ConversionError) as cm:
+            target.process_file(input_file, on_error="collect", **options)
+        self.assertEqual(cm.exception.exit_code, 250)
+        self.assertTrue(os.path.isfile(rejects_file))
+        self.assertFalse(os.path.isfile("%s/SSE0001E" % output_directory))
+        shutil.rmtree(output_directory)
+        self.assertFalse(os.path.isdir(output_directory))
+
+    def test_process_file_on_error_reasons(self):
+        """
+        Test that the rejects file gives the reason why each row could not be
+        converted
+        """
+        output_directory = "nonexistent_dir"
+        input_file = "%s/input.txt" % output_directory
+        self.assertFalse(os.path.isdir(output_directory))
+        pathlib.Path(output_directory).mkdir()
+        with open("tests/sample_files/input1.txt") as f:
+            lines = f.read().split("\n")
+        rows = [
+            lines[1].replace("31/7/2020", "31/13/2020"),
+            lines[2].replace("10:22", "10h22"),
+            lines[3] + "^extra1^extra2",
+            lines[1].replace("Leendert MOLENDIJK", "L" * 40),
+            lines[2].replace("1.567", "1,567.0"),
+            lines[3],
+        ]
+        with open(input_file, "w") as f:
+            f.write("\n".join([lines[0]] + rows + [lines[4]]))
+        with self.assertLogs(level="WARNING"):
+            results = target.process_file(
+                input_file,
+                output_directory=output_directory,
+                config="tests/sample_files/configuration1.xlsx",
+                delimiter="^",
+                skip_header=1,
+                skip_footer=1,
+                application_id="SE",
+                run_id=1,
+                on_error="divert",
+            )
+        self.assertEqual(results[0].num_input_rows, 1)
+        with open(results[0].rejects_file) as f:
+            reasons = [line.split("^")[:2] for line in f.read().splitlines()]
+        self.assertEqual(
+            reasons,
+            [
+                [
+                    "1",
+                    "Invalid date value '31/13/2020' for format 'Date (DD/MM/YYYY to "
+                    "YYYYMMDD)' in field 5 on row 1 (ignoring the header).",
+                ],
+                [
+                    "2",
+                    "Invalid time format '10h22' in field 6 on row 2 (ignoring the "
+                    "header).",
+                ],
+                [
+                    "3",
+                    "Row 3 (ignoring the header) has more fields than are defined in "
+                    "the configuration file! The row has 10 fields while the "
+                    "configuration defines only 9 possible fields.",
+                ],
+                [
+                    "4",
+                    "Field 8 on row 4 (ignoring the header) is too long! Length: 51, "
+                    "max length 40.",
+                ],
+                [
+                    "5",
+                    "Invalid decimal format '1,567.0' in field 4 on row 5 (ignoring "
+                    "the header).",
+                ],
+            ],
+        )
+        shutil.rmtree(output_directory)
+        self.assertFalse(os.path.isdir(output_directory))
+
+    def test_process_file_conversion_cache(self):
+        """
+        Test that the repeated dates and times are converted once
+        """
+        output_directory = "nonexistent_dir"
+        input_file = "%s/input.txt" % output_directory
+        self.assertFalse(os.path.isdir(output_directory))
+        pathlib.Path(output_directory).mkdir()
+        with open("tests/sample_files/input1.txt") as f:
+            lines = f.read().split("\n")
+        with open(input_file, "w") as f:
+            f.write("\n".join([lines[0]] + lines[1:4] * 3 + lines[4:]))
+        with self.assertLogs(level="INFO") as cm:
+            results = target.process_file(
+                input_file,
+                output_directory=output_directory,
+                config="tests/sample_files/configuration1.xlsx",
+                delimiter="^",
+                skip_header=1,
+                skip_footer=1,
+                application_id="SE",
+                run_id=1,
+            )
+        self.assertIn("INFO:root:Field 5 conversion cache: 6 hits, 3 misses", cm.output)
+        self.assertIn("INFO:root:Field 6 conversion cache: 6 hits, 3 misses", cm.output)
+        with open("tests/sample_files/output.txt") as f:
+            expected_output = f.read()
+        with open(results[0].detailed_file) as f:
+            self.assertEqual("\n".join([expected_output] * 3), f.read())
+        shutil.rmtree(output_directory)
+        self.assertFalse(os.path.isdir(output_directory))
+
+    def test_process_file_decimal_separator(self):
+        """
+        Test converting the Decimal values with a decimal separator given on the
+        command line instead of the locale
+        """
+        output_directory = "nonexistent_dir"
+        input_file = "%s/input.txt" % output_directory
+        self.assertFalse(os.path.isdir(output_directory))
+        pathlib.Path(output_directory).mkdir()
+        with open("tests/sample_files/input1.txt") as f:
+            content = f.read()
+        with open(input_file, "w") as f:
+            f.write(content.replace("^1.567^", "^1,567^").replace("^221.", "^221,"))
+        options = {
+            "output_directory": output_directory,
+            "config": "tests/sample_files/configuration1.xlsx",
+            "delimiter": "^",
+            "skip_header": 1,
+            "skip_footer": 1,
+            "application_id": "SE",
+            "run_id": 1,
+            "overwrite_files": True,
+        }
+        results = target.process_file(input_file, decimal_separator=",", **options)
+        with open("tests/sample_files/output.txt") as f:
+            expected_output = f.read()
+        with open(results[0].detailed_file) as f:
+            self.assertEqual(expected_output, f.read())
+
+        # Pure integer arithmetic, rounded half up
+        self.assertEqual(target.convert_decimal(" 2.675 ", "."), "268")
+        self.assertEqual(target.convert_decimal("-1,005", ","), "-101")
+        self.assertEqual(target.convert_decimal("-0.004", "."), "0")
+        self.assertEqual(target.convert_decimal(".5", "."), "50")
+        with self.assertRaises(ValueError):
+            target.convert_decimal("1.567", ",")
+        with self.assertRaises(target.ConversionError) as cm:
+            target.process_file(input_file, decimal_separator=".", **options)
+        self.assertEqual(cm.exception.exit_code, 19)
+        self.assertTrue(str(cm.exception).startswith("Invalid decimal format '"))
+        with self.assertRaises(target.ConversionError) as cm:
+            target.convert_cell("1.2.3", "Decimal", 4, 2, ".")
+        self.assertEqual(
+            str(cm.exception),
+            "Invalid decimal format '1.2.3' in field 4 on row 2 (ignoring the header).",
+        )
+        self.assertEqual(cm.exception.exit_code, 19)
+        with self.assertRaises(target.InvalidArgumentError) as cm:
+            target.process_file(input_file, decimal_separator=",.", **options)
+        self.assertEqual(cm.exception.exit_code, 253)
+        with self.assertRaises(target.InvalidArgumentError) as cm:
+            target.process_file(
+                input_file, decimal_separator=",", locale="C", **options
+            )
+        self.assertEqual(cm.exception.exit_code, 254)
+        shutil.rmtree(output_directory)
+        self.assertFalse(os.path.isdir(output_directory))
+
+    def test_process_file_write_batches(self):
+        """
+        Test that the rows written in batches are separated like the others, with
+        some of them diverted
+        """
+        output_directory = "nonexistent_dir"
+        self.assertFalse(os.path.isdir(output_directory))
+        with mock.patch.object(target, "WRITE_BATCH_SIZE", 2):
+            results = target.process_file(
+                "tests/sample_files/input1.txt",
+                output_directory=output_directory,
+                config="tests/sample_files/configuration1.xlsx",
+                delimiter="^",
+                skip_header=1,
+                skip_footer=1,
+                application_id="SE",
+                run_id=1,
+                divert=["4,1.567"],
+            )
+        with open("tests/sample_files/output.txt") as f:
+            expected_output = f.read().split("\n")
+        with open(results[0].detailed_file) as f:
+            self.assertEqual(
+                "\n".join([expected_output[0], expected_output[2]]), f.read()
+            )
+        with open(results[0].diverted_file) as f:
+            self.assertEqual(expected_output[1], f.read())
+        shutil.rmtree(output_directory)
+        self.assertFalse(os.path.isdir(output_directory))
+
+    def test_validate_batch(self):
+        """
+        Test checking a batch of input files with the importable API
+        """
+        results = target.validate_batch(
+            input_directory="tests/sample_files/multiple",
+            output_directory="nonexistent_dir",
+            config="tests/sample_files/configuration1.xlsx",
+            delimiter="^",
+            skip_header=1,
+            skip_footer=1,
+            application_id="SE",
+        )
+        self.assertEqual([result.num_input_rows for result in results], [3, 3, 3])
+        self.assertEqual([result.errors for result in results], [{}, {}, {}])
+        self.assertFalse(os.path.isdir("nonexistent_dir"))
+
+    def test_compile_field_checker(self):
+        """
+        Test that the compiled checks of the fields find the same errors as
+        check_field, and only fall back on it for the invalid values
+        """
+        target.load_delimited2fixedwidth()
+        config = target.load_config("tests/sample_files/configuration1.xlsx")
+        values = {
+            1: ["123", "", "12345678"],
+            4: ["12.5", "-0.01", "1.2.3", "123456.78"],
+            5: ["1/3/2020", "01/03/2020", "31/02/2020", "2020-03-01", ""],
+            6: ["0945", "09:45", "9h45", ""],
+            7: ["x" * 50],
+            8: ["LUCAS Luc", "y" * 41],
+        }
+        for truncate in ([], [1, 4, 8]):
+            for (idx_col, cells) in values.items():
+                field = config[idx_col - 1]
+                check = target.compile_field_checker(field, idx_col, truncate, ".")
+                for cell in cells:
+                    expected = target.check_field(
+                        cell, field, idx_col, 1, truncate, "."
+                    )
+                    self.assertEqual(check(cell, 1), expected, (idx_col, cell))
+        check = target.compile_field_checker(config[4], 5, [])
+        with mock.patch.object(target, "check_field", side_effect=AssertionError):
+            self.assertIsNone(check("01/03/2020", 1))
+        with mock.patch.object(target, "check_field", return_value=18) as check_field:
+            self.assertEqual(check("31/02/2020", 2), 18)
+        check_field.assert_called_once_with("31/02/2020", config[4], 5, 2, [], None)
+
+    def test_process_batch_report(self):
+        """
+        Test the JSON run report of a batch split over several runs
+        """
+        output_directory = "nonexistent_dir"
+        report_file = "%s/report.json" % output_directory
+        self.assertFalse(os.path.isdir(output_directory))
+        target.process_batch(
+            ["tests/sample_files/input1.txt"],
+            output_directory=output_directory,
+            config="tests/sample_files/configuration1.xlsx",
+            delimiter="^",
+            skip_header=1,
+            skip_footer=1,
+            application_id="SE",
+            run_id=123,
+            date_report=5,
+            max_rows_per_run=2,
+            report=report_file,
+        )
+        with open(report_file) as f:
+            report = json.load(f)
+        self.assertEqual([r["run_id"] for r in report["files"]], ["0123", "0124"])
+        self.assertEqual([r["rows"] for r in report["files"]], [2, 1])
+        self.assertEqual(report["files"][0]["oldest_date"], "20200305")
+        # The peak memory usage of the process, not of the run alone
+        self.assertIn("process_peak_rss_bytes", report["files"][0])
+        self.assertNotIn("peak_rss_bytes", report["files"][0])
+        self.assertEqual(
+            report["files"][1]["output_files"],
+            {
+                "%s/SSE0124E" % output_directory: 200,
+                "%s/SSE0124D" % output_directory: 120,
+            },
+        )
+        input_bytes = os.path.getsize("tests/sample_files/input1.txt")
+        self.assertEqual(report["files"][1]["input_bytes"], input_bytes)
+        totals = report["totals"]
+        self.assertEqual(
+            (totals["input_files"], totals["runs"], totals["rows"]), (1, 2, 3)
+        )
+        self.assertEqual(totals["input_bytes"], input_bytes)
+        self.assertEqual(totals["output_bytes"], 200 + 241 + 200 + 120)
+        self.assertEqual(totals["next_run_id"], 125)
+        for key in ("wall_time", "cpu_time", "rows_per_second"):
+            self.assertGreater(totals[key], 0)
+        shutil.rmtree(output_directory)
+        self.assertFalse(os.path.isdir(output_directory))
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_generate_extract(self):
+        """
+        Validate that the synthetic extracts of the benchmark suite can be
+        converted with the sample configuration file
+        """
+        output_directory = "nonexistent_dir"
+        self.assertFalse(os.path.isdir(output_directory))
+        pathlib.Path(output_directory).mkdir()
+        input_file = "%s/extract.txt" % output_directory
+        benchmark.generate_extract(input_file, 100)
+        results = target.process_file(
+            input_file,
+            output_directory=output_directory,
+            config=benchmark.CONFIG,
+            delimiter="^",
+            skip_header=1,
+            skip_footer=1,
+            application_id="BE",
+            run_id=1,
+        )
+        self.assertEqual(results[0].num_input_rows, 100)
+        self.assertEqual(benchmark.parse_rows("10k"), 10000)
+        self.assertEqual(benchmark.parse_rows("10M"), 10000000)
+        shutil.rmtree(output_directory)
+        self.assertFalse(os.path.isdir(output_directory))
+
+
 class TestLicense(unittest.TestCase):
     def test_license_file(self):
         """